@@ -0,0 +1 @@
+"Benchmarks for pymake. Run an individual benchmark with `python -m benchmarks.<name>`"
@@ -0,0 +1,69 @@
+"""Compare the bytes written to the `.pymake-cache` file by the journaling `TimestampCache`
+against the previous strategy of rewriting the whole json file after every target.
+
+    python -m benchmarks.cache_journal [N ...]
+"""
+from typing import Dict, List
+from pathlib import Path
+import tempfile
+import json
+import time
+import sys
+
+from pymake.cache import TimestampCache
+from pymake.targets import Fn, Target
+
+__FLAG_IS_PYMAKEFILE__ = True
+
+
+async def _noop():
+    pass
+
+
+def legacy_bytes_written(targets: List[Target], timestamp: float) -> int:
+    "Bytes the previous `save()`-on-every-set implementation would write for this build"
+    # json.dump(..) of {name: timestamp, ...} with the default ', ' and ': ' separators
+    total = file_size = 0
+    for i, target in enumerate(targets):
+        entry = len(json.dumps(str(target.target))) + 2 + len(json.dumps(timestamp))
+        file_size = (file_size + entry + 2) if i else (2 + entry)
+        total += file_size
+    return total
+
+
+def run(n_targets: int) -> Dict[str, float]:
+    targets = {f'out/{i}.o': Fn(f'out/{i}.o', f'src/{i}.c', _noop)
+               for i in range(n_targets)}
+    timestamp = time.time()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / '.pymake-cache'
+        start = time.perf_counter()
+        cache = TimestampCache(path, targets)
+        for target in targets.values():
+            cache[target] = timestamp
+        cache.save()
+        elapsed = time.perf_counter() - start
+        final_size = path.stat().st_size
+
+    legacy = legacy_bytes_written(list(targets.values()), timestamp)
+    return {
+        'targets': n_targets,
+        'journal_bytes_written': cache.bytes_written,
+        'legacy_bytes_written': legacy,
+        'final_file_size': final_size,
+        'bytes_per_target': cache.bytes_written / n_targets,
+        'seconds': elapsed,
+    }
+
+
+def main(sizes: List[int]):
+    print(f"{'targets':>8} {'journal bytes':>14} {'legacy bytes':>16} {'bytes/target':>12} {'seconds':>8}")
+    for n in sizes:
+        res = run(n)
+        print(f"{res['targets']:>8} {res['journal_bytes_written']:>14} {res['legacy_bytes_written']:>16}"
+              f" {res['bytes_per_target']:>12.1f} {res['seconds']:>8.3f}")
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [100, 1000, 10000, 20000])
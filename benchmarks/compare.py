@@ -0,0 +1,50 @@
+"""Compare two results files of `benchmarks.suite`, ie from two commits.
+
+    python -m benchmarks.compare BEFORE AFTER
+"""
+from typing import Any, Dict, Tuple
+import json
+import sys
+
+# metric -> whether higher is better
+METRICS = {
+    'load_seconds': False,
+    'full_build_targets_per_second': True,
+    'noop_build_seconds': False,
+    'cache_load_seconds': False,
+    'cache_save_seconds': False,
+    'peak_rss_bytes': False,
+}
+
+Case = Tuple[str, int, bool, str]
+
+
+def _cases(path: str) -> Dict[Case, Dict[str, Any]]:
+    with open(path) as f:
+        results = json.load(f)['results']
+    return {(r['shape'], r['targets'], r['real_files'], r['executor']): r for r in results}
+
+
+def run(before: str, after: str) -> Dict[Case, Dict[str, float]]:
+    "The ratio of after to before of each metric, of the cases in both"
+    old, new = _cases(before), _cases(after)
+    return {
+        case: {metric: new[case][metric] / old[case][metric] if old[case][metric] else float('nan')
+               for metric in METRICS}
+        for case in old if case in new
+    }
+
+
+def main(before: str, after: str):
+    for (shape, n_targets, real_files, executor), ratios in run(before, after).items():
+        changes = []
+        for metric, ratio in ratios.items():
+            better = (ratio > 1) == METRICS[metric]
+            changes.append(f"{metric} {ratio - 1:+.0%}{'' if abs(ratio - 1) < 0.05 else ' (better)' if better else ' (worse)'}")
+        print(f"{shape} {n_targets} {'real' if real_files else 'fake'} {executor}: " + ', '.join(changes))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    main(*sys.argv[1:])
@@ -0,0 +1,74 @@
+"""Compare the per-target dispatch overhead of the warm worker pool against `ProcessPoolExecutor`,
+which re-pickles every target (with its deps and envvars) and starts a new event loop for each job.
+
+    python -m benchmarks.dispatch [N_TARGETS] [N_WORKERS]
+"""
+from typing import Dict, List
+import asyncio
+import time
+import sys
+
+import dill  # type: ignore
+
+from pymake.executors import Remade, _remake, _remake_async
+from pymake.processpoolexecutor import ProcessPoolExecutor
+from pymake.targets import Fn, Target
+from pymake.workerpool import WarmWorkerPool
+
+__FLAG_IS_PYMAKEFILE__ = True
+
+
+async def _noop():
+    pass
+
+
+async def _job(target: Target) -> Remade:
+    return await _remake_async(target, [], False)
+
+
+async def _process_pool(targets: List[Target], n_workers: int) -> float:
+    with ProcessPoolExecutor(n_workers) as executor:
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            asyncio.wrap_future(executor.submit(_remake, target, [], False)) for target in targets))
+        return time.perf_counter() - start
+
+
+async def _warm_pool(targets: List[Target], n_workers: int) -> float:
+    with WarmWorkerPool(targets, _job, n_workers) as pool:
+        # fork the workers up-front, so that we only time dispatching
+        await pool.submit(targets[0])
+        start = time.perf_counter()
+        await asyncio.gather(*(pool.submit(target) for target in targets))
+        return time.perf_counter() - start
+
+
+def run(n_targets: int, n_workers: int) -> Dict[str, float]:
+    targets: List[Target] = [Fn(None, [], _noop, do_cache=False) for _ in range(n_targets)]
+    loop = asyncio.new_event_loop()
+    try:
+        process_pool = loop.run_until_complete(_process_pool(targets, n_workers))
+        warm_pool = loop.run_until_complete(_warm_pool(targets, n_workers))
+    finally:
+        loop.close()
+
+    return {
+        'targets': n_targets,
+        'workers': n_workers,
+        'process_pool_us_per_target': process_pool / n_targets * 1e6,
+        'warm_pool_us_per_target': warm_pool / n_targets * 1e6,
+        'process_pool_bytes_per_target': len(dill.dumps((_remake, (targets[0], [], False)))),
+    }
+
+
+def main(n_targets: int, n_workers: int):
+    res = run(n_targets, n_workers)
+    print(f"{res['targets']} targets on {res['workers']} workers")
+    print(f"  ProcessPoolExecutor: {res['process_pool_us_per_target']:8.1f} us/target, "
+          f"~{res['process_pool_bytes_per_target']} bytes pickled per target")
+    print(f"  WarmWorkerPool:      {res['warm_pool_us_per_target']:8.1f} us/target")
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [2000, 4][len(args):]))
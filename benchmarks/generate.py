@@ -0,0 +1,109 @@
+"""Generate synthetic PyMakefiles of a given shape and size, for the benchmark suite.
+
+    python -m benchmarks.generate DIRECTORY [SHAPE] [N_TARGETS] [REAL_FILES]
+
+Shapes:
+    fanout   - one group of N independent targets
+    chain    - N targets, each depending on the one before
+    diamond  - layers of DIAMOND_WIDTH targets, each depending on two targets of the layer before
+    patterns - N requests for the outputs of N / PATTERN_FANOUT `%` pattern rules
+
+Every target writes an output file. With real files, the targets at the start of the graph also depend on
+source files, which are created, so that their staleness is checked against files that exist; otherwise they
+have no file dependencies. Pattern rules always use real files, as their inputs are what they match.
+"""
+from pathlib import Path
+import sys
+
+SHAPES = ('fanout', 'chain', 'diamond', 'patterns')
+DIAMOND_WIDTH = 32
+PATTERN_FANOUT = 100
+
+_HEADER = '''\
+from pymake import *
+from pymake.targets import Fn
+
+N_TARGETS = {n_targets}
+REAL_FILES = {real_files}
+
+
+async def write(out: Path):
+    out.touch()
+
+
+def target(i, deps):
+    return Fn(f'out/{{i}}.o', deps, write)
+
+
+def source(i):
+    return [f'src/{{i}}.c'] if REAL_FILES else []
+
+'''
+
+_SHAPES = {
+    'fanout': '''\
+for i in range(N_TARGETS):
+    globals()[f't{i}'] = target(i, source(i))
+all = Group([globals()[f't{i}'] for i in range(N_TARGETS)])
+''',
+    'chain': '''\
+previous = None
+for i in range(N_TARGETS):
+    previous = globals()[f't{i}'] = target(i, [previous] if previous else source(i))
+all = Group([previous])
+''',
+    'diamond': '''\
+WIDTH = {width}
+previous, layer = [], []
+for start in range(0, N_TARGETS, WIDTH):
+    previous, layer = layer, []
+    for i in range(start, min(start + WIDTH, N_TARGETS)):
+        j = i - start
+        deps = [previous[j], previous[(j + 1) % WIDTH]] if previous else source(i)
+        layer.append(target(i, deps))
+        globals()[f't{{i}}'] = layer[-1]
+all = Group(previous + layer)
+''',
+    'patterns': '''\
+FANOUT = {fanout}
+for p in range((N_TARGETS + FANOUT - 1) // FANOUT):
+    globals()[f'rule{{p}}'] = Fn(f'gen/{{p}}/%.out', f'src/{{p}}/%.in', write)
+all = Group([Path(f'gen/{{i // FANOUT}}/{{i}}.out') for i in range(N_TARGETS)])
+''',
+}
+
+
+def generate(directory: Path, shape: str = 'fanout', n_targets: int = 1000, real_files: bool = True) -> Path:
+    "Write the PyMakefile and its source files into the directory, returning the PyMakefile's path"
+    if shape not in SHAPES:
+        raise ValueError(f"Unknown shape '{shape}', expected one of {list(SHAPES)}")
+    real_files = real_files or shape == 'patterns'
+    directory.mkdir(parents=True, exist_ok=True)
+
+    if shape == 'patterns':
+        for i in range(n_targets):
+            p = i // PATTERN_FANOUT
+            (directory / 'src' / str(p)).mkdir(parents=True, exist_ok=True)
+            (directory / 'gen' / str(p)).mkdir(parents=True, exist_ok=True)
+            (directory / 'src' / str(p) / f'{i}.in').touch()
+    else:
+        (directory / 'out').mkdir(exist_ok=True)
+    if real_files and shape != 'patterns':
+        (directory / 'src').mkdir(exist_ok=True)
+        n_sources = {'fanout': n_targets, 'chain': 1, 'diamond': DIAMOND_WIDTH}[shape]
+        for i in range(min(n_sources, n_targets)):
+            (directory / 'src' / f'{i}.c').touch()
+
+    makefile = directory / 'PyMakefile.py'
+    body = _SHAPES[shape] if shape in ('fanout', 'chain') \
+        else _SHAPES[shape].format(width=DIAMOND_WIDTH, fanout=PATTERN_FANOUT)
+    makefile.write_text(_HEADER.format(n_targets=n_targets, real_files=real_files) + body)
+    return makefile
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if not args:
+        sys.exit(__doc__)
+    directory, shape, n_targets, real_files = args + ['fanout', '1000', 'true'][len(args) - 1:]
+    print(generate(Path(directory), shape, int(n_targets), real_files.lower() in ('1', 'true', 'yes')))
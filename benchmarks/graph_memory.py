@@ -0,0 +1,86 @@
+"""Measure the memory taken by the targets of a generated PyMakefile and by the `BuildGraph` expanded from them,
+as bytes per node and bytes per edge (fitted from a graph with and without dependencies between targets).
+
+    python -m benchmarks.graph_memory [N_TARGETS] [DEPS_PER_TARGET]
+"""
+from typing import Dict, List, Tuple
+from pathlib import Path
+import tracemalloc
+import tempfile
+import random
+import sys
+import gc
+
+from pymake.graph import BuildGraph
+from pymake.snapshot import FileSnapshot
+from pymake.targets import Fn, Group, Target
+
+__FLAG_IS_PYMAKEFILE__ = True
+
+
+async def _noop():
+    pass
+
+
+def _traced(fn):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = fn()
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, allocated
+
+
+def _build(n_targets: int, deps_per_target: int, directory: Path) -> Tuple[int, int, int]:
+    "Returns (bytes for the targets, bytes for the graph, number of edges)"
+    rng = random.Random(0)
+
+    def define() -> Dict[str, Target]:
+        targets: Dict[str, Target] = {}
+        created: List[Target] = []
+        for i in range(n_targets):
+            deps = [created[rng.randrange(i)] for _ in range(min(deps_per_target, i))]
+            # every target also includes the same header, as a file dependency
+            target = Fn(f'out/{i}.o', [*deps, 'common.h'], _noop)
+            targets[f't{i}'] = target
+            created.append(target)
+        targets['all'] = Group(created)
+        return targets
+
+    targets, targets_bytes = _traced(define)
+    snapshot = FileSnapshot(directory)
+    graph, graph_bytes = _traced(lambda: BuildGraph(targets['all'], targets, directory, snapshot))
+    edges = sum(len(node.deps) + len(node.files) for node in graph.order)
+    return targets_bytes, graph_bytes, edges
+
+
+def run(n_targets: int, deps_per_target: int) -> Dict[str, float]:
+    with tempfile.TemporaryDirectory() as tmp:
+        (Path(tmp) / 'common.h').touch()
+        sparse = _build(n_targets, 0, Path(tmp))
+        dense = _build(n_targets, deps_per_target, Path(tmp))
+
+    nodes = n_targets + 1
+    targets_per_edge = (dense[0] - sparse[0]) / max(dense[2] - sparse[2], 1)
+    graph_per_edge = (dense[1] - sparse[1]) / max(dense[2] - sparse[2], 1)
+    return {
+        'nodes': nodes,
+        'edges': dense[2],
+        'target_bytes_per_node': (sparse[0] - targets_per_edge * sparse[2]) / nodes,
+        'target_bytes_per_edge': targets_per_edge,
+        'graph_bytes_per_node': (sparse[1] - graph_per_edge * sparse[2]) / nodes,
+        'graph_bytes_per_edge': graph_per_edge,
+    }
+
+
+def main(n_targets: int, deps_per_target: int):
+    res = run(n_targets, deps_per_target)
+    print(f"{res['nodes']} nodes, {res['edges']} edges")
+    print(f"  targets:    {res['target_bytes_per_node']:8.0f} bytes/node, {res['target_bytes_per_edge']:6.1f} bytes/edge")
+    print(f"  BuildGraph: {res['graph_bytes_per_node']:8.0f} bytes/node, {res['graph_bytes_per_edge']:6.1f} bytes/edge")
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [100_000, 4][len(args):]))
@@ -0,0 +1,58 @@
+"""Wall time of a build of CPU-bound shell commands at different `-j` job limits.
+Without a limit, every target's subprocess starts at once and they oversubscribe the cores.
+
+    python -m benchmarks.jobs [N_TARGETS] [WORK]
+"""
+from typing import Dict, List, Optional
+from pathlib import Path
+import asyncio
+import time
+import sys
+
+from pymake.environment import N_CPU_CORES
+from pymake.make import make
+from pymake.shell import sh
+from pymake.targets import Fn, Group, Target
+
+__FLAG_IS_PYMAKEFILE__ = True
+
+
+def _busy(work: int) -> Target:
+    async def burn():
+        await sh(f"{sys.executable} -c 'sum(range({work}))'", silent=True)
+    return Fn(None, [], burn, do_cache=False)
+
+
+def _job_limits() -> List[Optional[int]]:
+    limits = {1, 2, max(N_CPU_CORES // 2, 1), N_CPU_CORES, 2 * N_CPU_CORES}
+    return [*sorted(limits), None]
+
+
+def run(n_targets: int, work: int) -> Dict[str, float]:
+    targets = {f't{i}': _busy(work) for i in range(n_targets)}
+    root = Group(list(targets.values()))
+    results: Dict[str, float] = {}
+
+    for jobs in _job_limits():
+        loop = asyncio.new_event_loop()
+        try:
+            start = time.perf_counter()
+            loop.run_until_complete(make(
+                root, cache=None, targets=targets, prefix_dir=Path('.'), jobs=jobs))
+            results[f'j{jobs or "unlimited"}_seconds'] = time.perf_counter() - start
+        finally:
+            loop.close()
+    return results
+
+
+def main(n_targets: int, work: int):
+    res = run(n_targets, work)
+    print(f"{n_targets} targets of sum(range({work})) on {N_CPU_CORES} cores")
+    for name, seconds in res.items():
+        jobs = name[1:-len('_seconds')]
+        print(f"  -j {jobs:>9}: {seconds:6.2f} s")
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [4 * N_CPU_CORES, 5_000_000][len(args):]))
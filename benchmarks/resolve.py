@@ -0,0 +1,84 @@
+"""Time resolving dependencies to targets with the `TargetIndex`, against scanning every target with a regex
+per request as `find_matching_target` used to.
+
+    python -m benchmarks.resolve [N_TARGETS] [N_PATTERNS] [N_REQUESTS]
+"""
+from typing import Dict, List
+import random
+import time
+import sys
+import re
+
+from pymake.targets import Target
+from pymake.targets.wildcard import TargetIndex
+
+
+class _Output(Target):
+    async def make(self):
+        pass
+
+
+def _targets(n_targets: int, n_patterns: int) -> Dict[str, Target]:
+    targets: Dict[str, Target] = {}
+    for i in range(n_targets):
+        targets[f'obj{i}'] = _Output(f'build/obj/{i}.o', f'src/{i}.c', cwd='.')
+    for i in range(n_patterns):
+        targets[f'rule{i}'] = _Output(f'gen/{i}/%.out', f'in/{i}/%.txt', cwd='.')
+    return targets
+
+
+def _linear_scan(request: str, targets: Dict[str, Target]) -> Target:
+    "The previous implementation, without its unscoped memo"
+    if request in targets:
+        return targets[request]
+    pattern = re.compile(request.replace("**", r"\w*").replace("*", r"\w*"))
+    for target in targets.values():
+        if target.matches(pattern):
+            return target
+    raise KeyError(request)
+
+
+def run(n_targets: int, n_patterns: int, n_requests: int) -> Dict[str, float]:
+    targets = _targets(n_targets, n_patterns)
+    rng = random.Random(0)
+    requests: List[str] = [
+        f'build/obj/{rng.randrange(n_targets)}.o' if rng.random() < 0.5
+        else f'gen/{rng.randrange(n_patterns)}/file{rng.randrange(1000)}.out'
+        for _ in range(n_requests)
+    ]
+
+    start = time.perf_counter()
+    index = TargetIndex(targets)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for request in requests:
+        index.find(request)
+    indexed = time.perf_counter() - start
+
+    # only plain outputs, as the scan never matched pattern targets; and few of them, as it's slow
+    plain = [request for request in requests if request.endswith('.o')][:max(n_requests // 100, 1)]
+    start = time.perf_counter()
+    for request in plain:
+        _linear_scan(request, targets)
+    scanned = time.perf_counter() - start
+
+    return {
+        'targets': n_targets,
+        'patterns': n_patterns,
+        'index_build_ms': build * 1e3,
+        'index_us_per_lookup': indexed / len(requests) * 1e6,
+        'scan_us_per_lookup': scanned / len(plain) * 1e6,
+    }
+
+
+def main(n_targets: int, n_patterns: int, n_requests: int):
+    res = run(n_targets, n_patterns, n_requests)
+    print(f"{res['targets']} targets and {res['patterns']} pattern targets")
+    print(f"  TargetIndex: built in {res['index_build_ms']:8.1f} ms, {res['index_us_per_lookup']:8.1f} us/lookup")
+    print(f"  linear scan:                      {res['scan_us_per_lookup']:8.1f} us/lookup")
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [50_000, 2_000, 20_000][len(args):]))
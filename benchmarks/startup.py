@@ -0,0 +1,89 @@
+"""Check the startup time of pymake against a budget: of importing pymake, as every PyMakefile does, and of
+`pymake show` in a generated project. Exits with status 1 if either is over budget, or if importing pymake
+imports a module that should only be imported once it's needed.
+
+    python -m benchmarks.startup [IMPORT_BUDGET_MS] [SHOW_BUDGET_MS] [N_TARGETS]
+
+Times are the best of REPEATS runs, from `python -X importtime` for the import and the wall clock for `show`.
+The import is also compared to that of asyncio, which pymake is built on, as `tests/test_startup.py` does to
+check it against IMPORT_BUDGET_RATIO on machines of any speed.
+"""
+from typing import Any, Dict, List
+from pathlib import Path
+import subprocess
+import tempfile
+import time
+import sys
+import os
+
+from .generate import generate
+
+IMPORT_BUDGET_MS = 125.0
+IMPORT_BUDGET_RATIO = 3.0  # of the time to import pymake to the time to import asyncio
+SHOW_BUDGET_MS = 400.0
+REPEATS = 5
+# imported when they're needed, rather than by `import pymake`
+LAZY_MODULES = ('click', 'dill', 'multiprocess', 'multiprocessing', 'tblib', 'concurrent.futures.process')
+
+
+def import_times(code: str, cwd: str = '.') -> Dict[str, float]:
+    "The cumulative time in ms to import each module the code imports, per `python -X importtime`"
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(Path(__file__).parent.parent)] + sys.path))
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=cwd, env=env,
+                         capture_output=True, text=True, check=True)
+    times: Dict[str, float] = {}
+    for line in res.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        times[module.strip()] = int(cumulative) / 1000
+    return times
+
+
+def show_seconds(directory: str) -> float:
+    "The wall clock time of `pymake show` in the directory"
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(Path(__file__).parent.parent)] + sys.path))
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'from pymake.cli import cli_shell; cli_shell()', 'show'],
+                   cwd=directory, env=env, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def run(n_targets: int) -> Dict[str, Any]:
+    imports = [import_times('import pymake') for _ in range(REPEATS)]
+    asyncio_ms = min(import_times('import asyncio')['asyncio'] for _ in range(REPEATS))
+    with tempfile.TemporaryDirectory() as tmp:
+        generate(Path(tmp), 'fanout', n_targets)
+        show_seconds(tmp)  # warm the filesystem cache
+        show = min(show_seconds(tmp) for _ in range(REPEATS))
+    return {
+        'targets': n_targets,
+        'import_ms': min(times['pymake'] for times in imports),
+        'import_ratio': min(times['pymake'] for times in imports) / asyncio_ms,
+        'show_ms': show * 1000,
+        'lazy_modules_imported': sorted(m for m in LAZY_MODULES if m in imports[0]),
+    }
+
+
+def main(import_budget_ms: float, show_budget_ms: float, n_targets: int) -> int:
+    res = run(n_targets)
+    failures: List[str] = []
+    print(f"import pymake:  {res['import_ms']:7.1f} ms (budget {import_budget_ms:.0f} ms), "
+          f"{res['import_ratio']:.2f}x import asyncio")
+    if res['import_ms'] > import_budget_ms:
+        failures.append('import pymake is over budget')
+    print(f"pymake show:    {res['show_ms']:7.1f} ms (budget {show_budget_ms:.0f} ms, {n_targets} targets)")
+    if res['show_ms'] > show_budget_ms:
+        failures.append('pymake show is over budget')
+    if res['lazy_modules_imported']:
+        failures.append(f"import pymake imported {', '.join(res['lazy_modules_imported'])}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    import_budget_ms, show_budget_ms, n_targets = args + [str(IMPORT_BUDGET_MS), str(SHOW_BUDGET_MS), '100'][len(args):]
+    sys.exit(main(float(import_budget_ms), float(show_budget_ms), int(n_targets)))
@@ -0,0 +1,137 @@
+"""Run the benchmark suite over generated PyMakefiles (see `benchmarks.generate`) of every shape and size,
+and write the results as JSON to compare between commits with `benchmarks.compare`.
+
+    python -m benchmarks.suite [OUTPUT] [MAX_TARGETS] [EXECUTOR]
+
+For each case it measures the time to load the PyMakefile with `run_path`, the throughput of a full build
+of trivial `Fn` targets, the latency of a no-op build, the time to load and save the cache, and peak RSS.
+Each case runs in its own process, so that its peak RSS is its own.
+"""
+from typing import Any, Dict, List
+from runpy import run_path
+from pathlib import Path
+import subprocess
+import tempfile
+import platform
+import resource
+import asyncio
+import json
+import time
+import sys
+
+from benchmarks.generate import SHAPES, generate
+from pymake.cache import TimestampCache
+from pymake.make import make
+from pymake.targets import Target
+from pymake.targets.wildcard import TargetIndex
+
+SIZES = (1_000, 10_000, 100_000)
+
+
+def run_case(shape: str, n_targets: int, real_files: bool, executor: str) -> Dict[str, Any]:
+    "Measure one generated PyMakefile, in this process"
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        makefile = generate(directory, shape, n_targets, real_files)
+        cache_path = directory / '.pymake-cache'
+
+        start = time.perf_counter()
+        exports = run_path(str(makefile))
+        targets = {name: val for name, val in exports.items() if isinstance(val, Target)}
+        index = TargetIndex(targets)
+        load = time.perf_counter() - start
+
+        def build() -> Any:
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(make(
+                    targets['all'], cache=cache_path, targets=index, prefix_dir=directory, executor=executor))
+            finally:
+                loop.close()
+
+        start = time.perf_counter()
+        full = build()
+        full_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cache = TimestampCache(cache_path, index)
+        cache_load = time.perf_counter() - start
+        start = time.perf_counter()
+        cache.compact()
+        cache_save = time.perf_counter() - start
+
+        start = time.perf_counter()
+        noop = build()
+        noop_seconds = time.perf_counter() - start
+
+    # kilobytes on Linux, bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return {
+        'shape': shape,
+        'targets': n_targets,
+        'real_files': real_files,
+        'executor': executor,
+        'nodes': full.targets,
+        'load_seconds': load,
+        'full_build_seconds': full_seconds,
+        'full_build_targets_per_second': full.remade / full_seconds,
+        'noop_build_seconds': noop_seconds,
+        'noop_remade': noop.remade,
+        'cache_load_seconds': cache_load,
+        'cache_save_seconds': cache_save,
+        'peak_rss_bytes': peak_rss,
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run(max_targets: int, executor: str) -> Dict[str, Any]:
+    results: List[Dict[str, Any]] = []
+    for n_targets in [n for n in SIZES if n <= max_targets] or [max_targets]:
+        for shape in SHAPES:
+            for real_files in ((True,) if shape == 'patterns' else (True, False)):
+                # in a fresh process, for its own peak RSS
+                out = subprocess.run(
+                    [sys.executable, '-m', 'benchmarks.suite', '--case',
+                     shape, str(n_targets), str(real_files), executor],
+                    capture_output=True, text=True, check=True)
+                results.append(json.loads(out.stdout.splitlines()[-1]))
+                _print_case(results[-1])
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+def _print_case(res: Dict[str, Any]):
+    print(f"{res['shape']:>8} {res['targets']:>7} {'real' if res['real_files'] else 'fake':>4}: "
+          f"load {res['load_seconds']:7.3f}s, "
+          f"full {res['full_build_targets_per_second']:8.0f} targets/s, "
+          f"no-op {res['noop_build_seconds']:7.3f}s, "
+          f"cache load {res['cache_load_seconds']:6.3f}s save {res['cache_save_seconds']:6.3f}s, "
+          f"peak RSS {res['peak_rss_bytes'] / 2**20:6.0f} MiB")
+
+
+def main(output: str, max_targets: int, executor: str):
+    res = run(max_targets, executor)
+    with open(output, 'w') as f:
+        json.dump(res, f, indent=2)
+    print(f"Wrote {len(res['results'])} results to {output}")
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--case']:
+        shape, n_targets, real_files, executor = sys.argv[2:6]
+        print(json.dumps(run_case(shape, int(n_targets), real_files == 'True', executor)))
+    else:
+        args = sys.argv[1:]
+        output, max_targets, executor = args + ['benchmark-results.json', '10000', 'inline'][len(args):]
+        main(output, int(max_targets), executor)
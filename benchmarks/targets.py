@@ -0,0 +1,77 @@
+"""Measure how many targets a PyMakefile can define per second, and the memory each one takes,
+against the previous constructor that called `inspect.stack()` and copied `os.environ` for every target.
+
+    python -m benchmarks.targets [N_TARGETS]
+"""
+from typing import Any, Callable, Dict
+from pathlib import Path
+import tracemalloc
+import inspect
+import time
+import sys
+import os
+
+from pymake.targets import Fn, Target
+
+__FLAG_IS_PYMAKEFILE__ = True
+
+
+async def _noop():
+    pass
+
+
+class _LegacyFn(Fn):
+    "Fn with the constructor of `Target` as it was"
+
+    def __init__(self, target: Any, deps: Any, fn: Any):
+        for frame in inspect.stack():
+            if frame.frame.f_globals.get('__FLAG_IS_PYMAKEFILE__'):
+                self.cwd = Path(frame.filename).parent
+                break
+        self.target = target
+        self.deps = [Path(deps)]
+        self.do_cache = True
+        self.env = os.environ.copy()
+        self.executor = None
+        self.fn = fn
+
+
+def _measure(n_targets: int, make: Callable[[int], Target]) -> Dict[str, float]:
+    start = time.perf_counter()
+    targets = [make(i) for i in range(n_targets)]
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    more = [make(i) for i in range(n_targets)]
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del targets, more
+
+    return {'per_second': n_targets / elapsed, 'bytes_per_target': allocated / n_targets}
+
+
+def run(n_targets: int) -> Dict[str, float]:
+    legacy = _measure(n_targets, lambda i: _LegacyFn(f'out/{i}.o', f'src/{i}.c', _noop))
+    current = _measure(n_targets, lambda i: Fn(f'out/{i}.o', f'src/{i}.c', _noop))
+    return {
+        'targets': n_targets,
+        'legacy_per_second': legacy['per_second'],
+        'legacy_bytes_per_target': legacy['bytes_per_target'],
+        'per_second': current['per_second'],
+        'bytes_per_target': current['bytes_per_target'],
+    }
+
+
+def main(n_targets: int):
+    res = run(n_targets)
+    print(f"{res['targets']} targets, with {len(os.environ)} envvars")
+    print(f"  previous constructor: {res['legacy_per_second']:10.0f} targets/s, "
+          f"{res['legacy_bytes_per_target']:8.0f} bytes/target")
+    print(f"  Target:               {res['per_second']:10.0f} targets/s, "
+          f"{res['bytes_per_target']:8.0f} bytes/target")
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [20_000][len(args):]))
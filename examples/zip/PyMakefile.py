@@ -2,8 +2,8 @@ from pymake import *
 
 
 @makes('files.zip', 'files/*')
-async def zip(out: Path, files: Dependencies):
-    await sh(f"zip -r {out} {files}")
+async def zip(out: Path, deps: Dependencies):
+    await sh(f"zip -r {out} {' '.join(map(str, deps))}")
 
 if __name__ == "__main__":
     cli(__file__, loglevel='DEBUG')
@@ -0,0 +1,334 @@
+"""A cache of the outputs of targets shared between builds, ie of CI machines and developers' laptops, so that
+a target remade once needn't be remade anywhere else. Also serves a local directory of them over HTTP:
+
+    python -m pymake.artifacts DIRECTORY [[HOST:]PORT] [MAX_BYTES]
+
+The server only listens on localhost unless given a host, as anyone who can reach it can store archives
+that builds will unpack over their outputs.
+"""
+from typing import AbstractSet, Any, Callable, Dict, Iterator, List, Optional, Tuple
+from abc import ABC, abstractmethod
+from pathlib import Path
+import asyncio
+import hashlib
+import shutil
+import tempfile
+import threading
+import types
+import sys
+import io
+import os
+import re
+
+from .graph import Node
+from .logger import logger
+from .targets.target import FilePath, Target
+
+DEFAULT_MAX_BYTES = 10 << 30
+DEFAULT_HOST = '127.0.0.1'
+HTTP_TIMEOUT = 30.0  # seconds
+# the envvars that targets are keyed by, which change what compilers and linkers make. Any others, which differ
+# between machines and shells and may hold secrets, are left out of keys
+KEYED_ENV = frozenset({
+    'CC', 'CXX', 'CPP', 'AR', 'AS', 'LD', 'FC', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'ASFLAGS', 'LDFLAGS', 'LDLIBS',
+    'FFLAGS', 'ARFLAGS', 'CPATH', 'C_INCLUDE_PATH', 'CPLUS_INCLUDE_PATH', 'LIBRARY_PATH', 'PKG_CONFIG_PATH',
+    'SOURCE_DATE_EPOCH', 'LANG', 'LC_ALL',
+})
+_KEY = re.compile(r'[0-9a-f]{40}')
+
+
+class ArtifactStore(ABC):
+    "Where archives of the outputs of targets are kept, by key. Blocking, so run in a thread"
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        "The archive stored under the key, or None if there isn't one"
+
+    @abstractmethod
+    def put(self, key: str, data: bytes):
+        "Store the archive under the key"
+
+
+class LocalStore(ArtifactStore):
+    """Archives kept as files in a directory, which may be shared by builds on the machine or over NFS.
+    Once they total more than `max_bytes`, the least recently used are deleted, going by their mtimes,
+    which are touched whenever they're fetched"""
+
+    def __init__(self, directory: FilePath, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._total: Optional[int] = None  # the size of the archives, as of the last scan and our own puts
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key: str, data: bytes):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # written aside and renamed into place, so that a build reading it never sees half of it
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        with self._lock:
+            if self._total is None:
+                self._total = sum(size for _, size, _ in self._archives())
+            else:
+                self._total += len(data)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def evict(self):
+        "Delete the least recently used archives until they total at most `max_bytes`"
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        archives = sorted(self._archives())
+        total = sum(size for _, size, _ in archives)
+        for _, size, path in archives:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        logger.debug(f"Evicted archives from {self.directory} down to {total} bytes")
+        self._total = total
+
+    def _archives(self) -> Iterator[Tuple[float, int, str]]:
+        "The mtime, size and path of every archive"
+        try:
+            shards = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        for shard in shards:
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if _KEY.fullmatch(entry.name):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield stat.st_mtime, stat.st_size, entry.path
+
+
+class HttpStore(ArtifactStore):
+    """Archives on an HTTP server, fetched with `GET <url>/<key>` and stored with `PUT <url>/<key>`,
+    ie a bucket, a WebDAV share or `python -m pymake.artifacts`. A 404 is a miss"""
+
+    def __init__(self, url: str, timeout: float = HTTP_TIMEOUT):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def get(self, key: str) -> Optional[bytes]:
+        # imported here, as it takes longer to import than most builds take to check
+        import urllib.error
+        import urllib.request
+        try:
+            with urllib.request.urlopen(f'{self.url}/{key}', timeout=self.timeout) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+
+    def put(self, key: str, data: bytes):
+        import urllib.request
+        request = urllib.request.Request(
+            f'{self.url}/{key}', data=data, method='PUT', headers={'Content-Type': 'application/octet-stream'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+def artifact_store(spec: str) -> ArtifactStore:
+    "The store at an http(s):// URL, or else in a local directory"
+    if spec.startswith(('http://', 'https://')):
+        return HttpStore(spec)
+    return LocalStore(spec)
+
+
+class Artifacts:
+    """Restores the outputs of targets from an `ArtifactStore` rather than remaking them, and stores them
+    once they're remade. Counts them in `hits`, `misses` and `stored`.
+
+    Targets are keyed by their output, the contents of their dependencies, the code of their make function
+    (but not the values it closes over) and those of their envvars in `env`. Only targets with an
+    output that depend on nothing but files and the outputs of other targets are cached. Failing to reach
+    the store is logged, and the target is remade as if it missed.
+    """
+
+    def __init__(self, store: ArtifactStore, env: AbstractSet[str] = KEYED_ENV):
+        self.backend = store
+        self.env = env
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+
+    @staticmethod
+    def cacheable(node: Node) -> bool:
+        return bool(node.target.target) and not node.target.has_wildcard() \
+            and all(dep.target.target for dep in node.deps)
+
+    def key(self, target: Target, deps_digest: str) -> str:
+        "What the target's output is stored under, given the digest of its dependencies' contents"
+        h = hashlib.blake2b(digest_size=20)
+        make: Callable[..., Any] = getattr(target, 'fn', None) or type(target).make
+        h.update(f"{target.target}\0{deps_digest}\0{_identity(make)}\0{sys.implementation.cache_tag}\n".encode())
+        for name in sorted(self.env):
+            if name in target.env:
+                h.update(f"{name}={target.env[name]}\0".encode())
+        return h.hexdigest()
+
+    async def fetch(self, target: Target, key: str) -> bool:
+        "Restore the target's output from the store, returning whether it was there"
+        loop = asyncio.get_event_loop()
+        try:
+            data = await loop.run_in_executor(None, self.backend.get, key)
+            if data is not None:
+                await loop.run_in_executor(None, _unpack, data, target.cwd / str(target.target))
+        except Exception as e:
+            logger.warning(f"Couldn't fetch {target.target} from the artifact cache: {e!r}")
+            data = None
+        if data is None:
+            self.misses += 1
+            return False
+        logger.debug(f"Restored {target.target} from the artifact cache")
+        self.hits += 1
+        return True
+
+    async def store(self, target: Target, key: str):
+        "Store the target's output, once it's been remade"
+        loop = asyncio.get_event_loop()
+        try:
+            data = await loop.run_in_executor(None, _pack, target.cwd / str(target.target))
+            await loop.run_in_executor(None, self.backend.put, key, data)
+        except Exception as e:
+            logger.warning(f"Couldn't store {target.target} in the artifact cache: {e!r}")
+            return
+        self.stored += 1
+
+
+def _identity(fn: Callable[..., Any]) -> str:
+    "A digest of the function's code, which changes when it's edited"
+    code = getattr(fn, '__code__', None)
+    if code is None:
+        return f"{getattr(fn, '__module__', '')}.{getattr(fn, '__qualname__', repr(fn))}"
+    h = hashlib.blake2b(digest_size=20)
+
+    def update(code: types.CodeType):
+        h.update(code.co_code)
+        h.update(repr(code.co_names).encode())
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                update(const)
+            else:
+                h.update(repr(const).encode())
+    update(code)
+    return h.hexdigest()
+
+
+def _pack(path: Path) -> bytes:
+    "An archive of the file or directory"
+    import tarfile
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        tar.add(path, arcname=path.name)
+    return buffer.getvalue()
+
+
+def _unpack(data: bytes, path: Path):
+    "Replace the file or directory with the one in the archive, as modified now"
+    import tarfile
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        members: List[tarfile.TarInfo] = tar.getmembers()
+        for member in members:
+            parts = Path(member.name).parts
+            if not parts or parts[0] != path.name or '..' in parts or not (member.isfile() or member.isdir()):
+                raise ValueError(f"unexpected member {member.name!r} in the archive of {path}")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=path.parent, prefix='.tmp-')
+        try:
+            # the data filter also refuses links and absolute paths, where it's available
+            options: Dict[str, Any] = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+            tar.extractall(tmp, members=members, **options)
+            if path.is_dir() and not path.is_symlink():
+                shutil.rmtree(path)
+            os.replace(os.path.join(tmp, path.name), path)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+    os.utime(path)
+
+
+def serve(directory: FilePath, port: int = 0, max_bytes: int = DEFAULT_MAX_BYTES, host: str = DEFAULT_HOST) -> Any:
+    "An HTTP server of a `LocalStore`, for `HttpStore`s, listening on the host. Call its `serve_forever()`"
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    store = LocalStore(directory, max_bytes)
+
+    class Handler(BaseHTTPRequestHandler):
+        def _key(self) -> Optional[str]:
+            key = self.path.rsplit('/', 1)[-1]
+            if _KEY.fullmatch(key):
+                return key
+            self.send_error(404)
+            return None
+
+        def do_GET(self):
+            key = self._key()
+            if key is None:
+                return
+            data = store.get(key)
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_PUT(self):
+            key = self._key()
+            if key is None:
+                return
+            length = self.headers['Content-Length']
+            if length is None or not length.isdigit():
+                self.send_error(411)
+                return
+            store.put(key, self.rfile.read(int(length)))
+            self.send_response(201)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format: str, *args: Any):
+            logger.debug(format % args)
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if not args:
+        sys.exit(__doc__)
+    directory, address, max_bytes = args + ['8000', str(DEFAULT_MAX_BYTES)][len(args) - 1:]
+    host, _, port = address.rpartition(':')
+    server = serve(directory, int(port), int(max_bytes), host or DEFAULT_HOST)
+    print(f"Serving {directory} on {server.server_address[0]}:{server.server_address[1]}")
+    server.serve_forever()
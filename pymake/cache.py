@@ -1,41 +1,209 @@
-from typing import Dict
+from typing import Any, Dict, IO, List, Optional, Union
 import json
+import os
 
-from .targets.wildcard import find_matching_target, NoTargetMatchError
+from .targets.wildcard import NoTargetMatchError, TargetIndex
 from .targets.target import Target, FilePath
 from .logger import logger
 
+_MISSING: Any = object()
+
 
 class TimestampCache(Dict[Target, float]):
+    """Mapping of targets to the time they were last made, persisted to an append-only journal.
+
+    Every assignment appends one JSON record (`[section, name, value]`) to the cache file rather than
+    rewriting it, so a build of N targets writes O(N) bytes. The journal is compacted back down to one
+    record per live entry by `save()`, or once it grows past `compact_bytes` and twice its compacted size.
+    A partially written last line (ie from a crash mid-append) is discarded when loading, and a corrupt record
+    before it is skipped.
+
+    Targets are recorded under their output, or else under their name in the PyMakefile.
+
+    Other build metadata (such as file digests) is kept alongside the timestamps in named `sections`,
+    and written with `record()`.
 
-    def __init__(self, path: FilePath, targets: Dict[str, Target]):
+    Timestamps looked up with `lookup()` are counted in `hits` and `misses`.
+    """
+
+    SECTION = 'timestamp'
+
+    def __init__(
+        self,
+        path: FilePath,
+        targets: Union[Dict[str, Target], TargetIndex],
+        compact_bytes: int = 1 << 20
+    ):
         self.path = path
-        try:
-            with open(path, 'r') as f:
-                json_cache: Dict[str, float] = json.load(f)
-                for name, data in json_cache.items():
-                    try:
-                        target = find_matching_target(name, targets)
-                        assert target
-                        self[target] = data
-                    except NoTargetMatchError:
-                        logger.debug(
-                            f"target {name} is no longer defined in the PyMakefile. Discarding cache info.")
+        self.compact_bytes = compact_bytes
+        self.bytes_written = 0
+        self.hits = 0
+        self.misses = 0
+        self._journal: Optional[IO[str]] = None
+        self._journal_size = 0
+        self._compacted_size = 0
+        self._needs_compaction = False
+
+        index = TargetIndex.of(targets)
+        self._names = {target: name for name, target in index.targets.items()}
+        records = self._load()
+        self.sections: Dict[str, Dict[str, Any]] = records
+        for name, data in records.pop(self.SECTION, {}).items():
+            try:
+                target = index.find(name)
+                assert target
+                super().__setitem__(target, data)
+            except NoTargetMatchError:
+                self._needs_compaction = True
                 logger.debug(
-                    f"Loaded {len(self)} timestamps from cache file \"{path}\"")
+                    f"target {name} is no longer defined in the PyMakefile. Discarding cache info.")
+        if os.path.exists(path):
+            logger.debug(
+                f"Loaded {len(self)} timestamps from cache file \"{path}\"")
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        "Replay the journal into {section: {name: value}}, truncating any torn record at the end"
+        records: Dict[str, Dict[str, Any]] = {}
+        try:
+            with open(self.path, 'rb') as f:
+                content = f.read()
         except FileNotFoundError:
-            logger.debug(f"Cache file not found: \"{path}\"")
+            logger.debug(f"Cache file not found: \"{self.path}\"")
+            return records
+
+        self._journal_size = self._compacted_size = len(content)
+        offset = 0
+        for line in content.splitlines(keepends=True):
+            try:
+                record = json.loads(line)
+                if not line.endswith(b'\n') and not isinstance(record, dict):
+                    raise ValueError("record was not terminated")
+            except ValueError:
+                if offset + len(line) == len(content):
+                    logger.warning(
+                        f"Discarding partially written record at the end of cache file \"{self.path}\"")
+                    with open(self.path, 'r+b') as f:
+                        f.truncate(offset)
+                    self._journal_size = offset
+                    break
+                logger.warning(
+                    f"Skipping corrupt record in cache file \"{self.path}\" at byte {offset}")
+                self._needs_compaction = True
+                offset += len(line)
+                continue
+
+            offset += len(line)
+            if isinstance(record, dict):
+                # legacy format: the whole cache as one json object
+                records.setdefault(self.SECTION, {}).update(record)
+                self._needs_compaction = True
+                continue
+
+            section, name, value = record
+            if value is None:
+                records.get(section, {}).pop(name, None)
+            else:
+                records.setdefault(section, {})[name] = value
+
+        return records
+
+    def _records(self) -> List[List[Any]]:
+        "All live records, as written by a compaction"
+        records = [[self.SECTION, self.key(target), data]
+                   for target, data in self.items() if self.key(target)]
+        for section, entries in self.sections.items():
+            records.extend([section, name, value]
+                           for name, value in entries.items())
+        return records
+
+    def key(self, target: Target) -> str:
+        "What the target's timestamp is recorded under: its output, or else its name in the PyMakefile"
+        return str(target.target or self._names.get(target, ''))
+
+    def lookup(self, k: Target) -> Optional[float]:
+        "The time the target was last made, or None if it isn't cached"
+        v = self.get(k)
+        if v is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return v
+
+    def section(self, section: str) -> Dict[str, Any]:
+        "The entries recorded in a section. Modify them through `record()` so that they are persisted"
+        return self.sections.setdefault(section, {})
+
+    def record(self, section: str, name: str, value: Any):
+        "Set an entry of the section, or remove it if value is None"
+        assert section != self.SECTION, "set timestamps through the cache mapping itself"
+        entries = self.section(section)
+        if value is None:
+            if entries.pop(name, None) is None:
+                return
+        elif entries.get(name) == value:
+            return
+        else:
+            entries[name] = value
+        self._append(section, name, value)
+
+    def _append(self, section: str, name: str, value: Any):
+        line = json.dumps([section, name, value]) + '\n'
+        if self._journal is None:
+            self._journal = open(self.path, 'a')
+        self._journal.write(line)
+        self._journal.flush()
+        self._journal_size += len(line)
+        self.bytes_written += len(line)
+
+        if self._journal_size > max(self.compact_bytes, 2 * self._compacted_size):
+            self.compact()
+
+    def compact(self):
+        "Rewrite the journal so that it only holds the latest record of every live entry"
+        self.close()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            for record in self._records():
+                f.write(json.dumps(record) + '\n')
+            size = f.tell()
+        os.replace(tmp_path, self.path)
+
+        logger.debug(
+            f"Compacted cache file \"{self.path}\" from {self._journal_size} to {size} bytes")
+        self.bytes_written += size
+        self._journal_size = self._compacted_size = size
+        self._needs_compaction = False
 
     def save(self):
-        with open(self.path, 'w') as f:
-            json.dump({
-                target.target: data
-                for target, data in self.items()
-            }, f)
+        "Flush the cache to disk, compacting the journal if it has accumulated any appended records"
+        if self._needs_compaction or self._journal_size != self._compacted_size:
+            self.compact()
+        else:
+            self.close()
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
 
     def __setitem__(self, k: Target, v: float):
         assert not k.has_wildcard(
         ), "Something went wrong with pymake. Wildcard targets should never be cached"
         assert k.do_cache, f"target {k} requested not to be cached."
         super().__setitem__(k, v)
-        self.save()
+        if self.key(k):
+            self._append(self.SECTION, self.key(k), v)
+
+    def __delitem__(self, k: Target):
+        super().__delitem__(k)
+        if self.key(k):
+            self._append(self.SECTION, self.key(k), None)
+
+    def pop(self, k: Target, default: Any = _MISSING) -> Any:  # type: ignore
+        if k in self:
+            v = self[k]
+            del self[k]
+            return v
+        if default is _MISSING:
+            raise KeyError(k)
+        return default
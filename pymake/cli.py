@@ -1,12 +1,16 @@
-import click
-from runpy import run_path
-from typing import Any, Dict, List
+import time
+import sys
+import os
+from typing import Any, Dict, List, Optional, Tuple
 from pathlib import Path
 
 from .targets.target import FilePath, Target, Union
-from .targets.wildcard import NoTargetMatchError, find_matching_target
+from .targets.wildcard import NoTargetMatchError, TargetIndex
 from .targets.clean import Clean
-from .make import make_sync
+from .compiled import load_targets
+from .make import make_sync, out_of_date_sync
+from .watch import POLL_INTERVAL, watch_sync
+from .executors import AGENTS_ENV, EXECUTORS
 from .logger import RED, logger, YELLOW, RESET, GREY
 from .utils import unindent
 
@@ -24,51 +28,115 @@ def run(
     request: str,
     cache: str = '.pymake-cache',
     no_cache: bool = False,
-    loglevel: Union[int, str] = "WARNING"
+    loglevel: Union[int, str] = "WARNING",
+    digest: bool = False,
+    restat: bool = False,
+    executor: str = 'process',
+    jobs: Optional[int] = None,
+    load_average: Optional[float] = None,
+    explain_schedule: bool = False,
+    stream: bool = False,
+    log_dir: Optional[str] = None,
+    trace: Optional[str] = None,
+    stats: bool = False,
+    stats_file: Optional[str] = None,
+    question: bool = False,
+    dry_run: bool = False,
+    graph_cache: Optional[str] = None,
+    watch: bool = False,
+    poll: bool = False,
+    artifacts: Optional[str] = None,
+    agents: Optional[str] = None
 ):
     try:
         logger.setLevel(loglevel)
-        try:
-            exports = run_path(makefile)
-        except FileNotFoundError as e:
-            raise UserError(
-                f"Could not find makefile: \"{makefile}\".",
-                "Please run from the correct directory or specify the path to the makefile with \"-m\".\n"
-                "See help with \"pymake --help\" for more info.",
-                e)
-
-        # collect all targets
-        targets = {
-            name: val for name, val
-            in exports.items()
-            if isinstance(val, Target)
-        }
-
-        try:
-            target = getattr(exports, request)
-            assert isinstance(target, Target), \
-                f"Expected requested target to be of class Target, but instead found {target.__class__}"
-
-        except AttributeError:
-            # no target was matched directly.
-            # Perhaps this will match the output of a FileTarget?
-            try:
-                target = find_matching_target(request, targets)
-            except NoTargetMatchError as e:
-                if request == 'show':
-                    target = ShowTargets(targets)
-                elif request == 'clean':
-                    target = Clean(targets.values())
-                else:
-                    raise e
-
-        make_sync(target, cache=None if no_cache else cache,
-                  targets=targets, prefix_dir=Path(makefile).parent)
+        targets, index, target = _load(makefile, request, graph_cache)
+
+        if question or dry_run:
+            stale = out_of_date_sync(target, cache=None if no_cache else cache, targets=index,
+                                     prefix_dir=Path(makefile).parent, digest=digest, restat=restat)
+            if dry_run:
+                names = {t: name for name, t in targets.items()}
+                for t, reason in stale:
+                    print(f"{t.target or names.get(t, repr(t))}: {reason}")
+            if question:
+                sys.exit(1 if stale else 0)
+            return
+
+        options: Dict[str, Any] = dict(
+            digest=digest, restat=restat, executor=executor, jobs=jobs, load_average=load_average,
+            explain_schedule=explain_schedule, stream=stream, log_dir=log_dir, trace=trace,
+            stats=stats, stats_file=stats_file, artifacts=artifacts, agents=agents.split(',') if agents else None)
+        if not watch:
+            make_sync(target, cache=None if no_cache else cache,
+                      targets=index, prefix_dir=Path(makefile).parent, **options)
+            return
+
+        while True:
+            # returns when the makefile changes, to be reloaded
+            watch_sync(target, cache=None if no_cache else cache, targets=index,
+                       prefix_dir=Path(makefile).parent, makefile=makefile, poll=poll, **options)
+            while True:
+                try:
+                    targets, index, target = _load(makefile, request, graph_cache)
+                    break
+                except UserError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Couldn't reload {makefile}: {e!r}")
+                    _wait_for_change(makefile)
 
     except UserError as e:
         print(f"{RED}{e.msg}{RESET}\n{e.help}")
 
 
+def _load(makefile: str, request: str, graph_cache: Optional[str]) -> Tuple[Dict[str, Target], TargetIndex, Target]:
+    "Load the makefile's targets, and find the one requested"
+    try:
+        targets = load_targets(makefile, None if graph_cache is None else Path(makefile).parent / graph_cache)
+    except FileNotFoundError as e:
+        raise UserError(
+            f"Could not find makefile: \"{makefile}\".",
+            "Please run from the correct directory or specify the path to the makefile with \"-m\".\n"
+            "See help with \"pymake --help\" for more info.",
+            e)
+
+    index = TargetIndex(targets)
+    return targets, index, find_target(targets, index, request)
+
+
+def find_target(targets: Dict[str, Target], index: TargetIndex, request: str) -> Target:
+    "The target requested: by name, by the file it makes, or else `show` or `clean`"
+    try:
+        target = targets[request]
+
+    except KeyError:
+        # no target was matched directly.
+        # Perhaps this will match the output of a FileTarget?
+        try:
+            target = index.find(request)
+        except NoTargetMatchError as e:
+            if request == 'show':
+                target = ShowTargets(targets)
+            elif request == 'clean':
+                target = Clean(targets.values())
+            else:
+                raise e
+    return target
+
+
+def _wait_for_change(path: str):
+    "Block until the file is modified"
+    def mtime() -> Optional[int]:
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+    before = mtime()
+    while mtime() == before:
+        time.sleep(POLL_INTERVAL)
+
+
 def cli(makefile: FilePath, loglevel: Union[int, str] = "WARNING"):
     """Run the makefile as a command-line app, handling arguments correctly
     Requires the makefile to be passed in. Intended to be run as such in a PyMakefile.py:
@@ -77,34 +145,81 @@ def cli(makefile: FilePath, loglevel: Union[int, str] = "WARNING"):
         cli(__file__)
     ```
     """
-    # not DRY enough... but whatever
-    @click.command()
-    @click.argument("request", default="show")
-    @click.option("--cache", default='.pymake-cache', help="Path to cache file")
-    @click.option("--no-cache", default=False, help="Set to disable caching")
-    def cmd(*args: Any, **kwargs: Any):
-        run(*args, makefile=str(makefile),  # type: ignore
-            loglevel=loglevel, **kwargs)  # type: ignore
-    return cmd()
-
-
-@click.command()
-@click.argument("request", default="show")
-@click.option("--makefile", "-m", default='PyMakefile.py',
-              help="Path to the makefile. Defaults to 'PyMakefile.py' in current directory.")
-@click.option("--cache", default='.pymake-cache', help="Path to cache file")
-@click.option("--no-cache", default=False, help="Set to disable caching")
-@click.option("--loglevel", "-l", default='WARNING', help="loglevel for internal logs. Setting to 'DEBUG' may aid with debugging")
-def cli_shell(*args: Any, **kwargs: Any):
+    return command(makefile, loglevel)()
+
+
+def cli_shell(args: Optional[List[str]] = None):
     "Run the makefile as a command-line app, handling arguments correctly"
-    run(*args, **kwargs)
+    command()(args)
+
+
+def command(makefile: Optional[FilePath] = None, loglevel: Union[int, str] = "WARNING") -> Any:
+    """The click command of pymake: of the makefile at that loglevel if given, or else with options for them.
+    Click is imported here rather than up-front, as every PyMakefile imports this module, but few run it"""
+    import click
+
+    def cmd(*args: Any, **kwargs: Any):
+        if makefile is None:
+            run(*args, **kwargs)
+        else:
+            run(*args, makefile=str(makefile), loglevel=loglevel, **kwargs)  # type: ignore
+
+    options = [
+        click.argument("request", default="show"),
+        click.option("--makefile", "-m", default='PyMakefile.py',
+                     help="Path to the makefile. Defaults to 'PyMakefile.py' in current directory."),
+        click.option("--cache", default='.pymake-cache', help="Path to cache file"),
+        click.option("--no-cache", default=False, help="Set to disable caching"),
+        click.option("--digest", is_flag=True, default=False,
+                     help="Decide whether targets are up-to-date by the contents of their dependencies, rather than their timestamps"),
+        click.option("--restat", is_flag=True, default=False,
+                     help="Don't remake the dependents of targets whose output is unchanged after being remade"),
+        click.option("--executor", type=click.Choice(list(EXECUTORS)), default='process',
+                     help="Where to remake targets: in worker processes, a thread pool, or inline on the main event loop"),
+        click.option("--agents", envvar=AGENTS_ENV, default=None,
+                     help="Comma-separated HOST:PORTs of the pymake-worker agents to remake targets on with '--executor remote'"),
+        click.option("--jobs", "-j", type=int, default=None,
+                     help="Maximum number of targets and shell commands to run at once. Unlimited by default"),
+        click.option("--load-average", type=float, default=None,
+                     help="Don't start new targets while the load average is at least this"),
+        click.option("--explain-schedule", is_flag=True, default=False,
+                     help="Compare the build's makespan to the one predicted from the durations of previous builds"),
+        click.option("--stream", is_flag=True, default=False,
+                     help="Log the output of shell commands line by line as it arrives, prefixed by the target"),
+        click.option("--log-dir", default=None, help="Directory to write the full output of each target's shell commands to"),
+        click.option("--trace", default=None,
+                     help="Write a timeline of the build to this path, in Chrome Trace Event format (for Perfetto)"),
+        click.option("--stats", is_flag=True, default=False,
+                     help="Print totals of the build once it finishes: targets remade, cache hits, time spent, etc"),
+        click.option("--stats-file", default=None,
+                     help="Write the build's totals to this path, as a Prometheus textfile if it ends in '.prom' or else as JSON"),
+        click.option("--artifacts", default=None,
+                     help="Directory or http(s):// URL of a cache of targets' outputs shared between builds, to restore them from rather than remaking them"),
+        click.option("--question", "-q", is_flag=True, default=False,
+                     help="Don't make anything. Exit with status 1 if the target is out-of-date, or 0 if not"),
+        click.option("--dry-run", "-n", is_flag=True, default=False,
+                     help="Don't make anything. List the targets that would be remade, in order, and why"),
+        click.option("--graph-cache", default=None,
+                     help="Path to compile the makefile's targets to, and load them from rather than running it while the files "
+                          "it read are unchanged. Only for makefiles that don't check whether files exist"),
+        click.option("--watch", "-w", is_flag=True, default=False,
+                     help="Keep running, and remake the target whenever the files it depends upon change"),
+        click.option("--poll", is_flag=True, default=False, help="With --watch, poll for changes rather than use inotify"),
+        click.option("--loglevel", "-l", default='WARNING', help="loglevel for internal logs. Setting to 'DEBUG' may aid with debugging"),
+    ]
+    if makefile is not None:
+        options = options[:1] + options[2:-1]
+    # applied as decorators would be, from the bottom up
+    for option in reversed(options):
+        cmd = option(cmd)
+    return click.command(help=None if makefile is not None else cli_shell.__doc__)(cmd)
 
 
 class ShowTargets(Target):
     "Display this target help information"
 
     def __init__(self, targets: Dict[str, Target]):
-        super().__init__(None, [])
+        super().__init__(None, [], cwd='.', executor='inline')
         self.targets = targets
 
     async def make(self):
@@ -116,7 +231,7 @@ class ShowTargets(Target):
             spec_str = f"    - {'/'.join(f'{YELLOW}{name}{RESET}' for name in names)} {repr(target)}"
             spec_str += ':'
             for dep in target.deps:
-                spec_str += f" {'/'.join(YELLOW + name + RESET for name in target2names[dep])}" if isinstance(dep, Target) \
+                spec_str += f" {'/'.join(YELLOW + name + RESET for name in target2names.get(dep, [repr(dep)]))}" if isinstance(dep, Target) \
                     else f" {str(dep)}"
             print(spec_str)
 
@@ -0,0 +1,138 @@
+"""A thin client of the pymake daemon (see `pymake.daemon`), which keeps a project's targets, cache,
+filesystem snapshot and worker processes resident between builds. Takes the same arguments as `pymake`:
+
+    python -m pymake.client [--stop] [PYMAKE ARGS...]
+
+The daemon of the makefile and the current directory is started if it isn't running. `--stop` stops it.
+This module only imports the standard library, so that starting the client is quick.
+"""
+from typing import List, Optional, Sequence, Tuple
+import subprocess
+import tempfile
+import hashlib
+import socket
+import struct
+import json
+import time
+import sys
+import os
+
+STARTUP_TIMEOUT = 10.0  # seconds to wait for a daemon that was just started to listen
+
+# the frames of the protocol: a channel and the length of the data that follows
+_FRAME = struct.Struct('!cI')
+REQUEST = b'r'  # JSON of the arguments and environment of a build
+STOP = b's'
+STDOUT = b'1'
+STDERR = b'2'
+EXIT = b'x'  # the exit status of the request, in ascii
+
+
+def socket_path(makefile: str, cwd: str) -> str:
+    "The socket of the daemon of the makefile, when run from the directory"
+    key = hashlib.blake2b(f'{os.path.abspath(makefile)}\0{cwd}'.encode(), digest_size=8).hexdigest()
+    return os.path.join(tempfile.gettempdir(), f'pymake-{os.getuid()}-{key}.sock')
+
+
+def send_frame(sock: socket.socket, channel: bytes, data: bytes = b''):
+    sock.sendall(_FRAME.pack(channel, len(data)) + data)
+
+
+def recv_frame(sock: socket.socket) -> Tuple[bytes, bytes]:
+    channel, length = _FRAME.unpack(_recv_exactly(sock, _FRAME.size))
+    return channel, _recv_exactly(sock, length)
+
+
+def _recv_exactly(sock: socket.socket, n: int) -> bytes:
+    chunks: List[bytes] = []
+    while n:
+        chunk = sock.recv(min(n, 1 << 16))
+        if not chunk:
+            raise ConnectionError("the pymake daemon closed the connection")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+def main(args: Optional[Sequence[str]] = None) -> int:
+    args = list(sys.argv[1:] if args is None else args)
+    stop = args[:1] == ['--stop']
+    if stop:
+        args = args[1:]
+    if not stop and _in_process(args):
+        from .cli import cli_shell
+        cli_shell(args)
+        return 0
+
+    makefile = _option(args, ('-m', '--makefile'), 'PyMakefile.py')
+    path = socket_path(makefile, os.getcwd())
+    sock = _connect(path)
+    if sock is None:
+        if stop:
+            return 0
+        sock = _start(makefile, path)
+
+    with sock:
+        if stop:
+            send_frame(sock, STOP)
+        else:
+            send_frame(sock, REQUEST, json.dumps({'args': args, 'env': dict(os.environ)}).encode())
+        try:
+            while True:
+                channel, data = recv_frame(sock)
+                if channel == EXIT:
+                    return int(data)
+                stream = sys.stdout if channel == STDOUT else sys.stderr
+                stream.buffer.write(data)
+                stream.flush()
+        except KeyboardInterrupt:
+            # closing the connection cancels the build
+            return 130
+        except BrokenPipeError:
+            # ie piped into `head`
+            return 141
+
+
+def _in_process(args: List[str]) -> bool:
+    "Whether to run pymake in this process, as the daemon can't"
+    # the daemon can't share the jobserver of a make that the client was run from, nor watch
+    return 'jobserver' in os.environ.get('MAKEFLAGS', '') or bool({'-w', '--watch'} & set(args))
+
+
+def _option(args: List[str], names: Tuple[str, ...], default: str) -> str:
+    for i, arg in enumerate(args):
+        if arg in names and i + 1 < len(args):
+            return args[i + 1]
+        for name in names:
+            if arg.startswith(name + '='):
+                return arg[len(name) + 1:]
+    return default
+
+
+def _connect(path: str) -> Optional[socket.socket]:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    return sock
+
+
+def _start(makefile: str, path: str) -> socket.socket:
+    "Start the daemon in the background, and connect to it"
+    with open(path + '.log', 'ab') as log:
+        subprocess.Popen(
+            [sys.executable, '-m', 'pymake.daemon', makefile],
+            stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        sock = _connect(path)
+        if sock is not None:
+            return sock
+        time.sleep(0.02)
+    sys.exit(f"The pymake daemon didn't start. See its log in {path}.log")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+from typing import Any, Dict, List, Optional, Set, Tuple
+from runpy import run_path
+from pathlib import Path
+import hashlib
+import pickle
+import sys
+import os
+
+from .targets.target import FilePath, Target
+from .logger import logger
+
+VERSION = 1  # of the format of the compiled makefile
+
+# audit events of running a command, whose output the makefile may depend upon but can't be tracked
+COMMAND_EVENTS = frozenset({'subprocess.Popen', 'os.system', 'os.posix_spawn', 'os.exec', 'os.spawn', 'os.startfile'})
+
+# inputs read by the makefile being run: files opened, directories listed and commands run, or None when not recording
+_reads: Optional[Set[Tuple[str, str]]] = None
+_hooked = False
+
+Input = Tuple[str, str, Any]  # (kind, path, what it was when read)
+
+
+def load_targets(makefile: FilePath, compiled: Optional[FilePath] = None) -> Dict[str, Target]:
+    """The targets defined by the makefile, by name.
+
+    With `compiled`, the targets are loaded from that file instead of running the makefile, if it was compiled
+    from the same makefile, environment and pymake, and nothing that the makefile read has changed since:
+    the files it opened (by size and mtime) and the directories it listed (by their entries). Otherwise the
+    makefile is run, and its targets compiled to the file. They aren't compiled if the makefile ran a command,
+    as what it read can't be seen, nor if they can't be serialised, so such makefiles are run every time.
+    Checks for whether a file exists (or of its stat) can't be seen either, so makefiles that rely on them
+    shouldn't be compiled. Recording what the makefile reads needs audit hooks, so before Python 3.8 it's run every time.
+    """
+    if compiled is not None and not hasattr(sys, 'addaudithook'):
+        logger.debug("Not compiling the makefile's targets, as recording what it reads needs Python 3.8")
+        compiled = None
+    if compiled is None:
+        return _targets(run_path(str(makefile)))
+
+    key = _key(makefile)
+    targets = _load(compiled, key)
+    if targets is not None:
+        return targets
+
+    global _reads
+    _record()
+    reads: Set[Tuple[str, str]] = set()
+    _reads = reads
+    try:
+        targets = _targets(run_path(str(makefile)))
+    finally:
+        _reads = None
+
+    commands = sorted(path for kind, path in reads if kind == 'command')
+    if commands:
+        logger.debug(f"Not compiling the makefile's targets, as it ran a command ({commands[0]}) whose inputs can't be tracked")
+        return targets
+    inputs = [_input(kind, path) for kind, path in sorted(reads)]
+    _save(compiled, key, inputs, targets)
+    return targets
+
+
+def _targets(exports: Dict[str, Any]) -> Dict[str, Target]:
+    return {name: val for name, val in exports.items() if isinstance(val, Target)}
+
+
+def _key(makefile: FilePath) -> str:
+    "Digest of what the targets depend upon besides what the makefile reads"
+    h = hashlib.blake2b(digest_size=20)
+    with open(makefile, 'rb') as f:
+        h.update(f.read())
+    h.update(repr((VERSION, os.path.abspath(makefile), os.getcwd(), sys.version, sorted(os.environ.items()))).encode())
+    # pymake itself, as the targets are pickled by its classes
+    package = Path(__file__).parent
+    for source in sorted(package.glob('**/*.py')):
+        stat = source.stat()
+        h.update(f'{source}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return h.hexdigest()
+
+
+def _record():
+    "Install the audit hook that records the inputs of a makefile. Audit hooks can't be removed, so only once"
+    global _hooked
+    if not _hooked:
+        sys.addaudithook(_audit)
+        _hooked = True
+
+
+def _audit(event: str, args: Tuple[Any, ...]):
+    if _reads is None:
+        return
+    if event == 'open':
+        path, mode = args[0], args[1]
+        if isinstance(path, (str, bytes, os.PathLike)) and (mode is None or not set('wax+') & set(str(mode))):
+            _reads.add(('file', os.path.abspath(os.fsdecode(path))))
+    elif event in ('os.listdir', 'os.scandir'):
+        path = args[0]
+        if isinstance(path, (str, bytes, os.PathLike)) or path is None:
+            _reads.add(('dir', os.path.abspath(os.fsdecode(path if path is not None else '.'))))
+    elif event in COMMAND_EVENTS:
+        _reads.add(('command', event))
+
+
+def _input(kind: str, path: str) -> Input:
+    "The input as it is now"
+    try:
+        if kind == 'file':
+            stat = os.stat(path)
+            return kind, path, (stat.st_size, stat.st_mtime_ns)
+        return kind, path, sorted(os.listdir(path))
+    except OSError:
+        return kind, path, None
+
+
+def _load(compiled: FilePath, key: str) -> Optional[Dict[str, Target]]:
+    try:
+        with open(compiled, 'rb') as f:
+            version, compiled_key, inputs, payload = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.debug(f"Couldn't read compiled makefile \"{compiled}\": {e!r}")
+        return None
+
+    if version != VERSION or compiled_key != key:
+        logger.debug(f"Compiled makefile \"{compiled}\" is of a different makefile or environment")
+        return None
+    for kind, path, was in inputs:
+        if _input(kind, path)[2] != was:
+            logger.debug(f"Compiled makefile \"{compiled}\" is out-of-date, as {path} changed")
+            return None
+
+    import dill  # type: ignore
+    try:
+        targets: Dict[str, Target] = dill.loads(payload)
+    except Exception as e:
+        logger.debug(f"Couldn't load compiled makefile \"{compiled}\": {e!r}")
+        return None
+    logger.debug(f"Loaded {len(targets)} targets from compiled makefile \"{compiled}\"")
+    return targets
+
+
+def _save(compiled: FilePath, key: str, inputs: List[Input], targets: Dict[str, Target]):
+    import dill  # type: ignore
+    try:
+        payload = dill.dumps(targets, recurse=True)
+        # check that they can be loaded before relying on it
+        dill.loads(payload)
+    except Exception as e:
+        logger.debug(f"Couldn't compile the makefile's targets, so it will be run every time: {e!r}")
+        return
+
+    tmp_path = f"{compiled}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump((VERSION, key, inputs, payload), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, compiled)
+    logger.debug(f"Compiled {len(targets)} targets to \"{compiled}\", depending on {len(inputs)} inputs")
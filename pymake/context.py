@@ -26,11 +26,16 @@ class Context:
 
 
     async def inject_and_run(self, fn: Callable[..., Awaitable[Any]]):
+        from .targets.target import Target
         kwargs = {}
-        for arg, type in get_type_hints(fn).items():
-            if arg is 'ctx':
+        # `Dependencies` refers to Target by name, which isn't among the globals of a function loaded by dill
+        for arg, type in get_type_hints(fn, localns={'Target': Target}).items():
+            if arg == 'return':
+                continue
+            if arg == 'ctx':
                 assert type is Context
                 kwargs['ctx'] = self
+                continue
             try:
                 kwargs[arg] = getattr(self, arg)
                 if isclass(type):
@@ -43,4 +48,4 @@ class Context:
                     Available properties are: {[attr for attr in dir(self) if not attr.startswith('_')]}. Please see documentation for more info.
                 """))
 
-        await fn(**kwargs)
+        return await fn(**kwargs)
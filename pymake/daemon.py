@@ -0,0 +1,357 @@
+"""The pymake daemon, which serves the builds of one makefile run from one directory to `pymake.client`s
+over a Unix socket, keeping what it can between them. Started by the client when it isn't running:
+
+    python -m pymake.daemon MAKEFILE [IDLE_TIMEOUT]
+"""
+from typing import Any, Dict, List, Optional, Tuple
+from pathlib import Path
+import threading
+import traceback
+import asyncio
+import termios
+import select
+import socket
+import fcntl
+import array
+import json
+import time
+import sys
+import os
+
+from click import ClickException
+from click.exceptions import Exit
+
+from .cache import TimestampCache
+from .cli import UserError, command, find_target
+from .client import EXIT, REQUEST, STDERR, STDOUT, STOP, recv_frame, send_frame, socket_path
+from .compiled import load_targets
+from .executors import Executor
+from .graph import BuildGraph
+from .jobs import JobLimiter, job_limiter
+from .logger import logger, RED, RESET
+from .make import make, out_of_date
+from .snapshot import FileSnapshot
+from .targets.makefile import Makefile, SubMakes
+from .targets.target import Target
+from .targets.wildcard import TargetIndex
+from .watch import InotifyWatcher, Watched
+
+IDLE_TIMEOUT = 15 * 60  # seconds without a request before the daemon exits
+
+
+class Daemon:
+    """Serves builds to clients one at a time, streaming back everything written to stdout and stderr,
+    including by `sh()`s and worker processes. Exits after `idle_timeout` seconds without a request.
+
+    Between builds it keeps the makefile's targets, the cache, the filesystem snapshot (invalidated by
+    what inotify says changed, or else dropped before each build), the graph of each target built, and
+    the executors and job limiter of the last one, so that its worker processes stay warm. Everything is
+    dropped when the makefile or the environment of the client changes, and the cache is reloaded when
+    it's written by something else.
+    """
+
+    def __init__(self, makefile: str, idle_timeout: float = IDLE_TIMEOUT):
+        self.makefile = makefile
+        self.path = socket_path(makefile, os.getcwd())
+        self.idle_timeout = idle_timeout
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.watcher: Optional[InotifyWatcher] = InotifyWatcher()
+        except OSError as e:
+            logger.info(f"Can't watch for changes with inotify, so the snapshot is dropped before each build: {e}")
+            self.watcher = None
+
+        self.conn: Optional[socket.socket] = None  # the client being served
+        self._relays: List[_Relay] = []
+        self._loaded: Optional[Tuple[Any, ...]] = None  # what the targets were loaded with
+        self._cache_stat: Optional[Tuple[int, int]] = None
+        self.targets: Dict[str, Target] = {}
+        self.index = TargetIndex({})
+        self.cache: Optional[TimestampCache] = None
+        self.snapshot = FileSnapshot()
+        self.graphs: Dict[Target, BuildGraph] = {}
+        # the executors and job limiter of the last build, by its graph, jobs, load average and agents
+        self._resident: Optional[Tuple[Tuple[Any, ...], Dict[str, Executor], JobLimiter]] = None
+
+    def serve(self):
+        lock = open(self.path + '.lock', 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info(f"Another daemon is serving {self.path}")
+            return
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen()
+        server.settimeout(self.idle_timeout)
+        # line buffered, which the worker processes forked later inherit
+        sys.stdout.reconfigure(line_buffering=True)  # type: ignore
+        self._relays = [_Relay(self, 1, STDOUT), _Relay(self, 2, STDERR)]
+        try:
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    break
+                with conn:
+                    conn.settimeout(None)
+                    if not self._handle(conn):
+                        break
+        finally:
+            os.unlink(self.path)
+            server.close()
+            self._drop()
+            if self.cache is not None:
+                self.cache.save()
+            lock.close()
+
+    def _handle(self, conn: socket.socket) -> bool:
+        "Serve a request, returning whether to keep serving"
+        try:
+            channel, data = recv_frame(conn)
+        except ConnectionError:
+            return True
+        if channel == STOP:
+            send_frame(conn, EXIT, b'0')
+            return False
+        assert channel == REQUEST
+        request = json.loads(data)
+
+        self.conn = conn
+        try:
+            status = self._request(request['args'], request['env'])
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for relay in self._relays:
+                relay.drain()
+            self.conn = None
+        try:
+            send_frame(conn, EXIT, str(status).encode())
+        except OSError:
+            pass
+        return True
+
+    def _request(self, args: List[str], env: Dict[str, str]) -> int:
+        "Build as `pymake` would with the arguments, returning its exit status"
+        try:
+            with command().make_context('pymake', list(args)) as ctx:
+                params = ctx.params
+        except Exit as e:
+            return e.exit_code
+        except ClickException as e:
+            e.show()
+            return e.exit_code
+
+        try:
+            return self._build(params, env)
+        except UserError as e:
+            print(f"{RED}{e.msg}{RESET}\n{e.help}")
+            return 1
+        except Exception:
+            traceback.print_exc()
+            return 1
+
+    def _build(self, params: Dict[str, Any], env: Dict[str, str]) -> int:
+        logger.setLevel(params['loglevel'])
+        if params['watch']:
+            print(f"{RED}The daemon can't --watch, run pymake without it{RESET}", file=sys.stderr)
+            return 2
+
+        self._load(params, env)
+        target = find_target(self.targets, self.index, params['request'])
+        cache = None if params['no_cache'] else self.cache
+        prefix_dir = Path(params['makefile']).parent
+        graph = self.graphs.get(target)
+        if graph is None:
+            graph = self.graphs[target] = BuildGraph(target, self.index, prefix_dir, self.snapshot)
+        # whether make -q says a Makefile is up-to-date can change without any file we watch changing
+        sub_makes = SubMakes.of(self.snapshot, self.cache)
+        for node in graph.order:
+            if isinstance(node.target, Makefile):
+                sub_makes.forget(node.target)
+
+        try:
+            if params['question'] or params['dry_run']:
+                stale = self._run(out_of_date(
+                    target, cache=cache, targets=self.index, prefix_dir=prefix_dir, snapshot=self.snapshot,
+                    digest=params['digest'], restat=params['restat']))
+                if stale is None:
+                    return 130
+                if params['dry_run']:
+                    names = {t: name for name, t in self.targets.items()}
+                    for t, reason in stale:
+                        print(f"{t.target or names.get(t, repr(t))}: {reason}")
+                return 1 if params['question'] and stale else 0
+
+            executors, limiter = self._executors(graph, params['jobs'], params['load_average'], params['agents'])
+            options = {name: params[name] for name in (
+                'digest', 'restat', 'executor', 'jobs', 'load_average', 'explain_schedule', 'stream', 'log_dir',
+                'trace', 'stats', 'stats_file', 'artifacts')}
+            self._run(make(
+                target, cache=cache, targets=self.index, prefix_dir=prefix_dir, snapshot=self.snapshot,
+                graph=graph, executors=executors, limiter=limiter,
+                agents=params['agents'].split(',') if params['agents'] else None, **options))
+            return 0
+        finally:
+            self._watch()
+            if self.cache is not None and os.path.exists(self.cache.path):
+                self._cache_stat = _stat(self.cache.path)
+
+    def _run(self, coro: Any) -> Any:
+        "Run the coroutine on the loop, cancelling it if the client disconnects"
+        task = asyncio.ensure_future(coro)
+        conn = self.conn
+        if conn is not None:
+            def disconnected():
+                try:
+                    if not conn.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT):
+                        task.cancel()
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    task.cancel()
+            self.loop.add_reader(conn.fileno(), disconnected)
+        try:
+            return self.loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            logger.info("The client disconnected, so its build was cancelled")
+            return None
+        finally:
+            if conn is not None:
+                self.loop.remove_reader(conn.fileno())
+
+    def _load(self, params: Dict[str, Any], env: Dict[str, str]):
+        "Load the targets unless they're loaded already, and forget what's changed since the last build"
+        cache_path = str(Path(params['makefile']).parent / params['cache'])
+        graph_cache = Path(params['makefile']).parent / params['graph_cache'] if params['graph_cache'] else None
+        try:
+            loaded = (_stat(self.makefile), env, cache_path, graph_cache)
+        except FileNotFoundError as e:
+            raise UserError(f"Could not find makefile: \"{self.makefile}\".",
+                            "Please run from the correct directory or specify it with \"-m\".", e)
+
+        if loaded != self._loaded:
+            logger.info(f"Loading {self.makefile}")
+            self._drop()
+            if self.cache is not None:
+                self.cache.save()
+            self._loaded = None
+            if env != dict(os.environ):
+                os.environ.clear()
+                os.environ.update(env)
+            self.targets = load_targets(self.makefile, graph_cache)
+            self.index = TargetIndex(self.targets)
+            self.cache = TimestampCache(cache_path, self.index)
+            self._loaded = loaded
+        elif self.cache is not None and os.path.exists(self.cache.path) and _stat(self.cache.path) != self._cache_stat:
+            logger.info("The cache was written by something else, so reloading it")
+            self._drop()
+            self.cache = TimestampCache(cache_path, self.index)
+        else:
+            self._refresh()
+
+    def _refresh(self):
+        "Forget what's changed on the filesystem since the last build"
+        changes = self.watcher.pending() if self.watcher is not None else None
+        if changes is None or changes.overflowed:
+            self._drop()
+            return
+        for path in changes.paths | changes.directories:
+            self.snapshot.invalidate(path)
+        if changes.directories:
+            # globs may match something else
+            self.graphs.clear()
+            self._stop_executors()
+
+    def _watch(self):
+        "Watch the paths of every graph for changes"
+        if self.watcher is None:
+            return
+        files: List[str] = []
+        directories = set(self.snapshot.listed())
+        for graph in self.graphs.values():
+            watched = Watched(graph, self.snapshot, None)
+            files += watched.files
+            files += watched.outputs
+        self.watcher.watch(files, directories)
+
+    def _executors(self, graph: BuildGraph, jobs: Optional[int], load_average: Optional[float],
+                   agents: Optional[str]) -> Tuple[Dict[str, Executor], JobLimiter]:
+        "The executors and job limiter to reuse for the build"
+        key = (id(graph), jobs, load_average, agents)
+        if self._resident is None or self._resident[0] != key:
+            self._stop_executors()
+            self._resident = (key, {}, job_limiter(jobs, load_average))
+        return self._resident[1], self._resident[2]
+
+    def _stop_executors(self):
+        if self._resident is not None:
+            _, executors, limiter = self._resident
+            for executor in executors.values():
+                executor.shutdown()
+            limiter.close()
+            self._resident = None
+
+    def _drop(self):
+        "Forget everything known about the filesystem"
+        self._stop_executors()
+        self.graphs.clear()
+        self.snapshot = FileSnapshot()
+        if self.watcher is not None:
+            self.watcher.pending()
+
+
+class _Relay(threading.Thread):
+    """Replaces a standard stream (fd 1 or 2) with a pipe, and forwards what's written to it to the client
+    being served, if any, on its channel. Subprocesses and worker processes inherit the pipe"""
+
+    def __init__(self, server: Daemon, fd: int, channel: bytes):
+        super().__init__(daemon=True)
+        self.server = server
+        self.channel = channel
+        self.fd, write = os.pipe()
+        os.dup2(write, fd)
+        os.close(write)
+        self.busy = False
+        self.start()
+
+    def run(self):
+        while True:
+            select.select([self.fd], [], [])
+            # busy before reading, so that `drain()` can't miss what's been read but not yet sent
+            self.busy = True
+            data = os.read(self.fd, 1 << 16)
+            conn = self.server.conn
+            if conn is not None:
+                try:
+                    send_frame(conn, self.channel, data)
+                except OSError:
+                    pass
+            self.busy = False
+
+    def drain(self):
+        "Wait for what has been written so far to be forwarded"
+        while True:
+            unread = array.array('i', [0])
+            fcntl.ioctl(self.fd, termios.FIONREAD, unread)
+            if not unread[0] and not self.busy:
+                return
+            time.sleep(0.001)
+
+
+def _stat(path: Any) -> Tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if not args:
+        sys.exit(__doc__)
+    makefile, idle_timeout = args + [str(IDLE_TIMEOUT)][len(args) - 1:]
+    Daemon(makefile, float(idle_timeout)).serve()
@@ -6,10 +6,11 @@ from .targets.function import Fn
 def makes(
     target: Optional[FilePath],
     deps: Depends = [],
-    do_cache: bool = True
+    do_cache: bool = True,
+    executor: Optional[str] = None
 ) -> Callable[[Callable[..., Awaitable[Any]]], Target]:
 
     def inner(fn: Callable[..., Awaitable[Any]]):
-        return Fn(target, deps, fn, do_cache)
+        return Fn(target, deps, fn, do_cache, executor)
         
     return inner
@@ -0,0 +1,87 @@
+from typing import Dict, Iterable, Optional
+import asyncio
+import hashlib
+import mmap
+import os
+import stat
+
+from .cache import TimestampCache
+from .snapshot import FileSnapshot
+from .targets.target import FilePath
+
+CHUNK_SIZE = 1 << 20
+MMAP_THRESHOLD = 16 << 20
+
+
+def file_digest(path: FilePath) -> str:
+    "Hash the contents of a file without reading it into memory all at once"
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            # let the OS page the file through rather than copying it into our own buffers
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                h.update(mapped)
+        else:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def combine(digests: Dict[str, str]) -> str:
+    "A single digest of many named digests, independent of their order"
+    h = hashlib.blake2b(digest_size=20)
+    for name in sorted(digests):
+        h.update(f"{name}\0{digests[name]}\n".encode())
+    return h.hexdigest()
+
+
+class Digests:
+    """Content digests of files, cached in the `TimestampCache` by (path, size, mtime_ns, inode).
+
+    A file is only re-hashed when one of those changes, so that unchanged inputs are never read twice.
+    Hashing runs in the default thread pool executor, as hashlib releases the GIL for large buffers.
+    """
+
+    SECTION = 'hash'
+
+    def __init__(self, snapshot: FileSnapshot, cache: Optional[TimestampCache], persist: bool = True):
+        "Without persist, new digests aren't recorded in the cache, ie for a dry run"
+        self.snapshot = snapshot
+        self.cache = cache if persist else None
+        self.hashes = cache.section(self.SECTION) if cache is not None else {}
+        if not persist:
+            self.hashes = dict(self.hashes)
+        self.hashed = 0
+        self.reused = 0
+
+    async def digest(self, path: FilePath) -> Optional[str]:
+        "Digest of the file's contents, or None if it doesn't exist"
+        result = self.snapshot.stat(path)
+        if result is None:
+            return None
+
+        key = self.snapshot.abspath(path)
+        if stat.S_ISDIR(result.st_mode):
+            listing = self.snapshot.listdir(key) or {}
+            return combine({name: str(is_dir) for name, is_dir in listing.items()})
+
+        fingerprint = [result.st_size, result.st_mtime_ns, result.st_ino]
+        cached = self.hashes.get(key)
+        if cached is not None and cached[:3] == fingerprint:
+            self.reused += 1
+            return cached[3]
+
+        digest = await asyncio.get_event_loop().run_in_executor(None, file_digest, key)
+        self.hashed += 1
+        if self.cache is not None:
+            self.cache.record(self.SECTION, key, fingerprint + [digest])
+        else:
+            self.hashes[key] = fingerprint + [digest]
+        return digest
+
+    async def combined(self, paths: Iterable[FilePath]) -> str:
+        "A single digest of all the files' contents"
+        paths = list(paths)
+        digests = await asyncio.gather(*(self.digest(path) for path in paths))
+        return combine({str(path): digest or '' for path, digest in zip(paths, digests)})
@@ -1,11 +1,16 @@
+import asyncio
 import contextlib
 import os
-import multiprocessing
-from typing import Dict
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Mapping, MutableMapping, Optional, Tuple
 
-N_CPU_CORES = multiprocessing.cpu_count()
+N_CPU_CORES = os.cpu_count() or 1
 PATH = os.getenv('PATH')
 
+# cwd and envvars of the target being made in the current context, see `target_environment`
+_target_environment: 'ContextVar[Optional[Tuple[str, Mapping[str, str]]]]' = \
+    ContextVar('target_environment', default=None)
+
 @contextlib.contextmanager
 def env_isolated(**vars: str):
     with _env_inner(True, vars):
@@ -19,6 +24,18 @@ def env(**vars: str):
 @contextlib.contextmanager
 def _env_inner(isolated: bool, vars: Dict[str, str]):
     global PATH
+    current = _target_environment.get()
+    if current is not None:
+        # only modify the envvars of the target being made, which sh() passes on to its subprocesses
+        cwd, target_env = current
+        token = _target_environment.set(
+            (cwd, {**({} if isolated else target_env), **vars}))
+        try:
+            yield
+        finally:
+            _target_environment.reset(token)
+        return
+
     before = os.environ.copy()
     before_PATH = os.environ.get('PATH')
     if isolated:
@@ -31,4 +48,137 @@ def _env_inner(isolated: bool, vars: Dict[str, str]):
     finally:
         os.environ.clear()
         os.environ.update(before)
-        PATH = before_PATH  # type: ignore
\ No newline at end of file
+        PATH = before_PATH  # type: ignore
+
+
+class TargetEnv(MutableMapping[str, str]):
+    """The envvars of a target: a copy-on-write view of a snapshot of `os.environ` shared between targets.
+    The snapshot is only copied for a target whose envvars are changed."""
+
+    __slots__ = ('_base', '_own')
+
+    def __init__(self, base: Mapping[str, str]):
+        self._base = base
+        self._own: Optional[Dict[str, str]] = None
+
+    def _data(self) -> Mapping[str, str]:
+        return self._own if self._own is not None else self._base
+
+    def __getitem__(self, name: str) -> str:
+        return self._data()[name]
+
+    def __setitem__(self, name: str, value: str):
+        if self._own is None:
+            self._own = dict(self._base)
+        self._own[name] = value
+
+    def __delitem__(self, name: str):
+        if self._own is None:
+            self._own = dict(self._base)
+        del self._own[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._data())
+
+    def __len__(self) -> int:
+        return len(self._data())
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._data()
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, TargetEnv) and self._data() is other._data():
+            return True
+        return dict(self._data()) == (dict(other) if isinstance(other, Mapping) else other)
+
+    def copy(self) -> 'TargetEnv':
+        "Another view of the same envvars, which can then be changed independently"
+        if self._own is not None:
+            # share our own copy from now on, so it needs copying again before either of us changes it
+            self._base, self._own = self._own, None
+        return TargetEnv(self._base)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({dict(self._data())!r})"
+
+
+# the last snapshot of os.environ, and the raw data it was taken from
+_environ_snapshot: Optional[Tuple[Dict[Any, Any], Dict[str, str]]] = None
+
+
+def environ_snapshot() -> TargetEnv:
+    "The envvars of `os.environ` as they are now, sharing the previous snapshot if they haven't changed since"
+    global _environ_snapshot
+    # os.environ keeps the encoded envvars in a dict, which can be compared without decoding or copying them
+    data: Dict[Any, Any] = getattr(os.environ, '_data', None) or dict(os.environ)
+    if _environ_snapshot is None or _environ_snapshot[0] != data:
+        _environ_snapshot = (dict(data), dict(os.environ))
+    return TargetEnv(_environ_snapshot[1])
+
+
+@contextlib.contextmanager
+def target_environment(cwd: str, env: Mapping[str, str]):
+    "Set the cwd and envvars of the target being made in the current context (ie asyncio task or thread)"
+    token = _target_environment.set((cwd, env))
+    try:
+        yield
+    finally:
+        _target_environment.reset(token)
+
+
+def current_environment() -> Tuple[Optional[str], Optional[Mapping[str, str]]]:
+    "The cwd and envvars of the target being made in the current context, or (None, None) outside of one"
+    return _target_environment.get() or (None, None)
+
+
+class ProcessEnvironment:
+    """Installs the cwd and envvars that a coroutine needs into this process for as long as it runs.
+    Coroutines that need the same cwd and envvars share the installation and so may run concurrently,
+    whereas any others wait until it is no longer in use.
+
+    Once a installation is no longer in use it is left in place, and only the envvars that differ are
+    changed for the next one, as clearing and repopulating `os.environ` costs a syscall per variable.
+    """
+
+    def __init__(self):
+        self._installed: Optional[Tuple[str, Mapping[str, str]]] = None
+        self._users = 0
+        self._condition: Optional[asyncio.Condition] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _released(self) -> asyncio.Condition:
+        loop = asyncio.get_event_loop()
+        if self._condition is None or self._loop is not loop:
+            self._condition, self._loop = asyncio.Condition(), loop
+        return self._condition
+
+    def _install(self, cwd: str, env: Mapping[str, str]):
+        for name in [name for name in os.environ if name not in env]:
+            del os.environ[name]
+        for name, value in env.items():
+            if os.environ.get(name) != value:
+                os.environ[name] = value
+        if os.getcwd() != cwd:
+            os.chdir(cwd)
+        self._installed = (cwd, env.copy() if isinstance(env, TargetEnv) else dict(env))
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, cwd: str, env: Mapping[str, str]):
+        cwd = str(cwd)
+        released = self._released()
+        async with released:
+            await released.wait_for(lambda: not self._users or self._installed == (cwd, env))
+            if self._installed != (cwd, env):
+                self._install(cwd, env)
+            self._users += 1
+
+        try:
+            yield
+        finally:
+            async with released:
+                self._users -= 1
+                if not self._users:
+                    released.notify_all()
+
+
+process_environment = ProcessEnvironment()
@@ -0,0 +1,253 @@
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from inspect import signature
+from pathlib import Path
+import contextlib
+import asyncio
+import hashlib
+import pickle
+import time
+
+from .context import Context
+from .environment import N_CPU_CORES, process_environment, target_environment
+from .graph import BuildGraph, Node
+from .jobs import target_jobs
+from .logger import logger
+from .shell import ShellOutput, ShellStats, counting_commands, current_output, output_label, target_output
+from .targets.target import Target
+from .trace import Event, collecting, span
+
+
+class Remade(NamedTuple):
+    time: float  # when the target was remade
+    result: Optional[str]  # digest of what the make function returned, if it returned anything
+    events: Tuple[Event, ...] = ()  # spans of the remake, when the build is traced
+    elapsed: float = 0.0  # seconds the executor spent remaking the target
+    shell: Optional[ShellStats] = None  # the commands the target ran
+
+
+class Executor(ABC):
+    """Runs the remakes of targets for `make()`.
+
+    Each target runs with its own cwd and envvars, which `sh()` passes on to its subprocesses.
+    Only the process executor installs them into `os.environ` and the process' cwd, as its workers
+    don't share them with anything else.
+
+    When `trace` is given to `submit`, the spans of the remake are sent back with its result.
+    Targets remade through `remake` are counted in `remakes`, and the seconds spent remaking them in `busy`.
+    """
+
+    def __init__(self, graph: BuildGraph, max_workers: Optional[int] = None):
+        self.graph = graph
+        self.workers: Optional[int] = None  # how many targets it runs at once, if limited
+        self.remakes = 0
+        self.busy = 0.0
+        self.started = time.perf_counter()
+
+    @abstractmethod
+    def submit(self, node: Node, restat: bool, trace: bool = False) -> 'asyncio.Future[Remade]':
+        "Start remaking the node's target, returning a future of when it was remade"
+
+    async def remake(self, node: Node, restat: bool, trace: bool = False) -> Remade:
+        "Remake the node's target, counting it"
+        made = await self.submit(node, restat, trace)
+        self.remakes += 1
+        self.busy += made.elapsed
+        return made
+
+    def reset(self):
+        "Count afresh from the next build, when the executor is kept running between builds"
+        self.remakes = 0
+        self.busy = 0.0
+        self.started = time.perf_counter()
+
+    def utilisation(self) -> Optional[float]:
+        """Seconds spent remaking targets per second of each worker since the executor started.
+        Can exceed 1 for worker processes, which each run several async targets at once"""
+        elapsed = time.perf_counter() - self.started
+        if not self.workers or not elapsed:
+            return None
+        return self.busy / (elapsed * self.workers)
+
+    def shutdown(self):
+        pass
+
+
+class InlineExecutor(Executor):
+    "Runs targets as coroutines on the event loop running make(), ie for targets that only await `sh()`"
+
+    def submit(self, node: Node, restat: bool, trace: bool = False) -> 'asyncio.Future[Remade]':
+        return asyncio.ensure_future(
+            _remake_async(node.target, _dep_paths(node), restat, isolate=False, track=_track(node, trace)))
+
+
+class ThreadExecutor(Executor):
+    "Runs each target on its own event loop in a thread pool"
+
+    def __init__(self, graph: BuildGraph, max_workers: Optional[int] = None):
+        super().__init__(graph)
+        self.pool = ThreadPoolExecutor(max_workers)
+        self.workers = self.pool._max_workers  # type: ignore
+
+    def submit(self, node: Node, restat: bool, trace: bool = False) -> 'asyncio.Future[Remade]':
+        return asyncio.get_event_loop().run_in_executor(
+            self.pool, _remake, node.target, _dep_paths(node), restat, False, _track(node, trace))
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+class ProcessExecutor(Executor):
+    """Runs targets in worker processes. Uses the warm, forked `WarmWorkerPool` where possible,
+    falling back to a `ProcessPoolExecutor` that pickles every target otherwise"""
+
+    def __init__(self, graph: BuildGraph, max_workers: Optional[int] = None):
+        super().__init__(graph)
+        # each worker runs several targets at once, so there's no need for more workers than cores
+        max_workers = min(max_workers, N_CPU_CORES) if max_workers else None
+        # imported here rather than up-front, as they import dill, multiprocess and tblib
+        from .workerpool import WarmWorkerPool
+        self.warm = WarmWorkerPool.supported()
+        if self.warm:
+            # the workers are forked with the graph, so that jobs only need to send the node's index
+            self.pool: Any = WarmWorkerPool(graph.order, _remake_node, max_workers)
+        else:
+            from .processpoolexecutor import ProcessPoolExecutor
+            self.pool = ProcessPoolExecutor(max_workers)
+        self.workers = max_workers or N_CPU_CORES
+
+    def submit(self, node: Node, restat: bool, trace: bool = False) -> 'asyncio.Future[Remade]':
+        # sent with every job, as the workers may have been started by an earlier build, ie of the daemon
+        settings = (logger.getEffectiveLevel(), current_output())
+        if self.warm:
+            return self.pool.submit(node, restat, _track(node, trace), *settings)
+        return asyncio.wrap_future(self.pool.submit(
+            _remake, node.target, _dep_paths(node), restat, True, _track(node, trace), *settings))
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+AGENTS_ENV = 'PYMAKE_AGENTS'  # the agents of the remote executor, when not given to make()
+
+
+def remote_executor(graph: BuildGraph, max_workers: Optional[int] = None,
+                    agents: Optional[Sequence[str]] = None) -> Executor:
+    "A `RemoteExecutor` of the agents (`HOST:PORT`s), or else of those in $PYMAKE_AGENTS"
+    # imported here rather than up-front, as it imports dill and tblib
+    from .remote import RemoteExecutor
+    return RemoteExecutor(graph, max_workers, agents)
+
+
+EXECUTORS: Dict[str, Callable[[BuildGraph, Optional[int]], Executor]] = {
+    'inline': InlineExecutor,
+    'thread': ThreadExecutor,
+    'process': ProcessExecutor,
+    'remote': remote_executor,
+}
+
+
+def _dep_paths(node: Node) -> List[Path]:
+    "The files that a node depends upon, including the outputs of dependency targets"
+    return [Path(f) for f in node.files] + [
+        Path(dep.target.target) for dep in node.deps if dep.target.target]
+
+
+def _track(node: Node, trace: bool) -> Optional[int]:
+    "The track of the node's spans in the build's trace, or None when it isn't traced"
+    return node.index + 1 if trace else None
+
+
+def _remake(
+    target: Target,
+    deps: List[Path],
+    restat: bool = False,
+    isolate: bool = True,
+    track: Optional[int] = None,
+    level: Optional[int] = None,
+    output: Optional[ShellOutput] = None
+) -> Remade:
+    "Remake the given target on a new event loop. Returns the time the target was remade"
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_remake_async(target, deps, restat, isolate, track, level, output))
+    finally:
+        loop.close()
+
+
+async def _remake_node(node: Node, restat: bool, track: Optional[int] = None, level: Optional[int] = None,
+                       output: Optional[ShellOutput] = None) -> Remade:
+    return await _remake_async(node.target, _dep_paths(node), restat, track=track, level=level, output=output)
+
+
+async def _remake_async(
+    target: Target,
+    deps: List[Path],
+    restat: bool,
+    isolate: bool = True,
+    track: Optional[int] = None,
+    level: Optional[int] = None,
+    output: Optional[ShellOutput] = None
+) -> Remade:
+    """Remake the given target, ensuring envvars and cwd is as expected.
+    With isolate, they are installed into the process rather than only being passed on to `sh()`.
+    With restat, the make function is allowed to leave an existing output file untouched.
+    With a track, the spans of the remake are returned with it.
+    With a log level and `sh()` output, those of the build are applied in a worker that didn't inherit them"""
+    if level is not None:
+        logger.setLevel(level)
+    with target_output(output) if output is not None else contextlib.nullcontext(), \
+            target_environment(str(target.cwd), target.env), target_jobs(), output_label(target_label(target)), \
+            collecting(track) as events, counting_commands() as commands:
+        start = time.perf_counter()
+        with span('execute', 'execute'):
+            if isolate:
+                async with process_environment(str(target.cwd), target.env):
+                    made = await _run_make(target, deps, restat)
+            else:
+                made = await _run_make(target, deps, restat)
+        return made._replace(events=tuple(events), elapsed=time.perf_counter() - start, shell=commands)
+
+
+def target_label(target: Target) -> str:
+    "What to call the target in its output and stats: its output file, or else the name of its function"
+    if target.target:
+        return str(target.target)
+    return getattr(getattr(target, 'fn', None), '__name__', type(target).__name__)
+
+
+async def _run_make(target: Target, deps: List[Path], restat: bool) -> Remade:
+    async def run_make():
+        args: List[Any] = []
+        if 'ctx' in signature(target.make).parameters:
+            # relative to the target's cwd, which is only installed into the process when isolated
+            out = target.cwd / target.target if target.target else None
+            args.append(Context(None, None, out, deps))
+        return await target.make(*args)
+
+    if target.target:
+        target_path = target.cwd / target.target
+        if target_path.exists():
+            before = target_path.stat().st_mtime
+            await run_make()
+            after = target_path.stat().st_mtime
+            # TODO: custom errors
+            assert restat or after != before, "output file did not change"
+            assert after >= before, "output file went back in time"
+            # when the output was left untouched, record that it was up-to-date as of now
+            return Remade(after if after != before else time.time(), None)
+
+    result = await run_make()
+    return Remade(time.time(), _result_digest(result))
+
+
+def _result_digest(result: Any) -> Optional[str]:
+    "Digest of a value returned by a make function, which is only needed to compare it between builds"
+    if result is None:
+        return None
+    try:
+        data = pickle.dumps(result)
+    except Exception:
+        data = repr(result).encode()
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
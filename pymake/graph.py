@@ -0,0 +1,203 @@
+from typing import Dict, FrozenSet, List, Optional, Sequence, Tuple, Union
+from array import array
+from pathlib import Path
+import sys
+
+from .snapshot import FileSnapshot
+from .targets.target import Target
+from .targets.wildcard import NoTargetMatchError, TargetIndex
+
+
+class Node:
+    """A target in the build graph, with its dependencies resolved to other nodes and files.
+    Its edges are stored by the graph, and read back as lists of nodes or paths"""
+
+    __slots__ = ('target', 'index', '_graph')
+
+    def __init__(self, target: Target, index: int, graph: 'BuildGraph'):
+        self.target = target
+        self.index = index
+        self._graph = graph
+
+    @property
+    def deps(self) -> List['Node']:
+        return self._graph._edges(self._graph._deps, self.index)
+
+    @property
+    def dependents(self) -> List['Node']:
+        return self._graph._edges(self._graph._dependents, self.index)
+
+    @property
+    def files(self) -> List[str]:
+        graph = self._graph
+        offsets, ids = graph._files
+        return [graph.paths[i] for i in ids[offsets[self.index]:offsets[self.index + 1]]]
+
+    def __repr__(self) -> str:
+        return repr(self.target)
+
+
+# per node, the offsets of its edges in a flat array of the ids at their other end
+Edges = Tuple['array[int]', 'array[int]']
+
+
+def _compress(lists: Sequence[Sequence[int]]) -> Edges:
+    "Pack lists of ids into compressed sparse rows"
+    offsets = array('i', [0])
+    ids = array('i')
+    for items in lists:
+        ids.extend(items)
+        offsets.append(len(ids))
+    return offsets, ids
+
+
+class BuildGraph:
+    """The dependency graph required to make a target, expanded once up-front.
+
+    Each target appears as exactly one node no matter how many paths reach it.
+    `Path` dependencies (relative to `prefix_dir`) are resolved to the target that makes them,
+    otherwise they are globbed and the matches become file dependencies of the node. As with GNU make,
+    a pattern target is only instantiated for an existing file when its own dependencies exist or can be made.
+    `order` lists the nodes topologically, such that every node comes after all of its dependencies.
+
+    Edges are kept as arrays of node ids rather than lists of references, and file paths are interned into
+    `paths`, so that graphs of hundreds of thousands of targets stay small.
+    """
+
+    def __init__(
+        self,
+        root: Target,
+        targets: Union[Dict[str, Target], TargetIndex],
+        prefix_dir: Path,
+        snapshot: FileSnapshot
+    ):
+        self.index = TargetIndex.of(targets)
+        self.prefix_dir = prefix_dir
+        self.snapshot = snapshot
+        self.nodes: Dict[Target, Node] = {}
+        self.order: List[Node] = []
+        self.paths: List[str] = []
+        self._by_index: List[Node] = []
+        self._path_ids: Optional[Dict[str, int]] = {}
+        # edge lists while expanding, compressed once the graph is complete
+        self._building: Optional[Tuple[List[List[int]], List[List[int]], List[List[int]]]] = ([], [], [])
+        self.root = self._expand(root)
+
+        deps, dependents, files = self._building
+        self._deps, self._dependents, self._files = _compress(deps), _compress(dependents), _compress(files)
+        self._building = self._path_ids = None
+
+    def _edges(self, edges: Edges, index: int) -> List[Node]:
+        offsets, ids = edges
+        by_index = self._by_index
+        return [by_index[i] for i in ids[offsets[index]:offsets[index + 1]]]
+
+    def _add(self, target: Target) -> Node:
+        assert self._building is not None
+        node = self.nodes[target] = Node(target, len(self._by_index), self)
+        self._by_index.append(node)
+        for lists in self._building:
+            lists.append([])
+        return node
+
+    def _expand(self, root: Target) -> Node:
+        "Iterative depth-first expansion, so that deep dependency chains can't exhaust the stack"
+        assert self._building is not None
+        deps, dependents, _ = self._building
+        root_node = self._add(root)
+        # (node, remaining dependencies to expand) for the nodes currently on the DFS path
+        stack: List[Tuple[Node, List[Target]]] = [(root_node, self._resolve(root_node))]
+        on_path = {root}
+
+        while stack:
+            node, pending = stack[-1]
+            if not pending:
+                stack.pop()
+                on_path.discard(node.target)
+                self.order.append(node)
+                continue
+
+            dep = pending.pop()
+            if dep in on_path:
+                cycle = [n.target for n, _ in stack]
+                cycle = cycle[cycle.index(dep):] + [dep]
+                raise DependencyCycleError(
+                    f"Dependency cycle detected: {' -> '.join(map(repr, cycle))}")
+
+            dep_node = self.nodes.get(dep)
+            if dep_node is None:
+                dep_node = self._add(dep)
+                stack.append((dep_node, self._resolve(dep_node)))
+                on_path.add(dep)
+
+            deps[node.index].append(dep_node.index)
+            dependents[dep_node.index].append(node.index)
+
+        return root_node
+
+    def _resolve(self, node: Node) -> List[Target]:
+        "Resolve the node's file dependencies, returning the targets it depends upon (in reverse order)"
+        dep_targets: List[Target] = []
+        for dep in node.target.deps:
+            if isinstance(dep, Path):
+                if not dep.is_absolute():
+                    dep = self.prefix_dir / dep
+
+                try:
+                    found = self.index.find(dep)
+                    # as with GNU make, a pattern only applies to an existing file if its dependencies can be made
+                    if self.index.rule(found) is None or not self.snapshot.glob(dep) or self._applies(found):
+                        dep_targets.append(found)
+                        continue
+                except NoTargetMatchError:
+                    pass
+                matches = self.snapshot.glob(dep)
+                if not matches:
+                    raise NoTargetMatchError(
+                        f"No file or target matches the dependency '{dep}' of {node.target}")
+                self._add_files(node, matches)
+                continue
+
+            dep_targets.append(dep)
+
+        # deduplicate, reversed so that popping from the end expands them in declaration order
+        return list(dict.fromkeys(reversed(dep_targets)))
+
+    def _applies(self, target: Target, rules: FrozenSet[Target] = frozenset()) -> bool:
+        """Whether every file dependency of the target instantiated from a pattern exists or can be made,
+        without instantiating any pattern twice along the way"""
+        rule = self.index.rule(target)
+        assert rule is not None
+        rules = rules | {rule}
+        for dep in target.deps:
+            if not isinstance(dep, Path):
+                continue
+            if not dep.is_absolute():
+                dep = self.prefix_dir / dep
+            if self.snapshot.glob(dep):
+                continue
+            try:
+                found = self.index.find(dep)
+            except NoTargetMatchError:
+                return False
+            rule = self.index.rule(found)
+            if rule is not None and (rule in rules or not self._applies(found, rules)):
+                return False
+        return True
+
+    def _add_files(self, node: Node, paths: List[str]):
+        assert self._building is not None and self._path_ids is not None
+        files = self._building[2][node.index]
+        for path in paths:
+            path_id = self._path_ids.get(path)
+            if path_id is None:
+                path_id = self._path_ids[path] = len(self.paths)
+                self.paths.append(sys.intern(path))
+            files.append(path_id)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+
+class DependencyCycleError(Exception):
+    pass
@@ -0,0 +1,386 @@
+from typing import Deque, Dict, List, Optional, Tuple
+from contextvars import ContextVar
+from collections import deque
+import contextlib
+import itertools
+import heapq
+import asyncio
+import time
+import stat
+import re
+import os
+
+from .logger import logger
+
+# how often to re-check the load average while jobs are held back
+LOAD_POLL_INTERVAL = 0.25
+# jobs started within this many seconds count towards the load average, as it lags behind them
+LOAD_WINDOW = 1.0
+
+Token = Optional[bytes]  # None is the implicit token of the process running make()
+
+
+class JobLimiter:
+    """Limits the number of jobs running at once across the whole build, like `make -j -l`.
+
+    A job is either a target being remade or a `sh()` subprocess. As with GNU make's jobserver, the
+    slots are tokens in a pipe that's inherited by forked worker processes: the process running make()
+    has one implicit token and the pipe holds the other `jobs - 1`. A target's first subprocess runs
+    in the target's own slot, and any that it runs concurrently with that need a token of their own.
+
+    With `load_average`, no new target is started while the system's load average (plus the jobs
+    started in the last second, as it lags behind them) is at least that, unless nothing is running.
+
+    The pipe is also passed to the subprocesses of `sh()` as a GNU make jobserver, so that recursive
+    makes share the build's slots. Given the `pipe` or `fifo` of a jobserver that pymake was run from,
+    it joins that jobserver as a client instead, see `JobLimiter.from_makeflags`.
+    """
+
+    def __init__(
+        self,
+        jobs: Optional[int] = None,
+        load_average: Optional[float] = None,
+        *,
+        pipe: Optional[Tuple[int, int]] = None,
+        fifo: Optional[str] = None
+    ):
+        assert jobs is None or jobs >= 1, "jobs must be at least 1"
+        self.jobs = jobs
+        self.load_average = load_average
+        self.running = 0
+        self.held_back = 0
+
+        # the implicit token can only be taken by tasks on the event loop running make()
+        self._owner = asyncio.get_event_loop()
+        self._implicit_free = True
+        self._fifo = fifo
+        # whether the jobserver is ours, rather than that of a make we were run from
+        self.is_server = pipe is None and fifo is None
+        if fifo is not None:
+            self._pipe: Optional[Tuple[int, int]] = (
+                os.open(fifo, os.O_RDONLY | os.O_NONBLOCK), os.open(fifo, os.O_WRONLY))
+        elif pipe is not None:
+            self._pipe = pipe
+        else:
+            self._pipe = os.pipe() if jobs is not None else None
+            if self._pipe is not None:
+                os.write(self._pipe[1], b'+' * (jobs - 1))  # type: ignore
+
+        self._reader: Optional[int] = None
+        self._reader_pid: Optional[int] = None
+        # futures of tasks waiting for a token, per event loop
+        self._waiters: Dict[asyncio.AbstractEventLoop, List['asyncio.Future[None]']] = {}
+        self._started: Deque[float] = deque()
+        # targets waiting for a slot, by priority
+        self._turns: List[Tuple[float, int, 'asyncio.Future[None]']] = []
+        self._turn_order = itertools.count()
+        self._turn_taken = False
+
+    def _read_fd(self) -> int:
+        "A non-blocking read end of the pipe, private to this process where possible"
+        pid = os.getpid()
+        if self._reader_pid != pid:
+            assert self._pipe is not None
+            # forked from another process, so its waiters are on an event loop we don't have
+            self._waiters = {}
+            try:
+                # a new open file description, so that changing its flags doesn't affect other processes
+                self._reader = os.open(
+                    self._fifo or f'/proc/self/fd/{self._pipe[0]}', os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
+                self._reader = self._pipe[0]
+                os.set_blocking(self._reader, False)
+            self._reader_pid = pid
+        assert self._reader is not None
+        return self._reader
+
+    async def acquire(self) -> Token:
+        "Wait for a job slot, returning the token to `release` once the job is done"
+        if self._pipe is None:
+            return None
+
+        loop = asyncio.get_event_loop()
+        while True:
+            if self._implicit_free and loop is self._owner:
+                self._implicit_free = False
+                return None
+
+            fd = self._read_fd()
+            try:
+                token = os.read(fd, 1)
+                assert token, "the job token pipe was closed"
+                return token
+            except BlockingIOError:
+                pass
+
+            waiter = loop.create_future()
+            waiters = self._waiters.setdefault(loop, [])
+            if not waiters:
+                loop.add_reader(fd, self._wake, loop)
+            waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                if not waiters and not loop.is_closed():
+                    loop.remove_reader(fd)
+
+    def release(self, token: Token):
+        if self._pipe is None:
+            return
+        if token is None:
+            self._implicit_free = True
+            self._wake(self._owner)
+        else:
+            os.write(self._pipe[1], token)
+
+    def _wake(self, loop: asyncio.AbstractEventLoop):
+        "Let every task waiting on the loop try to take a token"
+        for waiter in self._waiters.get(loop, []):
+            if not waiter.done():
+                waiter.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        "Hold a job slot for as long as the block runs"
+        token = await self.acquire()
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    @contextlib.asynccontextmanager
+    async def target(self, priority: float = 0.0):
+        """Hold a slot for a target being remade, after waiting for the load average to drop if needed.
+        Targets waiting for a slot get one in order of priority, highest first"""
+        async with self._turn(priority):
+            await self._wait_for_load()
+            token = await self.acquire()
+        self.running += 1
+        self._started.append(time.monotonic())
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self.release(token)
+
+    @contextlib.asynccontextmanager
+    async def _turn(self, priority: float):
+        "Wait until no target of a higher priority is waiting for a slot"
+        if self._pipe is None and self.load_average is None:
+            yield  # nothing to wait for
+            return
+
+        if self._turn_taken or self._turns:
+            turn = asyncio.get_event_loop().create_future()
+            heapq.heappush(self._turns, (-priority, next(self._turn_order), turn))
+            try:
+                await turn
+            except asyncio.CancelledError:
+                if turn.done() and not turn.cancelled():
+                    self._pass_turn()
+                raise
+        else:
+            self._turn_taken = True
+        try:
+            yield
+        finally:
+            self._pass_turn()
+
+    def _pass_turn(self):
+        while self._turns:
+            _, _, turn = heapq.heappop(self._turns)
+            if not turn.done():
+                turn.set_result(None)
+                return
+        self._turn_taken = False
+
+    async def _wait_for_load(self):
+        if self.load_average is None:
+            return
+        logged = False
+        while self.running and self._load() >= self.load_average:
+            if not logged:
+                self.held_back += 1
+                logger.debug(
+                    f"Holding back a job until the load average drops below {self.load_average}")
+                logged = True
+            await asyncio.sleep(LOAD_POLL_INTERVAL)
+
+    def _load(self) -> float:
+        now = time.monotonic()
+        while self._started and now - self._started[0] > LOAD_WINDOW:
+            self._started.popleft()
+        try:
+            load = os.getloadavg()[0]
+        except OSError:
+            return 0.0
+        return load + len(self._started)
+
+    @classmethod
+    def from_makeflags(cls, makeflags: str, load_average: Optional[float] = None) -> Optional['JobLimiter']:
+        "Join the jobserver of the GNU make that set `MAKEFLAGS`, if it passed one on to us"
+        auth = None
+        for auth in re.findall(r'--jobserver-(?:auth|fds)=(\S+)', makeflags):
+            pass  # the last one wins, as with make
+        if auth is None:
+            return None
+        slots = re.findall(r'(?:^|\s)-j(\d+)', makeflags)
+        jobs = int(slots[-1]) if slots else None
+
+        if auth.startswith('fifo:'):
+            try:
+                return cls(jobs, load_average, fifo=auth[len('fifo:'):])
+            except OSError as e:
+                logger.warning(f"Couldn't open the jobserver fifo from MAKEFLAGS ({e}), so not limiting jobs")
+                return None
+
+        try:
+            read_fd, write_fd = (int(fd) for fd in auth.split(','))
+            for fd in (read_fd, write_fd):
+                if not stat.S_ISFIFO(os.fstat(fd).st_mode):
+                    raise OSError(f"fd {fd} isn't a pipe")
+        except (ValueError, OSError):
+            logger.warning(
+                "The jobserver in MAKEFLAGS isn't available, so not limiting jobs. "
+                "Prefix the make rule that runs pymake with '+' to pass it on.")
+            return None
+        return cls(jobs, load_average, pipe=(read_fd, write_fd))
+
+    def makeflags(self, makeflags: str = '') -> str:
+        "MAKEFLAGS for a child make to join this jobserver, keeping any other flags that were already set"
+        assert self._pipe is not None
+        flags = [flag for flag in makeflags.split()
+                 if not re.match(r'-j\d*$|--jobserver-(auth|fds)=', flag)]
+        auth = f'fifo:{self._fifo}' if self._fifo else f'{self._pipe[0]},{self._pipe[1]}'
+        flags += [f'-j{self.jobs or ""}', f'--jobserver-auth={auth}']
+        return ' '.join(flags)
+
+    @property
+    def pass_fds(self) -> Tuple[int, ...]:
+        "File descriptors that a child make needs to join this jobserver"
+        return self._pipe if self._pipe is not None and self._fifo is None else ()
+
+    @property
+    def has_jobserver(self) -> bool:
+        return self._pipe is not None
+
+    def close(self):
+        if self._reader is not None and self._pipe is not None and self._reader != self._pipe[0] \
+                and self._reader_pid == os.getpid():
+            os.close(self._reader)
+        # a make we were run from still needs its pipe, but not the fds we opened for its fifo
+        if self._pipe is not None and (self.is_server or self._fifo is not None):
+            for fd in self._pipe:
+                os.close(fd)
+        self._pipe = self._reader = None
+
+
+class _TargetJobs:
+    "The slot held by the target being made, which one of its subprocesses at a time may use"
+
+    def __init__(self):
+        self.slot_free = True
+        self._freed: List['asyncio.Future[None]'] = []
+
+    async def acquire(self, limiter: Optional[JobLimiter]) -> Tuple[bool, Token]:
+        "Wait for the target's own slot or another token, whichever is free first"
+        loop = asyncio.get_event_loop()
+        acquiring: Optional['asyncio.Future[Token]'] = None
+        try:
+            while True:
+                if self.slot_free:
+                    self.slot_free = False
+                    return True, None
+                if limiter is None:
+                    return False, None
+                if acquiring is None:
+                    acquiring = asyncio.ensure_future(limiter.acquire())
+
+                freed = loop.create_future()
+                self._freed.append(freed)
+                try:
+                    await asyncio.wait([acquiring, freed], return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    if freed in self._freed:
+                        self._freed.remove(freed)
+                if acquiring.done():
+                    token, acquiring = acquiring.result(), None
+                    return False, token
+        finally:
+            if acquiring is not None:
+                if acquiring.done() and not acquiring.cancelled() and acquiring.exception() is None:
+                    limiter.release(acquiring.result())  # type: ignore
+                else:
+                    acquiring.cancel()
+
+    def release(self, own: bool, token: Token, limiter: Optional[JobLimiter]):
+        if own:
+            self.slot_free = True
+            for freed in self._freed:
+                if not freed.done():
+                    freed.set_result(None)
+        elif limiter is not None:
+            limiter.release(token)
+
+
+# the limiter of the build in progress, which forked worker processes inherit
+_limiter: Optional[JobLimiter] = None
+_target_jobs: 'ContextVar[Optional[_TargetJobs]]' = ContextVar('target_jobs', default=None)
+
+
+@contextlib.contextmanager
+def limiting(limiter: JobLimiter):
+    "Limit the jobs of the build being made to those of the limiter"
+    global _limiter
+    previous, _limiter = _limiter, limiter
+    try:
+        yield limiter
+    finally:
+        _limiter = previous
+
+
+def current_limiter() -> Optional[JobLimiter]:
+    return _limiter
+
+
+def job_limiter(jobs: Optional[int] = None, load_average: Optional[float] = None) -> JobLimiter:
+    """The limiter for a build. Without an explicit `jobs`, joins the jobserver of a GNU make that pymake is
+    being run from, like a sub-make would"""
+    if jobs is None:
+        client = JobLimiter.from_makeflags(os.environ.get('MAKEFLAGS', ''), load_average)
+        if client is not None:
+            logger.debug("Joined the jobserver of the make that ran pymake")
+            return client
+    return JobLimiter(jobs, load_average)
+
+
+@contextlib.contextmanager
+def target_jobs():
+    "Let a subprocess of the target being made in the current context use the slot that it already holds"
+    token = _target_jobs.set(_TargetJobs())
+    try:
+        yield
+    finally:
+        _target_jobs.reset(token)
+
+
+@contextlib.asynccontextmanager
+async def subprocess_slot():
+    "Hold a job slot for a subprocess, unless it can use the slot of the target running it"
+    jobs = _target_jobs.get()
+    limiter = _limiter
+    if jobs is None:
+        if limiter is None:
+            yield
+        else:
+            async with limiter.slot():
+                yield
+        return
+
+    own, token = await jobs.acquire(limiter)
+    try:
+        yield
+    finally:
+        jobs.release(own, token, limiter)
@@ -1,25 +1,57 @@
+from .targets.group import Group
+from .targets.makefile import Makefile, SubMakes
 from .targets.target import FilePath, Target
-from .targets.wildcard import find_matching_target
-from typing import Awaitable, Optional, Union, Set, Dict
+from .targets.wildcard import TargetIndex
+from typing import AbstractSet, Dict, List, Optional, Sequence, Set, Tuple, Union, TYPE_CHECKING
 from .cache import TimestampCache
+from .digest import Digests
+from .executors import EXECUTORS, Executor, Remade, remote_executor, target_label
+from .graph import BuildGraph, Node
+from .jobs import JobLimiter, job_limiter, limiting
+from .logger import logger
+from .schedule import DURATIONS_SECTION, CriticalPath, explain
+from .shell import shell_output
+from .snapshot import FileSnapshot
+from .stats import SLOWEST, BuildStats
+from .trace import complete, enabled, merge, now, span, target_track, tracing
 import asyncio
-from pathlib import Path
-import os
-import glob
+import heapq
 import time
-from .processpoolexecutor import ProcessPoolExecutor
+from pathlib import Path
+
+if TYPE_CHECKING:
+    from .artifacts import Artifacts, ArtifactStore
+
+DEPS_SECTION = 'deps'  # cache section of the dependency digests each target was last made with
+OUTPUT_SECTION = 'output'  # cache section of the digest of each target's output when it was last made
 
 
 def make_sync(
     target: Target,
     *,
     cache: Optional[Union[TimestampCache, FilePath]] = '.pymake-cache',
-    targets: Optional[Dict[str, Target]] = None,
-    prefix_dir: FilePath = ''
-):
+    targets: Optional[Union[Dict[str, Target], TargetIndex]] = None,
+    prefix_dir: FilePath = '',
+    digest: bool = False,
+    restat: bool = False,
+    executor: str = 'process',
+    jobs: Optional[int] = None,
+    load_average: Optional[float] = None,
+    explain_schedule: bool = False,
+    stream: bool = False,
+    log_dir: Optional[FilePath] = None,
+    trace: Optional[FilePath] = None,
+    stats: bool = False,
+    stats_file: Optional[FilePath] = None,
+    artifacts: Optional[Union['ArtifactStore', str]] = None,
+    agents: Optional[Sequence[str]] = None
+) -> BuildStats:
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(make(
-        target, cache=cache, targets=targets, prefix_dir=prefix_dir))
+    return loop.run_until_complete(make(
+        target, cache=cache, targets=targets, prefix_dir=prefix_dir, digest=digest, restat=restat,
+        executor=executor, jobs=jobs, load_average=load_average, explain_schedule=explain_schedule,
+        stream=stream, log_dir=log_dir, trace=trace, stats=stats, stats_file=stats_file, artifacts=artifacts,
+        agents=agents))
 
 # technically not 'uncatchable', but most except clauses catch Exception
 # which is a subclass of BaseException. Therefore BaseExceptions won't be caught
@@ -29,105 +61,433 @@ async def make(
     target: Target,
     *,
     cache: Optional[Union[TimestampCache, FilePath]] = '.pymake-cache',
-    targets: Optional[Dict[str, Target]] = None,
-    prefix_dir: FilePath = ''
+    targets: Optional[Union[Dict[str, Target], TargetIndex]] = None,
+    prefix_dir: FilePath = '',
+    snapshot: Optional[FileSnapshot] = None,
+    graph: Optional[BuildGraph] = None,
+    only: Optional[Set[Target]] = None,
+    executors: Optional[Dict[str, Executor]] = None,
+    limiter: Optional[JobLimiter] = None,
+    digest: bool = False,
+    restat: bool = False,
+    executor: str = 'process',
+    jobs: Optional[int] = None,
+    load_average: Optional[float] = None,
+    explain_schedule: bool = False,
+    stream: bool = False,
+    log_dir: Optional[FilePath] = None,
+    trace: Optional[FilePath] = None,
+    stats: bool = False,
+    stats_file: Optional[FilePath] = None,
+    artifacts: Optional[Union['ArtifactStore', str]] = None,
+    agents: Optional[Sequence[str]] = None
+) -> BuildStats:
+    """Make the target, and any of its dependencies that are out-of-date.
+
+    By default a target is out-of-date when any of its file dependencies were modified after it.
+    With `digest=True` it is instead out-of-date when the contents of its dependencies differ from
+    when it was last made, as recorded in the cache.
+
+    With `restat=True` the digest of each remade target's output (or for targets without an output file,
+    of whatever their make function returned) is recorded in the cache. When it is the same as before the
+    remake, the target's dependents don't need to be remade on its account.
+
+    Targets are remade by the `executor` named by their `executor` attribute, or else the one given here:
+    'inline' runs them on this event loop, 'thread' in a thread pool and 'process' in worker processes.
+    'remote' sends them to `pymake-worker` agents, ie on other machines sharing the filesystem: the
+    `agents` given as `HOST:PORT`s, or else those in $PYMAKE_AGENTS (see `pymake.remote`).
+
+    At most `jobs` targets and `sh()` subprocesses run at once across the whole build, and no new target is
+    started while the load average is at least `load_average`. Either is unlimited when None, unless pymake
+    is run from a GNU make with a jobserver, which it then shares. Child makes share the build's jobs too.
+
+    Of the targets that are ready to be remade, those with the longest chain of dependents still to remake
+    start first, going by how long each took when last remade. With `explain_schedule`, the actual makespan
+    of the build is printed against the one those durations predicted.
+
+    With `stream`, the output of `sh()` is logged line by line as it arrives, prefixed by the target, rather
+    than once each command finishes. With `log_dir`, each target's output is also written to a file in it.
+
+    With `trace`, a timeline of the build is written to that path in the Chrome Trace Event format, with
+    spans of each target's staleness check, wait for a job slot, dispatch, remake, cache writes and `sh()`s.
+
+    A `graph` already resolved with the `snapshot` is reused, rather than resolving the target's again.
+    With `only`, the staleness of just those targets is checked, and the rest are assumed to be up-to-date,
+    ie by `watch()`, which knows which targets a change to the filesystem could have affected.
+
+    Given `executors` (by name, started with the `graph`), those missing are started in it, and they're
+    left running once the build finishes, as is a given job `limiter` (which their workers inherit),
+    so that a daemon can reuse them for its next build of the same graph.
+
+    With `artifacts` (an `ArtifactStore`, or a directory or http(s):// URL of one), the outputs of targets
+    that are out-of-date are restored from it when they were made before with the same dependencies,
+    code and envvars, ie by another machine, rather than being remade, and are stored in it once remade.
+
+    Returns the `BuildStats` of the build. With `stats` they're printed once it finishes, and with `stats_file`
+    they're written to that path, as a Prometheus textfile if it ends in '.prom' or else as JSON.
+    """
+    with tracing(trace):
+        assert targets  # TODO: import from calling module
+        # shared by the cache and the graph, so that both resolve a pattern request to the same instance
+        index = TargetIndex.of(targets)
+        _prefix_dir = Path(prefix_dir)
+        _snapshot = snapshot or FileSnapshot()
+
+        _cache = cache if cache is None or isinstance(cache, TimestampCache) \
+            else TimestampCache(_prefix_dir / cache, index)
+
+        if (digest or restat) and _cache is None:
+            logger.warning(
+                "Content digests can't be compared without a cache. Falling back to timestamps.")
+            digest = restat = False
+        digests = Digests(_snapshot, _cache) if _cache is not None else None
+        _artifacts: Optional['Artifacts'] = None
+        if artifacts is not None:
+            from .artifacts import Artifacts, artifact_store
+            _artifacts = Artifacts(artifact_store(artifacts) if isinstance(artifacts, str) else artifacts)
+        # the contents of dependencies are needed to key their artifacts, even without a cache to record them in
+        artifact_digests = (digests or Digests(_snapshot, None)) if _artifacts is not None else None
+        names = {t: name for name, t in index.targets.items()}
+
+        build_stats = BuildStats()
+        start = time.perf_counter()
+        with span('resolve graph', 'graph'):
+            if graph is None:
+                graph = BuildGraph(target, index, _prefix_dir, _snapshot)
+        build_stats.resolve_seconds = time.perf_counter() - start
+        sub_makes = SubMakes.of(_snapshot, _cache, persist=True)
+        logger.debug(
+            f"Resolved {len(graph)} targets required to make {target}")
+
+        def key(node: Node) -> str:
+            "What the node's target is recorded under in the cache"
+            return str(node.target.target or names.get(node.target, ''))
+
+        def label(node: Node) -> str:
+            "What the node's target is called in the trace and stats"
+            return key(node) or target_label(node.target)
+
+        # nodes that were remade during this build
+        changed: Set[Node] = set()
+        # nodes that were remade during this build without changing their output, with restat
+        unchanged: Set[Node] = set()
+        # how long each remade node took
+        remade: Dict[Node, float] = {}
+        # nodes whose output was restored from the artifact cache rather than remade
+        restored: Set[Node] = set()
+
+        recorded = _cache.section(DURATIONS_SECTION) if _cache is not None else {}
+        critical = CriticalPath(graph, {node: recorded.get(key(node)) for node in graph.order})
+
+        for name in {node.target.executor for node in graph.order} | {executor}:
+            if name is not None and name not in EXECUTORS:
+                raise ValueError(
+                    f"Unknown executor '{name}', expected one of {list(EXECUTORS)}")
+
+        # started as they are first needed, and shut down once the build finishes unless they were given
+        keep_executors, keep_limiter = executors is not None, limiter is not None
+        executors = executors if executors is not None else {}
+        for started in executors.values():
+            started.reset()
+        limiter = limiter if limiter is not None else job_limiter(jobs, load_average)
+
+        async def remake(node: Node):
+            name = node.target.executor or executor
+            if name not in executors:
+                executors[name] = remote_executor(graph, jobs, agents) if name == 'remote' \
+                    else EXECUTORS[name](graph, jobs)
+            queued = now()
+            async with limiter.target(critical.priority(node)):
+                complete('queue', 'schedule', queued)
+                start = time.perf_counter()
+                with span('submit', 'dispatch', executor=name):
+                    made = await executors[name].remake(node, restat, enabled())
+                remade[node] = time.perf_counter() - start
+            merge(made.events)
+            if made.shell is not None:
+                build_stats.commands += made.shell.commands
+                build_stats.command_seconds += made.shell.seconds
+                build_stats.command_output_bytes += made.shell.output_bytes
+            if _cache is not None and key(node):
+                _cache.record(DURATIONS_SECTION, key(node), round(remade[node], 4))
+            return made
+
+        async def remake_or_restore(node: Node, deps_digest: Optional[str]) -> Remade:
+            "Restore the node's output from the artifact cache if it's there, or else remake it and store it"
+            if _artifacts is None or artifact_digests is None or not _artifacts.cacheable(node):
+                return await remake(node)
+            with span('restore', 'cache'):
+                artifact = _artifacts.key(node.target, deps_digest or await _deps_digest(node, artifact_digests))
+                if await _artifacts.fetch(node.target, artifact):
+                    restored.add(node)
+                    return Remade(time.time(), None)
+            made = await remake(node)
+            with span('store', 'cache'):
+                await _artifacts.store(node.target, artifact)
+            return made
+
+        try:
+            async def visit(node: Node) -> Node:
+                "Check the node's staleness and remake it if needed, within its track of the trace"
+                with target_track(node.index + 1, label(node)), span(label(node), 'target'):
+                    return await check(node)
+
+            async def check(node: Node) -> Node:
+                if only is not None and node.target not in only:
+                    build_stats.up_to_date += 1
+                    return node
+                with span('check', 'staleness'):
+                    deps_digest = await _deps_digest(node, digests) \
+                        if digest and digests is not None and node.target.target else None
+                    reason = await _staleness(
+                        node, changed, _cache, _snapshot, deps_digest, restat, unchanged)
+                if reason is None:
+                    build_stats.up_to_date += 1
+                else:
+                    logger.debug(f"Remaking {node.target}: {reason}")
+                    made = await remake_or_restore(node, deps_digest)
+                    with span('cache', 'cache'):
+                        return await record(node, made, deps_digest)
+                return node
+
+            async def record(node: Node, made: Remade, deps_digest: Optional[str]) -> Node:
+                "Record the remake of the node in the cache"
+                if node.target.target:
+                    _snapshot.invalidate(node.target.target)
+                if _cache is not None and node.target.do_cache:
+                    _cache[node.target] = made.time
+                if _cache is not None and deps_digest is not None:
+                    _cache.record(DEPS_SECTION, str(
+                        node.target.target), deps_digest)
+
+                if restat and _cache is not None and digests is not None and key(node):
+                    output = await digests.digest(node.target.target) if node.target.target \
+                        else made.result
+                    previous = _cache.section(OUTPUT_SECTION).get(key(node))
+                    _cache.record(OUTPUT_SECTION, key(node), output)
+                    if output is not None and output == previous:
+                        logger.debug(
+                            f"{node.target} is unchanged, so its dependents won't be remade on its account")
+                        unchanged.add(node)
+                        return node
+
+                if isinstance(node.target, Makefile):
+                    await sub_makes.remade(node.target)
+                changed.add(node)
+                return node
+
+            # number of each node's dependencies yet to be visited
+            waiting = {node: len(node.deps) for node in graph.order}
+            # heaviest critical path first
+            ready: List[Tuple[float, int, Node]] = [
+                (-critical.priority(node), node.index, node) for node in graph.order if not node.deps]
+            heapq.heapify(ready)
+            running: Set['asyncio.Future[Node]'] = set()
+            start = time.perf_counter()
+
+            try:
+                with limiting(limiter), shell_output(stream, log_dir):
+                    # check sub-projects concurrently, rather than as each is reached
+                    sub_makes.prefetch(node.target for node in graph.order if only is None or node.target in only)
+                    while ready or running:
+                        while ready:
+                            running.add(asyncio.ensure_future(visit(heapq.heappop(ready)[2])))
+
+                        done, running = await asyncio.wait(
+                            running, return_when=asyncio.FIRST_COMPLETED)
+                        for fut in done:
+                            for dependent in fut.result().dependents:
+                                waiting[dependent] -= 1
+                                if not waiting[dependent]:
+                                    heapq.heappush(
+                                        ready, (-critical.priority(dependent), dependent.index, dependent))
+
+                build_stats.execute_seconds = time.perf_counter() - start
+                if explain_schedule:
+                    print(explain(critical, remade, limiter.jobs, build_stats.execute_seconds,
+                                  label))
+            finally:
+                for fut in running:
+                    fut.cancel()
+                # let them give back their job slots before the limiter is closed
+                await asyncio.gather(*running, return_exceptions=True)
+                await sub_makes.close()
+
+        finally:
+            if not keep_executors:
+                for started in executors.values():
+                    started.shutdown()
+            if not keep_limiter:
+                limiter.close()
+            if limiter.held_back:
+                logger.debug(f"Held back {limiter.held_back} jobs until the load average dropped")
+            logger.debug(
+                f"Filesystem snapshot made {_snapshot.syscalls} syscalls, and saved {_snapshot.saved_syscalls}")
+            if digests is not None:
+                logger.debug(f"Hashed the contents of {digests.hashed} files")
+            if sub_makes.questioned or sub_makes.skipped:
+                logger.debug(f"Ran make -q {sub_makes.questioned} times, and skipped it {sub_makes.skipped} times")
+            if _cache is not None:
+                _cache.save()
+            _collect(build_stats, graph, {label(n): t for n, t in remade.items()}, len(restored),
+                     executors, _snapshot, _cache, digests, _artifacts)
+
+        if stats:
+            print(build_stats.summary())
+        if stats_file is not None:
+            build_stats.write(stats_file)
+        return build_stats
+
+
+def _collect(
+    build_stats: BuildStats,
+    graph: BuildGraph,
+    remade: Dict[str, float],
+    restored: int,
+    executors: Dict[str, Executor],
+    snapshot: FileSnapshot,
+    cache: Optional[TimestampCache],
+    digests: Optional[Digests],
+    artifacts: Optional['Artifacts'] = None
 ):
-    assert targets  # TODO: import from calling module
-    _targets = targets
-    _prefix_dir = Path(prefix_dir)
+    "Fill in the build's stats from the counters kept by the things it used"
+    build_stats.targets = len(graph)
+    build_stats.remade = len(remade)
+    build_stats.restored = restored
+    build_stats.slowest = sorted(remade.items(), key=lambda item: item[1], reverse=True)[:SLOWEST]
+    build_stats.files_statted = snapshot.statted
+    build_stats.globs_expanded = snapshot.globbed
+    build_stats.syscalls = snapshot.syscalls
+    build_stats.saved_syscalls = snapshot.saved_syscalls
+    if cache is not None:
+        build_stats.cache_hits = cache.hits
+        build_stats.cache_misses = cache.misses
+        build_stats.cache_bytes_written = cache.bytes_written
+    if digests is not None:
+        build_stats.files_hashed = digests.hashed
+        build_stats.hashes_reused = digests.reused
+    if artifacts is not None:
+        build_stats.artifact_hits = artifacts.hits
+        build_stats.artifact_misses = artifacts.misses
+        build_stats.artifacts_stored = artifacts.stored
+    for name, started in executors.items():
+        build_stats.executors[name] = {
+            'remakes': started.remakes,
+            'busy_seconds': started.busy,
+            'workers': started.workers,
+            'utilisation': started.utilisation(),
+        }
+
+
+def out_of_date_sync(
+    target: Target,
+    *,
+    cache: Optional[Union[TimestampCache, FilePath]] = '.pymake-cache',
+    targets: Optional[Union[Dict[str, Target], TargetIndex]] = None,
+    prefix_dir: FilePath = '',
+    digest: bool = False,
+    restat: bool = False
+) -> List[Tuple[Target, str]]:
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(out_of_date(
+        target, cache=cache, targets=targets, prefix_dir=prefix_dir, digest=digest, restat=restat))
 
+
+async def out_of_date(
+    target: Target,
+    *,
+    cache: Optional[Union[TimestampCache, FilePath]] = '.pymake-cache',
+    targets: Optional[Union[Dict[str, Target], TargetIndex]] = None,
+    prefix_dir: FilePath = '',
+    snapshot: Optional[FileSnapshot] = None,
+    digest: bool = False,
+    restat: bool = False
+) -> List[Tuple[Target, str]]:
+    """The targets that `make()` would remake to make the target, in the order it would make them, with the
+    reason that each is out-of-date. Checks staleness as make() does, but without running anything or
+    writing to the cache. The dependents of an out-of-date target are assumed to be out-of-date too, even
+    with `restat`. Groups are only out-of-date when one of their dependencies is, as they do nothing themselves.
+    """
+    assert targets
+    index = TargetIndex.of(targets)
+    _prefix_dir = Path(prefix_dir)
+    _snapshot = snapshot or FileSnapshot()
     _cache = cache if cache is None or isinstance(cache, TimestampCache) \
-        else TimestampCache(_prefix_dir / cache, targets) if targets else None
-
-    scheduled: Dict[Target, Awaitable[float]] = {}
-
-    try:
-        with ProcessPoolExecutor() as multiprocessor:
-            async def maybe_remake(target: Target) -> bool:
-                "Recursively schedule target remakes if needed, returns if the target was remade"
-                if target in scheduled:
-                    await scheduled[target]
-                    return True
-
-                if not any(target.deps):
-                    needs_remake = True
-
-                target_edited = await target.edited()
-                needs_remake = target_edited == float('inf')
-                maybe_remaking: Set[Awaitable[bool]] = set()
-                for dep in target.deps:
-                    if isinstance(dep, Path):
-                        if not dep.is_absolute():
-                            dep = _prefix_dir / dep
-
-                        try:
-                            # we use glob.iglob over dep.glob as dep.glob never follows symlinks
-                            for f in glob.iglob(str(dep)):
-                                if Path(f).stat().st_mtime > target_edited:
-                                    needs_remake = True
-                                    break
-                            continue
-                        except FileNotFoundError:
-                            dep = find_matching_target(dep, _targets)
-
-                    maybe_remaking.add(
-                        asyncio.ensure_future(maybe_remake(dep)))
-
-                if any(await asyncio.gather(*maybe_remaking)):
-                    needs_remake = True
-
-                if needs_remake:
-                    scheduled[target] = asyncio.wrap_future(
-                        multiprocessor.submit(_remake, target))
-                    time = await scheduled[target]
-                    if _cache and target.do_cache:
-                        _cache[target] = time
-                    return True
+        else TimestampCache(_prefix_dir / cache, index)
+    if (digest or restat) and _cache is None:
+        digest = restat = False
+    digests = Digests(_snapshot, _cache, persist=False) if _cache is not None else None
 
-                else:
-                    return False
-
-            await maybe_remake(target)
-
-    finally:
-        if _cache is not None:
-            _cache.save()
-
-
-def _remake(target: Target) -> float:
-    "Remake the given target, ensuring envvars and cwd is as expected. Returns the time the target was remade"
-
-    env_before = os.environ.copy()
-    os.environ.clear()
-    os.environ.update(target.env)
-
-    if not Path.cwd().samefile(target.cwd):
-        os.chdir(target.cwd)
-
-    async def process():
-        after = None
-        if target.target:
-            target_path = Path(target.target)
-            if target_path.exists():
-                before = target_path.stat().st_mtime
-                await target.make()
-                after = target_path.stat().st_mtime
-                # TODO: custom errors
-                assert after != before, "output file did not change"
-                assert after > before, "output file went back in time"
-
-        if not after:
-            await target.make()
-            after = time.time()
-        return after
-
-    try:
-        made_time = asyncio.new_event_loop() \
-            .run_until_complete(process())
-    except:
-        raise
-    finally:
-        os.environ.clear()
-        os.environ.update(env_before)
-
-    return made_time
+    graph = BuildGraph(target, index, _prefix_dir, _snapshot)
+    sub_makes = SubMakes.of(_snapshot, _cache, persist=False)
+    sub_makes.prefetch(node.target for node in graph.order)
+    stale: List[Tuple[Target, str]] = []
+    changed: Set[Node] = set()
+    for node in graph.order:
+        deps_digest = await _deps_digest(node, digests) \
+            if digest and digests is not None and node.target.target else None
+        reason = await _staleness(node, changed, _cache, _snapshot, deps_digest, restat)
+        if reason is not None and isinstance(node.target, Group) and not changed.intersection(node.deps):
+            reason = None
+        if reason is not None:
+            changed.add(node)
+            stale.append((node.target, reason))
+    return stale
+
+
+async def _staleness(
+    node: Node,
+    changed: Set[Node],
+    cache: Optional[TimestampCache],
+    snapshot: FileSnapshot,
+    deps_digest: Optional[str] = None,
+    restat: bool = False,
+    unchanged: AbstractSet[Node] = frozenset()
+) -> Optional[str]:
+    """Return the reason that the node needs to be remade, or None if it is up-to-date.
+    When deps_digest is given, file dependencies are compared by content rather than by timestamp.
+    With restat, a target is also up-to-date as of when it was last remade without touching its output,
+    and the outputs of the dependencies `unchanged` by their remakes in this build aren't compared"""
+    target = node.target
+    target_edited = await target.edited(snapshot)
+    cached = cache.lookup(target) if cache is not None else None
+    if cached is not None:
+        if target.target is None:
+            target_edited = cached
+        elif restat and target_edited != float('inf'):
+            target_edited = max(target_edited, cached)
+
+    if target_edited == float('inf'):
+        return "output is missing" if target.target \
+            else "no cache entry" if target.do_cache \
+            else "always remade"
+
+    for dep in node.deps:
+        if dep in changed:
+            return f"dependency {dep.target.target or dep.target} is out-of-date"
+
+    if deps_digest is not None:
+        assert cache is not None
+        recorded = cache.section(DEPS_SECTION).get(str(target.target))
+        if recorded is None:
+            return "no recorded digest of its dependencies"
+        if recorded != deps_digest:
+            return "contents of its dependencies changed"
+        return None
+
+    for f in node.files:
+        if snapshot.mtime(f) > target_edited:
+            return f"{f} is newer"
+
+    # the outputs of dependency targets that are up-to-date, but may have been remade or touched since
+    for dep in node.deps:
+        if dep.target.target and dep not in unchanged and snapshot.mtime(dep.target.target) > target_edited:
+            return f"{dep.target.target} is newer"
+
+    return None
+
+
+async def _deps_digest(node: Node, digests: Digests) -> str:
+    "Digest of the contents of every file the node depends upon"
+    return await digests.combined(
+        node.files + [dep.target.target for dep in node.deps if dep.target.target])
@@ -64,7 +64,7 @@ multiprocess.pool.ExceptionWithTraceback = ExceptionWithTraceback
 class ProcessPoolExecutor(_ProcessPoolExecutor):
 
     def __init__(self, max_workers: Optional[int] = None):
-        kwargs = {'nodes': max_workers} if max_workers else {}
+        kwargs = {'processes': max_workers} if max_workers else {}
         self.pool = multiprocess.pool.Pool(**kwargs)
 
     def submit(
@@ -75,11 +75,8 @@ class ProcessPoolExecutor(_ProcessPoolExecutor):
     ) -> 'Future[T]':
         fut: 'Future[T]' = Future()
 
-        def reraise(e: Exception):
-            raise e
-
         self.pool.apply_async(  # type: ignore
-            fn, args, kwargs, callback=fut.set_result, error_callback=reraise)
+            fn, args, kwargs, callback=fut.set_result, error_callback=fut.set_exception)
         fut.set_running_or_notify_cancel()
         return fut
 
@@ -0,0 +1,405 @@
+"""Remakes targets on `pymake-worker` agents over TCP, ie to spread a build over several machines that share
+its filesystem at the same paths. Start an agent on each with:
+
+    pymake-worker [HOST:]PORT [SLOTS]
+
+and build with `pymake --executor remote --agents HOST:PORT,HOST:PORT,...` (or $PYMAKE_AGENTS).
+Agents listen on localhost unless given a HOST, as they run whatever they're sent: only listen where trusted.
+"""
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+from collections import deque
+from copy import copy
+from contextvars import ContextVar
+from pathlib import Path
+import asyncio
+import pickle
+import socket
+import struct
+import time
+import sys
+import os
+
+import dill  # type: ignore
+from tblib import pickling_support  # type: ignore
+pickling_support.install()  # type: ignore
+
+from .environment import N_CPU_CORES
+from .executors import AGENTS_ENV, Executor, Remade, _dep_paths, _remake_async, _track
+from .graph import BuildGraph, Node
+from .logger import INFO, handler, logger
+from .shell import ShellOutput, current_output, target_output
+from .targets.target import Target
+from .workerpool import WorkerDiedError
+
+PROTOCOL = 1  # version of the messages between executors and agents
+DEFAULT_PORT = 7480
+HEARTBEAT = 1.0  # seconds between an agent's reports of its load
+HEARTBEAT_TIMEOUT = 30.0  # seconds without hearing from an agent before it's given up on
+CONNECT_TIMEOUT = 5.0
+RETRIES = 2  # times a target is retried on another agent after the one remaking it dies
+
+# each message is its length, then itself pickled
+_LENGTH = struct.Struct('!I')
+
+
+async def _read(reader: asyncio.StreamReader) -> Any:
+    (length,) = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+    return dill.loads(await reader.readexactly(length))
+
+
+def _write(writer: asyncio.StreamWriter, message: Tuple[Any, ...]):
+    try:
+        data = pickle.dumps(message)
+    except Exception:
+        # ie for exceptions defined in a PyMakefile
+        data = dill.dumps(message)
+    writer.write(_LENGTH.pack(len(data)) + data)
+
+
+def _address(agent: str) -> Tuple[str, int]:
+    "The host and port of `[HOST:]PORT`"
+    host, _, port = agent.strip().rpartition(':')
+    return host or '127.0.0.1', int(port or DEFAULT_PORT)
+
+
+class _Job:
+    __slots__ = ('id', 'target', 'payload', 'deps', 'restat', 'track', 'output', 'future', 'attempts', 'sent')
+
+    def __init__(self, id: int, node: Node, restat: bool, track: Optional[int], future: 'asyncio.Future[Remade]'):
+        self.id = id
+        self.target = node.target
+        # which the agent runs it in, rather than relative to the cwd of this process
+        target = copy(node.target)
+        target.cwd = target.cwd.resolve()
+        self.payload = dill.dumps(target, recurse=True)
+        self.deps = _dep_paths(node)
+        self.restat = restat
+        self.track = track
+        self.output = current_output()
+        self.future = future
+        self.attempts = 0
+        self.sent = 0  # time.monotonic_ns() when last sent to an agent
+
+
+class _Agent:
+    "An agent connected to, and the jobs it's running"
+
+    def __init__(self, name: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, hello: Dict[str, Any]):
+        self.name = name
+        self.reader = reader
+        self.writer = writer
+        self.slots: int = hello['slots']
+        self.cpus: int = hello['cpus']
+        self.load: float = hello['load']
+        self.jobs: Dict[int, _Job] = {}
+        self.task: Optional['asyncio.Future[None]'] = None
+
+    def busyness(self) -> float:
+        "How busy the agent is: its slots in use, and the load average of its host per core"
+        return len(self.jobs) / self.slots + self.load / self.cpus
+
+
+class RemoteExecutor(Executor):
+    """Remakes targets on agents (see `Agent`), given as `HOST:PORT`s or else in $PYMAKE_AGENTS.
+
+    Each target is sent to the least busy agent with a free slot, going by how many of its slots are in use
+    and the load average of its host, which agents report every `HEARTBEAT` seconds. The output and logs of
+    a target are sent back as it runs, and its result, timings and spans once it's remade. Agents need to
+    share the build's filesystem at the same paths, as targets run in their own cwds and with their own
+    envvars, as they would locally. When an agent dies or isn't heard from for `HEARTBEAT_TIMEOUT` seconds,
+    its targets are retried on the others, up to `RETRIES` times.
+    """
+
+    def __init__(self, graph: BuildGraph, max_workers: Optional[int] = None, agents: Optional[Sequence[str]] = None):
+        super().__init__(graph)
+        agents = agents or [agent for agent in os.environ.get(AGENTS_ENV, '').split(',') if agent.strip()]
+        if not agents:
+            raise ValueError(f"No agents to remake targets on. Give them with --agents or ${AGENTS_ENV}")
+        self.addresses = [_address(agent) for agent in agents]
+        self.retries = RETRIES
+        self.retried = 0
+        self._agents: List[_Agent] = []
+        self._queue: Deque[_Job] = deque()
+        self._connected: Optional['asyncio.Future[None]'] = None
+        self._next_job = 0
+
+    def submit(self, node: Node, restat: bool, trace: bool = False) -> 'asyncio.Future[Remade]':
+        job = _Job(self._next_job, node, restat, _track(node, trace), asyncio.get_event_loop().create_future())
+        self._next_job += 1
+        job.future.add_done_callback(lambda future: self._cancelled(job) if future.cancelled() else None)
+        self._queue.append(job)
+        if self._connected is None:
+            # connected to once there's something to remake, so that builds with nothing to do don't wait
+            self._connected = asyncio.ensure_future(self._connect())
+        elif self._connected.done():
+            self._dispatch()
+        return job.future
+
+    async def _connect(self):
+        agents = await asyncio.gather(*(self._open(host, port) for host, port in self.addresses),
+                                      return_exceptions=True)
+        for (host, port), agent in zip(self.addresses, agents):
+            if isinstance(agent, BaseException):
+                logger.warning(f"Couldn't connect to agent {host}:{port}: {agent!r}")
+                continue
+            assert isinstance(agent, _Agent)
+            self._agents.append(agent)
+            agent.task = asyncio.ensure_future(self._receive(agent))
+        self.workers = sum(agent.slots for agent in self._agents)
+        logger.debug(f"Connected to {len(self._agents)} agents, with {self.workers} slots")
+        if not self._agents:
+            self._fail(WorkerDiedError(f"Couldn't connect to any of the agents {self.addresses}"))
+        self._dispatch()
+
+    async def _open(self, host: str, port: int) -> _Agent:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), CONNECT_TIMEOUT)
+        kind, hello = await asyncio.wait_for(_read(reader), CONNECT_TIMEOUT)
+        if kind != 'hello' or hello['protocol'] != PROTOCOL:
+            writer.close()
+            raise ConnectionError(f"agent speaks protocol {hello.get('protocol')}, rather than {PROTOCOL}")
+        return _Agent(f"{host}:{port}", reader, writer, hello)
+
+    def _dispatch(self):
+        while self._queue:
+            free = [agent for agent in self._agents if len(agent.jobs) < agent.slots]
+            if not free:
+                return
+            job = self._queue.popleft()
+            if job.future.done():
+                continue
+            agent = min(free, key=_Agent.busyness)
+            job.sent = time.monotonic_ns()
+            _write(agent.writer, ('job', job.id, job.payload, job.deps, job.restat, job.track,
+                                  logger.getEffectiveLevel(), tuple(job.output)))
+            agent.jobs[job.id] = job
+
+    async def _receive(self, agent: _Agent):
+        "Handle the messages of the agent until it dies"
+        try:
+            while True:
+                message = await asyncio.wait_for(_read(agent.reader), HEARTBEAT_TIMEOUT)
+                kind = message[0]
+                if kind == 'status':
+                    agent.load = message[1]
+                elif kind == 'log':
+                    _, _, fd, text = message
+                    stream = sys.stdout if fd == 1 else sys.stderr
+                    stream.write(text)
+                    stream.flush()
+                elif kind == 'done':
+                    self._done(agent, *message[1:])
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+            self._lost(agent, e)
+
+    def _done(self, agent: _Agent, job_id: int, ok: bool, result: Any, received: int):
+        job = agent.jobs.pop(job_id, None)
+        if job is not None and not job.future.done():
+            if ok:
+                # the agent's clock is its own, so line its spans up with when the job was sent
+                offset = (job.sent - received) / 1000
+                result = result._replace(events=tuple({**event, 'ts': event['ts'] + offset} for event in result.events))
+                job.future.set_result(result)
+            else:
+                job.future.set_exception(result)
+        self._dispatch()
+
+    def _lost(self, agent: _Agent, error: BaseException):
+        "Retry the targets of an agent that died on the others"
+        agent.writer.close()
+        self._agents.remove(agent)
+        self.workers = sum(agent.slots for agent in self._agents)
+        logger.warning(f"Lost agent {agent.name} with {len(agent.jobs)} targets running: {error!r}")
+        for job in reversed(list(agent.jobs.values())):
+            job.attempts += 1
+            if job.future.done():
+                continue
+            if job.attempts > self.retries:
+                job.future.set_exception(WorkerDiedError(
+                    f"Agent {agent.name} died while remaking {job.target}, which was tried {job.attempts} times"))
+            else:
+                self.retried += 1
+                self._queue.appendleft(job)
+        if not self._agents:
+            self._fail(WorkerDiedError("All the agents died"))
+        self._dispatch()
+
+    def _fail(self, error: Exception):
+        "Fail the targets waiting for an agent"
+        for job in self._queue:
+            if not job.future.done():
+                job.future.set_exception(error)
+        self._queue.clear()
+
+    def _cancelled(self, job: _Job):
+        "Stop remaking a target that's no longer needed, ie by a build that `watch()` cancelled"
+        for agent in self._agents:
+            if agent.jobs.pop(job.id, None) is not None:
+                _write(agent.writer, ('cancel', job.id))
+                self._dispatch()
+                return
+
+    def shutdown(self):
+        if self._connected is not None:
+            self._connected.cancel()
+        for agent in self._agents:
+            if agent.task is not None:
+                agent.task.cancel()
+            agent.writer.close()
+        self._agents = []
+
+
+class _JobOutput:
+    "What a job writes to stdout and stderr, sent back to its build a line at a time"
+
+    def __init__(self, send: Callable[[int, str], None]):
+        self.send = send
+        self.partial = {1: '', 2: ''}
+
+    def write(self, fd: int, text: str):
+        text = self.partial[fd] + text
+        end = text.rfind('\n') + 1
+        if end:
+            self.send(fd, text[:end])
+        self.partial[fd] = text[end:]
+
+    def flush(self):
+        for fd, text in self.partial.items():
+            if text:
+                self.send(fd, text)
+            self.partial[fd] = ''
+
+
+# the output of the job in the current context
+_job_output: 'ContextVar[Optional[_JobOutput]]' = ContextVar('job_output', default=None)
+
+
+class _Forward:
+    "Stands in for stdout or stderr, sending what's written within a job to its build"
+
+    def __init__(self, stream: Any, fd: int):
+        self._stream = stream
+        self._fd = fd
+
+    def write(self, text: str) -> int:
+        output = _job_output.get()
+        if output is None:
+            return self._stream.write(text)
+        output.write(self._fd, text)
+        return len(text)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._stream, name)
+
+
+class Agent:
+    """Remakes the targets that `RemoteExecutor`s send it, up to `slots` at once, on one event loop as a
+    warm worker process does. What the targets log and print is sent back to the build that sent them,
+    rather than written here. A build disconnecting cancels its targets."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = DEFAULT_PORT, slots: int = N_CPU_CORES):
+        self.host = host
+        self.port = port
+        self.slots = slots
+        self.remade = 0
+
+    async def serve(self):
+        sys.stdout = _Forward(sys.stdout, 1)  # type: ignore
+        sys.stderr = _Forward(sys.stderr, 2)  # type: ignore
+        handler.setStream(sys.stderr)  # type: ignore
+        server = await asyncio.start_server(self._serve_build, self.host, self.port)
+        port = server.sockets[0].getsockname()[1]
+        print(f"pymake-worker listening on {self.host}:{port} with {self.slots} slots", flush=True)
+        async with server:
+            await server.serve_forever()
+
+    async def _serve_build(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        "Serve the connection of a build until it disconnects"
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        _write(writer, ('hello', {'protocol': PROTOCOL, 'slots': self.slots, 'cpus': N_CPU_CORES,
+                                  'load': _load(), 'pid': os.getpid()}))
+        running: Dict[int, 'asyncio.Task[None]'] = {}
+
+        async def heartbeat():
+            while True:
+                await asyncio.sleep(HEARTBEAT)
+                _write(writer, ('status', _load()))
+
+        beating = asyncio.ensure_future(heartbeat())
+        try:
+            while True:
+                message = await _read(reader)
+                if message[0] == 'job':
+                    job_id = message[1]
+                    task = running[job_id] = asyncio.ensure_future(self._run(writer, *message[1:]))
+
+                    def forget(_: 'asyncio.Future[None]', job_id: int = job_id):
+                        running.pop(job_id, None)
+                    task.add_done_callback(forget)
+                elif message[0] == 'cancel' and message[1] in running:
+                    running[message[1]].cancel()
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            beating.cancel()
+            for task in running.values():
+                task.cancel()
+            await asyncio.gather(beating, *running.values(), return_exceptions=True)
+            writer.close()
+
+    async def _run(self, writer: asyncio.StreamWriter, job_id: int, payload: bytes, deps: List[Path], restat: bool,
+                   track: Optional[int], level: int, output: Tuple[Any, ...]):
+        received = time.monotonic_ns()
+        logger.setLevel(level)
+        job_output = _JobOutput(lambda fd, text: _write(writer, ('log', job_id, fd, text)))
+        token = _job_output.set(job_output)
+        try:
+            target: Target = dill.loads(payload)
+            if not target.cwd.is_dir():
+                raise FileNotFoundError(
+                    f"{target.cwd} doesn't exist on agent {socket.gethostname()}:{self.port}. "
+                    "Agents need to share the build's filesystem at the same paths")
+            with target_output(ShellOutput(*output)):
+                made = await _remake_async(target, deps, restat, track=track)
+            reply: Tuple[Any, ...] = ('done', job_id, True, made, received)
+            self.remade += 1
+        except asyncio.CancelledError:
+            logger.debug(f"Job {job_id} was cancelled")
+            raise
+        except BaseException as e:
+            reply = ('done', job_id, False, e, received)
+        finally:
+            _job_output.reset(token)
+            job_output.flush()
+        try:
+            _write(writer, reply)
+        except Exception as e:
+            _write(writer, ('done', job_id, False, Exception(
+                f"Couldn't send the result of the job back from agent {os.getpid()}: {e!r}, "
+                f"result was: {reply[3]!r}"), received))
+
+
+def _load() -> float:
+    "The 1 minute load average of the host"
+    try:
+        return os.getloadavg()[0]
+    except OSError:
+        return 0.0
+
+
+def main(args: Optional[Sequence[str]] = None):
+    args = list(sys.argv[1:] if args is None else args)
+    if not args or args[0] in ('-h', '--help'):
+        sys.exit(__doc__)
+    address, slots = args + [str(N_CPU_CORES)][len(args) - 1:]
+    host, port = _address(address)
+    logger.setLevel(INFO)
+    try:
+        asyncio.run(Agent(host, port, int(slots)).serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+import heapq
+import math
+
+from .graph import BuildGraph, Node
+
+DURATIONS_SECTION = 'duration'  # cache section of how long each target took to remake when it was last made
+
+
+class CriticalPath:
+    """Priorities for scheduling a build graph, from how long each target took to remake previously.
+
+    A node's weight is the length of the longest chain of remakes from it to the end of the build,
+    including itself. Starting ready targets heaviest-first keeps long chains from starting late.
+    Targets without a recorded duration are assumed to take the average of those with one.
+    """
+
+    def __init__(self, graph: BuildGraph, durations: Mapping[Node, Optional[float]]):
+        known = [d for d in durations.values() if d is not None]
+        self.default = sum(known) / len(known) if known else 0.0
+        self.durations = durations
+        self.order = graph.order
+        self.weights = self._chain_weights(None)
+
+    def _chain_weights(self, within: Optional[Set[Node]]) -> Dict[Node, float]:
+        "Weight of each node's heaviest chain of dependents, only counting nodes within the set if given"
+        weights: Dict[Node, float] = {}
+        # dependents come after their dependencies in the topological order
+        for node in reversed(self.order):
+            if within is None or node in within:
+                weights[node] = self.duration(node) + max(
+                    (weights[d] for d in node.dependents if d in weights), default=0.0)
+        return weights
+
+    def duration(self, node: Node) -> float:
+        recorded = self.durations.get(node)
+        return self.default if recorded is None else recorded
+
+    def priority(self, node: Node) -> float:
+        return self.weights.get(node, 0.0)
+
+    def longest(self, nodes: Iterable[Node]) -> List[Node]:
+        "The heaviest chain of dependencies within nodes"
+        within = set(nodes)
+        weights = self._chain_weights(within)
+        path: List[Node] = []
+        candidates = [n for n in within if not any(dep in within for dep in n.deps)]
+        while candidates:
+            node = max(candidates, key=weights.__getitem__)
+            path.append(node)
+            candidates = [n for n in node.dependents if n in within]
+        return path
+
+    def simulate(self, nodes: Iterable[Node], slots: Optional[int]) -> float:
+        "Predicted makespan of remaking the nodes on the given number of slots, scheduling heaviest-first"
+        remaining = set(nodes)
+        waiting = {n: sum(dep in remaining for dep in n.deps) for n in remaining}
+        ready: List[Tuple[float, int, Node]] = []
+        running: List[Tuple[float, int, Node]] = []
+        order = {n: i for i, n in enumerate(self.order)}
+        capacity = math.inf if slots is None else slots
+        now = 0.0
+
+        for node in remaining:
+            if not waiting[node]:
+                heapq.heappush(ready, (-self.priority(node), order[node], node))
+
+        while ready or running:
+            while ready and len(running) < capacity:
+                _, i, node = heapq.heappop(ready)
+                heapq.heappush(running, (now + self.duration(node), i, node))
+            now, _, done = heapq.heappop(running)
+            for dependent in done.dependents:
+                if dependent in waiting:
+                    waiting[dependent] -= 1
+                    if not waiting[dependent]:
+                        heapq.heappush(ready, (-self.priority(dependent), order[dependent], dependent))
+        return now
+
+
+def explain(
+    critical: CriticalPath,
+    remade: Mapping[Node, float],
+    slots: Optional[int],
+    actual: float,
+    label: Callable[[Node], str] = repr
+) -> str:
+    "Describe how the build's actual makespan compares to the one predicted from previous builds"
+    if not remade:
+        return "Schedule: nothing was remade"
+
+    unknown = sum(critical.durations.get(node) is None for node in remade)
+    path = critical.longest(remade)
+    lines = [
+        f"Schedule: predicted makespan {critical.simulate(remade, slots):.2f}s, actual {actual:.2f}s "
+        f"({len(remade)} targets remade on {slots or 'unlimited'} slots"
+        + (f", {unknown} without a previous duration" if unknown else "") + ")",
+        f"Critical path ({sum(critical.duration(n) for n in path):.2f}s predicted, "
+        f"{sum(remade[n] for n in path):.2f}s actual):",
+    ]
+    for node in path:
+        recorded = critical.durations.get(node)
+        predicted = f"{recorded:.2f}s" if recorded is not None else "unknown"
+        lines.append(f"    {label(node)} predicted {predicted}, took {remade[node]:.2f}s")
+    return '\n'.join(lines)
@@ -1,43 +1,256 @@
 from .targets.target import FilePath
-from typing import Optional
+from typing import IO, Deque, List, NamedTuple, Optional, Sequence, Set
 from asyncio.subprocess import create_subprocess_shell, PIPE
+from asyncio import StreamReader
+from collections import deque
+from contextvars import ContextVar
 from subprocess import CalledProcessError
 from .utils import unindent
-from .logger import logger, YELLOW, RESET
-import inspect
+from .logger import logger, INFO, YELLOW, GREY, RESET
+from .environment import current_environment
+from .jobs import current_limiter, subprocess_slot
+from .trace import span
+import contextlib
+import asyncio
+import time
+import sys
+import os
+import re
+
+TAIL_LINES = 50  # lines of each of stdout and stderr kept for the message of a ShellExecError
+CHUNK_SIZE = 1 << 16
+MAX_LINE = 1 << 16  # longer lines are split, so that a line without a newline can't be buffered forever
+
+
+class ShellOutput(NamedTuple):
+    "How the output of `sh()` is handled during a build, see `shell_output`"
+    stream: bool = False
+    log_dir: Optional[str] = None
+
+
+# how the build in progress handles output, which forked worker processes inherit
+_output = ShellOutput()
+# overrides `_output` in the current context, ie for the target of a build that a remote agent is remaking
+_context_output: 'ContextVar[Optional[ShellOutput]]' = ContextVar('shell_output', default=None)
+# name of the target being made in the current context, to prefix its output and name its log file
+_label: 'ContextVar[Optional[str]]' = ContextVar('shell_label', default=None)
+# the log files written to so far while making the target in the current context
+_logged: 'ContextVar[Optional[Set[str]]]' = ContextVar('shell_logged', default=None)
+
+
+class ShellStats:
+    "Counts of the commands run by `sh()` within `counting_commands`"
+
+    __slots__ = ('commands', 'seconds', 'output_bytes')
+
+    def __init__(self):
+        self.commands = 0
+        self.seconds = 0.0
+        self.output_bytes = 0
+
+
+_counts: 'ContextVar[Optional[ShellStats]]' = ContextVar('shell_counts', default=None)
+
+
+@contextlib.contextmanager
+def shell_output(stream: bool = False, log_dir: Optional[FilePath] = None):
+    "Set whether `sh()` streams output by default, and the directory to tee each target's output into"
+    global _output
+    previous, _output = _output, ShellOutput(stream, str(log_dir) if log_dir else None)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    try:
+        yield
+    finally:
+        _output = previous
+
+
+def current_output() -> ShellOutput:
+    "How `sh()` handles output in the current context"
+    return _context_output.get() or _output
+
+
+@contextlib.contextmanager
+def target_output(output: ShellOutput):
+    "Handle the output of `sh()` in the current context as given, rather than as the build in this process does"
+    token = _context_output.set(output)
+    try:
+        yield
+    finally:
+        _context_output.reset(token)
+
+
+@contextlib.contextmanager
+def counting_commands():
+    "Count the commands run by `sh()` in the current context, in the `ShellStats` yielded"
+    counts = ShellStats()
+    token = _counts.set(counts)
+    try:
+        yield counts
+    finally:
+        _counts.reset(token)
+
+
+@contextlib.contextmanager
+def output_label(label: str):
+    "Prefix the streamed output of `sh()` in the current context with the label, and name its log file after it"
+    token, logged = _label.set(label), _logged.set(set())
+    try:
+        yield
+    finally:
+        _label.reset(token)
+        _logged.reset(logged)
+
+
+class _Caller(NamedTuple):
+    "Where sh() was called from, in place of the `inspect.FrameInfo` that the log formatter accepts"
+    filename: str
+    lineno: int
+    function: str
 
 
 async def sh(
     script: str,
     cwd: FilePath = '.',
-    silent: bool = False
+    silent: bool = False,
+    stream: Optional[bool] = None
 ) -> Optional[bytes]:
-    # TODO: print to terminal
+    """Run the script in a shell, raising a ShellExecError if it fails. Returns its stdout, if it printed any.
+
+    With `stream` (by default, that of the build), output is logged line by line as it arrives and isn't kept
+    in memory, so nothing is returned. Either way only the last `TAIL_LINES` lines of stdout and stderr are
+    kept for the error, and the whole output is also written to the target's log file if the build has a
+    `log_dir`.
+    """
     script = unindent(script.strip())
-    if not silent:
-        frame = inspect.stack()[1]
+    stream = current_output().stream if stream is None else stream
+    label = _label.get()
+    caller: Optional[_Caller] = None
+    if not silent and logger.isEnabledFor(INFO):
+        frame = sys._getframe(1)
+        caller = _Caller(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
         maybe_newline = "\n" if "\n" in script else ""
         script_fmted = f'{maybe_newline}{YELLOW}{script}{RESET}'
-        logger.info(f'Running {script_fmted}', extra=dict(frame=frame))
-
-    process = await create_subprocess_shell(
-        unindent(script),
-        cwd=cwd,
-        stderr=PIPE, stdout=PIPE
-    )
-    stdout, stderr = await process.communicate()
-    assert process.returncode is not None
-    if process.returncode != 0:
-        raise ShellExecError(process.returncode, script,
-                             stdout.decode(), stderr.decode())
-
-    if not silent:
+        logger.info(f'Running {script_fmted}', extra=dict(frame=caller))
+
+    # run relative to the cwd and with the envvars of the target being made
+    target_cwd, env = current_environment()
+    # let any make run by the script share the build's jobs
+    limiter = current_limiter()
+    pass_fds: Sequence[int] = ()
+    if limiter is not None and limiter.has_jobserver:
+        env = {**(env if env is not None else os.environ)}
+        env['MAKEFLAGS'] = limiter.makeflags(env.get('MAKEFLAGS', ''))
+        pass_fds = limiter.pass_fds
+
+    stdout_tail: Deque[bytes] = deque(maxlen=TAIL_LINES)
+    stderr_tail: Deque[bytes] = deque(maxlen=TAIL_LINES)
+    captured: Optional[List[bytes]] = None if stream else []
+    prefix = f'{GREY}[{label}]{RESET} ' if label else ''
+    log_to = caller if stream else None
+
+    with _log_file(label) as log:
+        if log is not None:
+            log.write(f'$ {script}\n'.encode())
+        async with subprocess_slot():
+            with span('sh', 'shell', script=script):
+                start = time.perf_counter()
+                process = await create_subprocess_shell(
+                    script,
+                    cwd=os.path.join(target_cwd, cwd) if target_cwd else cwd,
+                    env=env,
+                    pass_fds=pass_fds,
+                    stderr=PIPE, stdout=PIPE
+                )
+                assert process.stdout is not None and process.stderr is not None
+                try:
+                    output_bytes = sum(await asyncio.gather(
+                        _pump(process.stdout, stdout_tail, captured, log, prefix, log_to),
+                        _pump(process.stderr, stderr_tail, None, log, prefix, log_to),
+                    ))
+                    returncode = await process.wait()
+                except asyncio.CancelledError:
+                    # the build no longer needs it, ie it was cancelled by `watch()`
+                    if process.returncode is None:
+                        process.kill()
+                    raise
+
+    counts = _counts.get()
+    if counts is not None:
+        counts.commands += 1
+        counts.seconds += time.perf_counter() - start
+        counts.output_bytes += output_bytes
+
+    if returncode != 0:
+        raise ShellExecError(returncode, script,
+                             b'\n'.join(stdout_tail).decode(errors='replace'),
+                             b'\n'.join(stderr_tail).decode(errors='replace'))
+
+    stdout = b''.join(captured) if captured is not None else b''
+    if caller is not None and not stream:
         output = (
-            f'Finished {script_fmted}:\n{stdout.decode().strip()}'  # type: ignore # nopep8
+            f'Finished {script_fmted}:\n{stdout.decode(errors="replace").strip()}'  # type: ignore # nopep8
         ).replace('\n', '\n  >> ')
-        logger.info(output, extra=dict(frame=frame))  # type: ignore
+        logger.info(output, extra=dict(frame=caller))
     return stdout if any(stdout) else None
 
 
+async def _pump(
+    reader: StreamReader,
+    tail: Deque[bytes],
+    captured: Optional[List[bytes]],
+    log: Optional[IO[bytes]],
+    prefix: str,
+    log_to: Optional[_Caller]
+) -> int:
+    "Read a pipe until it closes, passing each chunk and line on as it arrives. Returns the bytes read"
+    partial = b''
+    size = 0
+    while True:
+        chunk = await reader.read(CHUNK_SIZE)
+        size += len(chunk)
+        if captured is not None:
+            captured.append(chunk)
+        if log is not None:
+            log.write(chunk)
+
+        lines = (partial + chunk).split(b'\n')
+        partial = lines.pop() if chunk else b''
+        if len(partial) > MAX_LINE:
+            lines.append(partial)
+            partial = b''
+        for line in lines:
+            if not chunk and not line:
+                continue
+            tail.append(line)
+            if log_to is not None:
+                text = line.decode(errors='replace').rstrip('\r')
+                logger.info(f'{prefix}{text}', extra=dict(frame=log_to))
+        if not chunk:
+            return size
+
+
+@contextlib.contextmanager
+def _log_file(label: Optional[str]):
+    "The target's log file in the build's log_dir, truncated by the first of its commands and appended to by the rest"
+    log_dir = current_output().log_dir
+    if log_dir is None or label is None:
+        yield None
+        return
+    name = re.sub(r'[^\w.-]+', '_', label).strip('_') or 'target'
+    path = os.path.join(log_dir, f'{name}.log')
+    logged = _logged.get()
+    mode = 'ab' if logged is None or path in logged else 'wb'
+    if logged is not None:
+        logged.add(path)
+    with open(path, mode) as f:
+        yield f
+
+
 class ShellExecError(CalledProcessError):
-    pass
+    def __str__(self) -> str:
+        message = super().__str__()
+        for name, tail in (('stdout', self.output), ('stderr', self.stderr)):
+            if tail:
+                message += f"\n{name} (last {TAIL_LINES} lines):\n  " + tail.replace('\n', '\n  ')
+        return message
@@ -0,0 +1,191 @@
+from typing import Dict, List, Optional, Set, Tuple
+from fnmatch import fnmatch
+import glob
+import os
+
+from .targets.target import FilePath
+
+Listing = Dict[str, bool]  # name -> is_dir
+
+
+class FileSnapshot:
+    """A build-scoped view of the filesystem, shared by everything that checks staleness during a build.
+
+    Each directory is listed at most once (with `os.scandir`), and `stat` results and glob expansions are
+    cached until `invalidate` is called for a path that a target has written.
+    `syscalls` counts the filesystem calls actually made and `saved_syscalls` those answered from the cache,
+    of which `statted` were stats and `globbed` glob patterns expanded.
+    Globs follow `glob.glob`, except that `**` matches any number of directories.
+    """
+
+    def __init__(self, cwd: Optional[FilePath] = None):
+        self.cwd = os.path.abspath(cwd or os.getcwd())
+        self.syscalls = 0
+        self.saved_syscalls = 0
+        self.statted = 0
+        self.globbed = 0
+        self._stats: Dict[str, Optional[os.stat_result]] = {}
+        self._listings: Dict[str, Optional[Listing]] = {}
+        # pattern -> (matches, directories listed to expand it)
+        self._globs: Dict[str, Tuple[List[str], Set[str]]] = {}
+        # directory -> patterns whose expansion listed it
+        self._globs_by_dir: Dict[str, Set[str]] = {}
+
+    def abspath(self, path: FilePath) -> str:
+        "The normalised absolute path that entries are cached under"
+        return os.path.normpath(os.path.join(self.cwd, path))
+
+    def stat(self, path: FilePath) -> Optional[os.stat_result]:
+        "Cached `os.stat`, following symlinks. Returns None if the path doesn't exist"
+        key = self.abspath(path)
+        try:
+            result = self._stats[key]
+            self.saved_syscalls += 1
+            return result
+        except KeyError:
+            pass
+
+        self.syscalls += 1
+        self.statted += 1
+        try:
+            result = os.stat(key)
+        except (FileNotFoundError, NotADirectoryError):
+            result = None
+        self._stats[key] = result
+        return result
+
+    def mtime(self, path: FilePath) -> float:
+        "Modification time of the path, or float('inf') if it doesn't exist"
+        result = self.stat(path)
+        return float('inf') if result is None else result.st_mtime
+
+    def listdir(self, directory: FilePath) -> Optional[Listing]:
+        "Cached directory listing of {name: is_dir}, or None if it isn't a directory"
+        key = self.abspath(directory)
+        try:
+            listing = self._listings[key]
+            self.saved_syscalls += 1
+            return listing
+        except KeyError:
+            pass
+
+        self.syscalls += 1
+        try:
+            with os.scandir(key) as entries:
+                listing = {entry.name: _is_dir(entry) for entry in entries}
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            listing = None
+        self._listings[key] = listing
+        return listing
+
+    def glob(self, pattern: FilePath) -> List[str]:
+        "Cached, sorted expansion of the glob pattern"
+        pattern = str(pattern)
+        cached = self._globs.get(pattern)
+        if cached is not None:
+            self.saved_syscalls += len(cached[1])
+            return cached[0]
+
+        self.globbed += 1
+        listed: Set[str] = set()
+        matches = sorted(self._expand(pattern, listed))
+        self._globs[pattern] = (matches, listed)
+        for directory in listed:
+            self._globs_by_dir.setdefault(directory, set()).add(pattern)
+        return matches
+
+    def _expand(self, pattern: str, listed: Set[str]) -> List[str]:
+        drive, rest = os.path.splitdrive(pattern)
+        root = drive + os.sep if os.path.isabs(pattern) else drive
+        parts = [part for part in rest.split(os.sep) if part]
+
+        # paths matched so far, formatted as glob.glob would return them
+        candidates: List[str] = [root]
+        for i, part in enumerate(parts):
+            last = i == len(parts) - 1
+            found: List[str] = []
+            for base in candidates:
+                listing = self._listing_for(base, listed)
+                if listing is None:
+                    continue
+
+                if part == '**':
+                    found.extend(self._walk(base, listed, include_files=last))
+                elif glob.has_magic(part):
+                    hidden_ok = part.startswith('.')
+                    found.extend(
+                        os.path.join(base, name) for name, is_dir in listing.items()
+                        if (is_dir or last) and (hidden_ok or not name.startswith('.')) and fnmatch(name, part))
+                elif part in ('.', '..') or (part in listing and (listing[part] or last)):
+                    found.append(os.path.join(base, part))
+            candidates = found
+
+        return [c for c in candidates if c]
+
+    def _listing_for(self, base: str, listed: Set[str]) -> Optional[Listing]:
+        directory = self.abspath(base or '.')
+        listed.add(directory)
+        return self.listdir(directory)
+
+    def _walk(self, base: str, listed: Set[str], include_files: bool) -> List[str]:
+        "Everything below base (and base itself), as matched by '**'"
+        found: List[str] = [base]
+        stack = [base]
+        while stack:
+            directory = stack.pop()
+            listing = self._listing_for(directory, listed) or {}
+            for name, is_dir in listing.items():
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(directory, name)
+                if is_dir:
+                    found.append(path)
+                    stack.append(path)
+                elif include_files:
+                    found.append(path)
+        return found
+
+    def listed(self) -> List[str]:
+        "The directories listed to expand the cached globs, whose entries changing would change their matches"
+        return list(self._globs_by_dir)
+
+    def invalidate(self, path: FilePath):
+        "Forget everything cached about a path after it has been written to"
+        key = self.abspath(path)
+        self._stats.pop(key, None)
+
+        if key in self._listings:
+            # the target may have written anything below this directory too
+            prefix = key + os.sep
+            for cached in [k for k in self._stats if k.startswith(prefix)]:
+                del self._stats[cached]
+            for cached in [k for k in self._listings if k.startswith(prefix)]:
+                self._forget_listing(cached)
+            self._forget_listing(key)
+
+        # forget the listings of any ancestors that the path (or one of its parents) just appeared in
+        child, parent = key, os.path.dirname(key)
+        while parent != child:
+            if parent in self._listings:
+                listing = self._listings[parent]
+                if listing is not None and os.path.basename(child) in listing:
+                    break
+                self._stats.pop(parent, None)
+                self._forget_listing(parent)
+            child, parent = parent, os.path.dirname(parent)
+
+    def _forget_listing(self, directory: str):
+        self._listings.pop(directory, None)
+        self._forget_globs(directory)
+
+    def _forget_globs(self, directory: str):
+        for pattern in self._globs_by_dir.pop(directory, ()):
+            self._globs.pop(pattern, None)
+
+
+def _is_dir(entry: 'os.DirEntry[str]') -> bool:
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
@@ -0,0 +1,129 @@
+from typing import Any, Dict, List, Optional, Tuple
+import json
+
+from .targets.target import FilePath
+
+SLOWEST = 10  # number of the slowest targets reported
+
+
+class BuildStats:
+    """Totals of a build, from the counters kept by make(), the cache, the filesystem snapshot, `sh()` and
+    the executors. Printed by `summary()`, and written for CI by `write()` as JSON or a Prometheus textfile"""
+
+    def __init__(self):
+        self.targets = 0
+        self.up_to_date = 0
+        self.remade = 0
+        self.restored = 0  # from the artifact cache, rather than remade
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_bytes_written = 0
+        self.files_hashed = 0
+        self.hashes_reused = 0
+        self.artifact_hits = 0
+        self.artifact_misses = 0
+        self.artifacts_stored = 0
+        self.files_statted = 0
+        self.globs_expanded = 0
+        self.syscalls = 0
+        self.saved_syscalls = 0
+        self.commands = 0
+        self.command_seconds = 0.0
+        self.command_output_bytes = 0
+        self.resolve_seconds = 0.0
+        self.execute_seconds = 0.0
+        # executor name -> {'remakes', 'busy_seconds', 'workers', 'utilisation'}
+        self.executors: Dict[str, Dict[str, Any]] = {}
+        # (target, seconds), slowest first
+        self.slowest: List[Tuple[str, float]] = []
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            **{k: v for k, v in vars(self).items() if k not in ('executors', 'slowest')},
+            'executors': self.executors,
+            'slowest': [{'target': target, 'seconds': seconds} for target, seconds in self.slowest],
+        }
+
+    def summary(self) -> str:
+        lines = [
+            f"Targets: {self.targets} considered, {self.up_to_date} up to date, {self.remade} remade, "
+            f"{self.restored} restored",
+            f"Cache: {self.cache_hits} hits, {self.cache_misses} misses, {self.cache_bytes_written} bytes written; "
+            f"{self.files_hashed} files hashed, {self.hashes_reused} hashes reused",
+            f"Artifacts: {self.artifact_hits} restored, {self.artifact_misses} missed, {self.artifacts_stored} stored",
+            f"Filesystem: {self.files_statted} files statted, {self.globs_expanded} globs expanded, "
+            f"{self.syscalls} syscalls ({self.saved_syscalls} saved)",
+            f"Time: {self.resolve_seconds:.3f}s resolving the graph, {self.execute_seconds:.3f}s executing",
+            f"Commands: {self.commands} run for {self.command_seconds:.3f}s, "
+            f"{self.command_output_bytes} bytes of output",
+        ]
+        for name, executor in self.executors.items():
+            utilisation = executor['utilisation']
+            lines.append(
+                f"Executor {name}: {executor['remakes']} targets, busy {executor['busy_seconds']:.3f}s"
+                + (f" on {executor['workers']} workers ({utilisation:.0%} utilised)" if utilisation is not None
+                   else ""))
+        if self.slowest:
+            lines.append("Slowest targets:")
+            lines.extend(f"    {seconds:8.3f}s {target}" for target, seconds in self.slowest)
+        return '\n'.join(lines)
+
+    def prometheus(self) -> str:
+        "The stats in the Prometheus text exposition format, ie for node_exporter's textfile collector"
+        metrics: Dict[str, Tuple[str, List[Tuple[Dict[str, str], float]]]] = {
+            'pymake_targets': ("Targets of the build by state", [
+                ({'state': 'considered'}, self.targets),
+                ({'state': 'up_to_date'}, self.up_to_date),
+                ({'state': 'remade'}, self.remade),
+                ({'state': 'restored'}, self.restored)]),
+            'pymake_cache_lookups': ("Timestamp cache lookups by result", [
+                ({'result': 'hit'}, self.cache_hits),
+                ({'result': 'miss'}, self.cache_misses)]),
+            'pymake_cache_bytes_written': ("Bytes written to the cache file", [({}, self.cache_bytes_written)]),
+            'pymake_file_digests': ("File content digests by whether the file was hashed", [
+                ({'source': 'hashed'}, self.files_hashed),
+                ({'source': 'reused'}, self.hashes_reused)]),
+            'pymake_artifacts': ("Outputs of targets restored from, missed in and stored in the artifact cache", [
+                ({'result': 'hit'}, self.artifact_hits),
+                ({'result': 'miss'}, self.artifact_misses),
+                ({'result': 'stored'}, self.artifacts_stored)]),
+            'pymake_files_statted': ("Files statted", [({}, self.files_statted)]),
+            'pymake_globs_expanded': ("Glob patterns expanded", [({}, self.globs_expanded)]),
+            'pymake_syscalls': ("Filesystem calls, and those saved by the snapshot", [
+                ({'cached': 'false'}, self.syscalls),
+                ({'cached': 'true'}, self.saved_syscalls)]),
+            'pymake_phase_seconds': ("Seconds spent in each phase of the build", [
+                ({'phase': 'resolve'}, self.resolve_seconds),
+                ({'phase': 'execute'}, self.execute_seconds)]),
+            'pymake_commands': ("Shell commands run", [({}, self.commands)]),
+            'pymake_command_seconds': ("Seconds spent running shell commands", [({}, self.command_seconds)]),
+            'pymake_command_output_bytes': ("Bytes output by shell commands", [({}, self.command_output_bytes)]),
+            'pymake_executor_remakes': ("Targets remade by each executor", [
+                ({'executor': name}, e['remakes']) for name, e in self.executors.items()]),
+            'pymake_executor_busy_seconds': ("Seconds each executor spent remaking targets", [
+                ({'executor': name}, e['busy_seconds']) for name, e in self.executors.items()]),
+            'pymake_executor_utilisation': ("Busy seconds per worker second of each executor", [
+                ({'executor': name}, e['utilisation']) for name, e in self.executors.items()
+                if e['utilisation'] is not None]),
+            'pymake_target_seconds': (f"Seconds taken by the {SLOWEST} slowest targets", [
+                ({'target': target}, seconds) for target, seconds in self.slowest]),
+        }
+        lines: List[str] = []
+        for name, (help, samples) in metrics.items():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+            for labels, value in samples:
+                label_str = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: FilePath):
+        "Write the stats to path, as a Prometheus textfile if it ends in '.prom' or else as JSON"
+        with open(path, 'w') as f:
+            if str(path).endswith('.prom'):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.as_dict(), f, indent=2)
+
+
+def _escape(value: Optional[str]) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
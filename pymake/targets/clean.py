@@ -7,7 +7,7 @@ if TYPE_CHECKING:
 
 class Clean(Target):
     def __init__(self, targets: Iterable[Target]):
-        super().__init__(None, [])
+        super().__init__(None, [], cwd='.')
         self.targets = targets
     
     async def make(self, cache: 'TimestampCache'): # type: ignore
@@ -5,15 +5,18 @@ if TYPE_CHECKING:
     from ..context import Context
 
 class Fn(Target):
+    __slots__ = ('fn',)
+
     def __init__(
         self,
         target: Optional[Union[str, FilePath]],
         deps: Depends,
         fn: Callable[..., Awaitable[Any]],
         do_cache: bool = True,
+        executor: Optional[str] = None
     ):
-        super().__init__(target, deps, do_cache)
+        super().__init__(target, deps, do_cache, executor=executor)
         self.fn = fn
 
     async def make(self, ctx: 'Context'): # type: ignore
-        await ctx.inject_and_run(self.fn)
\ No newline at end of file
+        return await ctx.inject_and_run(self.fn)
\ No newline at end of file
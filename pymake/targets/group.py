@@ -2,9 +2,11 @@ from .target import Target, Dependencies
 
 
 class Group(Target):
+    __slots__ = ()
 
     def __init__(self, deps: Dependencies, do_cache: bool = False):
-        super().__init__(None, deps, do_cache=do_cache)
+        # nothing to run, so don't bother sending it to a worker
+        super().__init__(None, deps, do_cache=do_cache, executor='inline')
 
     async def make(self):
         pass
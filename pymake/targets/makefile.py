@@ -1,12 +1,30 @@
-from typing import Dict, Optional
+from typing import Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING
+from weakref import WeakKeyDictionary
 from pathlib import Path
+import asyncio
+import hashlib
+import time
+import os
 from ..shell import sh, ShellExecError
 
 from .target import FilePath, Target, Depends
 from ..environment import N_CPU_CORES
+from ..jobs import current_limiter
+if TYPE_CHECKING:
+    from ..cache import TimestampCache
+    from ..snapshot import FileSnapshot
 
 
 class Makefile(Target):
+    """Runs a target of a (GNU) Makefile, which is up-to-date when `make -q` says so.
+
+    With `fingerprint`, `make -q` is skipped when no file under the directory changed since the last time
+    the target was made or found up-to-date, which trusts that make only depends on files under it.
+    """
+
+    __slots__ = ('directory', 'make_target', 'makefile', 'vars', 'n_workers', 'exe', 'clean_target',
+                 'fingerprint')
+
     def __init__(
         self,
         directory: FilePath,
@@ -17,41 +35,170 @@ class Makefile(Target):
         extra_deps: Depends = [],
         n_workers: int = N_CPU_CORES,
         exe: FilePath = "make",
-        clean_target: str = 'clean'
+        clean_target: str = 'clean',
+        fingerprint: bool = False
     ):
-        super().__init__(None, extra_deps, do_cache=False)
-        self.directory = self.srcdir / directory
-        self.target = target
-        self.makefile = self.srcdir / makefile
+        # make does the work in its own processes, so only await it from the event loop
+        super().__init__(None, extra_deps, do_cache=False, executor='inline')
+        self.directory = self.cwd / directory
+        # the make target to run. Not `self.target`, as that's the output file of a pymake target
+        self.make_target = target
+        self.makefile = self.cwd / makefile
         self.vars = vars
         self.deps.insert(0, Path(directory) / makefile)
         self.n_workers = n_workers
         self.exe = exe
         self.clean_target = clean_target
+        self.fingerprint = fingerprint
 
     async def make(self):
-        await self._execute(self.target or "", silent=False)
+        await self._execute(self.make_target or "", silent=False)
 
     async def clean(self):
         await self._execute(self.clean_target, silent=False)
 
-    async def edited(self) -> float:
+    async def edited(self, snapshot: Optional['FileSnapshot'] = None) -> float:
+        if snapshot is not None:
+            up_to_date = await SubMakes.of(snapshot).up_to_date(self)
+        else:
+            up_to_date = await self.question()
+        # when up-to-date, it is as of now, ie newer than its dependencies
+        return time.time() if up_to_date else float('inf')
+
+    async def question(self) -> bool:
+        "Whether the target is up-to-date, by `make -q`"
         try:
-            # check if Makefile target is up-to-date
             # https://www.gnu.org/software/make/manual/html_node/Instead-of-Execution.html#Instead-of-Execution
-            await self._execute(f"-q {self.target or ''}", silent=True)
-            return 0  # target was up-to-date
-
+            await self._execute(f"-q {self.make_target or ''}", silent=True)
+            return True
         except ShellExecError:
-            return float('inf')  # target was not up-to-date
+            return False
+
+    def key(self) -> str:
+        "Identifies the make invocation, by everything that affects whether it's up-to-date"
+        makefile_vars = ' '.join(f'{name}={item}' for name, item in sorted(self.vars.items()))
+        return f"{self.exe} -f {self.makefile} -C {self.directory} {self.make_target or ''} {makefile_vars}".strip()
 
     async def _execute(self, target: str, silent: bool):
         makefile_vars = ' '.join(
             f'{name}={item}' for name, item in self.vars.items())
+        # with a jobserver, sh() has make share the build's jobs, which an explicit -j would opt out of
+        limiter = current_limiter()
+        jobs = '' if limiter is not None and limiter.has_jobserver else f'-j{self.n_workers}'
         await sh(
-            f"{self.exe} --directory={self.directory} -j{self.n_workers} {target} {makefile_vars}",
+            f"{self.exe} --directory={self.directory} {jobs} {target} {makefile_vars}",
             silent=silent
         )
 
     # def __repr__(self) -> str:
     #     return f"{self.__class__.__name__}({self.directory}/{self.makefile})"
+
+
+class SubMakes:
+    """The `make -q` checks of the Makefile targets of a build, memoised by `Makefile.key()` for the build.
+
+    Builds are told apart by their `FileSnapshot`. `prefetch` starts the checks of several Makefiles at once,
+    so that independent sub-projects are checked concurrently, rather than as each is visited.
+    With a cache, the fingerprint of the files under a `Makefile(fingerprint=True)`'s directory is recorded
+    whenever it's made or found up-to-date, and `make -q` is skipped while it's unchanged.
+    """
+
+    SECTION = 'makefile'  # cache section of the fingerprint of each Makefile's directory
+
+    _builds: 'WeakKeyDictionary[FileSnapshot, SubMakes]' = WeakKeyDictionary()
+
+    def __init__(self, cache: Optional['TimestampCache'] = None, persist: bool = True):
+        self.cache = cache
+        self.persist = persist
+        self.questioned = 0  # times make -q was run
+        self.skipped = 0  # times it wasn't, as the fingerprint was unchanged
+        self._checks: Dict[str, 'asyncio.Future[bool]'] = {}
+
+    @classmethod
+    def of(
+        cls,
+        snapshot: 'FileSnapshot',
+        cache: Optional['TimestampCache'] = None,
+        persist: Optional[bool] = None
+    ) -> 'SubMakes':
+        """The checks of the build using the snapshot. Without persist, fingerprints aren't recorded in the cache.
+        The snapshot may outlive a build (ie in the daemon), so persist applies from now on when given"""
+        sub_makes = cls._builds.get(snapshot)
+        if sub_makes is None:
+            sub_makes = cls._builds[snapshot] = cls(cache, persist is None or persist)
+        elif persist is not None:
+            sub_makes.persist = persist
+        return sub_makes
+
+    def prefetch(self, targets: Iterable[Target]):
+        "Start checking all of the Makefiles among the targets"
+        for target in targets:
+            if isinstance(target, Makefile):
+                self.up_to_date(target)
+
+    def up_to_date(self, makefile: Makefile) -> 'asyncio.Future[bool]':
+        key = makefile.key()
+        check = self._checks.get(key)
+        if check is None:
+            check = self._checks[key] = asyncio.ensure_future(self._check(makefile))
+        return check
+
+    async def _check(self, makefile: Makefile) -> bool:
+        fingerprint = None
+        if makefile.fingerprint and self.cache is not None:
+            recorded = self.cache.section(self.SECTION).get(makefile.key())
+            if recorded is not None:
+                fingerprint = await _fingerprint(makefile.directory)
+                if fingerprint == recorded:
+                    self.skipped += 1
+                    return True
+
+        self.questioned += 1
+        up_to_date = await makefile.question()
+        if up_to_date:
+            await self._record(makefile, fingerprint)
+        return up_to_date
+
+    async def remade(self, makefile: Makefile):
+        "Forget the check of a Makefile that was just made, and record its fingerprint as of the build"
+        self.forget(makefile)
+        await self._record(makefile)
+
+    def forget(self, makefile: Makefile):
+        "Forget the check of a Makefile, ie after a file under its directory changed"
+        self._checks.pop(makefile.key(), None)
+
+    async def _record(self, makefile: Makefile, fingerprint: Optional[str] = None):
+        if makefile.fingerprint and self.cache is not None and self.persist:
+            self.cache.record(self.SECTION, makefile.key(), fingerprint or await _fingerprint(makefile.directory))
+
+    async def close(self):
+        "Cancel the checks still running, ie when the build failed"
+        pending = [check for check in self._checks.values() if not check.done()]
+        for check in pending:
+            check.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def _fingerprint(directory: Path) -> str:
+    "Digest of the path, size and modification time of every file under the directory"
+    return await asyncio.get_event_loop().run_in_executor(None, _walk_fingerprint, str(directory))
+
+
+def _walk_fingerprint(directory: str) -> str:
+    entries: List[Tuple[str, int, int]] = []
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        st = entry.stat(follow_symlinks=False)
+                        entries.append((entry.path, st.st_size, st.st_mtime_ns))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+    entries.sort()
+    return hashlib.blake2b(repr(entries).encode(), digest_size=20).hexdigest()
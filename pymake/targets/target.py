@@ -1,15 +1,18 @@
 from typing import Iterable, List, Union, Optional, TypeVar, TYPE_CHECKING
 from pathlib import Path
+from types import FrameType
 from abc import ABC, abstractmethod
 from copy import copy
+import functools
 import shutil
-import inspect
-import os
+import sys
 import re
+from ..environment import environ_snapshot
 from ..logger import BLUE, RESET
 
 if TYPE_CHECKING:
     from ..cache import TimestampCache
+    from ..snapshot import FileSnapshot
 
 Dependencies = List[Union[Path, 'Target']]  # stored dependencies
 
@@ -21,14 +24,19 @@ Self = TypeVar('Self', bound='Target')
 
 
 class Target(ABC):
-    "A target with any number of dependencies"
+    """A target with any number of dependencies.
+    Slotted, as generated PyMakefiles may define hundreds of thousands of them. Subclasses that don't
+    declare `__slots__` themselves still get a `__dict__` for their attributes"""
+
+    __slots__ = ('cwd', 'target', 'deps', 'do_cache', 'env', 'executor')
 
     def __init__(
         self,
         target: Optional[Union[str, FilePath]],
         deps: Depends,
         do_cache: bool = True,
-        cwd: Optional[FilePath] = None
+        cwd: Optional[FilePath] = None,
+        executor: Optional[str] = None
     ):
         if isinstance(target, str):
             assert not any(c in target for c in ' \t\n'), \
@@ -43,24 +51,29 @@ class Target(ABC):
         else:
             # Look through pymakefile for the flag that says we're a makefile
             # this should be imported with `from pymake import *`
+            # Walks the raw frames, as `inspect.stack()` reads the source of every frame on the stack
 
-            for frame in inspect.stack():
-                if frame.frame.f_globals.get('__FLAG_IS_PYMAKEFILE__'):
-                    self.cwd = Path(frame.filename).parent
+            frame: Optional[FrameType] = sys._getframe(1)
+            while frame is not None:
+                if frame.f_globals.get('__FLAG_IS_PYMAKEFILE__'):
+                    self.cwd = _makefile_dir(frame.f_code.co_filename)
                     break
+                frame = frame.f_back
             else:
                 raise Exception(
                     "Couldn't find cwd where this target is defined.\n"
                     "In your PyMakefile, either define `__FLAG_IS_PYMAKEFILE__ = True`,\n"
                     "OR import it from pymake (ie `from pymake import __FLAG_IS_MAKEFILE__` or `from pymake import *`)")
 
-        self.target = target if target else None
+        self.target = (sys.intern(target) if isinstance(target, str) else target) if target else None
         self.deps: Dependencies = \
-            [Path(deps)] if isinstance(deps, str) \
+            [_dep_path(deps)] if isinstance(deps, str) \
             else [deps] if isinstance(deps, (Path, Target)) \
-            else [Path(src) if isinstance(src, str) else src for src in deps]
+            else [_dep_path(src) if isinstance(src, str) else src for src in deps]
         self.do_cache = do_cache and any(self.deps)
-        self.env = os.environ.copy()
+        self.env = environ_snapshot()
+        # name of the executor to remake this with, see `make()`. None uses the build's default
+        self.executor = executor
 
     @abstractmethod
     async def make(self):
@@ -79,12 +92,15 @@ class Target(ABC):
         else:
             cache.pop(self, None)
 
-    async def edited(self) -> float:
+    async def edited(self, snapshot: Optional['FileSnapshot'] = None) -> float:
         "Return POSIX timestamp at which this was last edited. Should return float('inf') if unable to tell."
         if self.target is None:
             return float('inf')
 
         assert not self.has_wildcard()
+        if snapshot is not None:
+            return snapshot.mtime(self.target)
+
         target_path = Path(self.target)
         try:
             return target_path.stat().st_mtime
@@ -93,9 +109,10 @@ class Target(ABC):
 
     def matches(self, query: 're.Pattern[str]') -> Optional[str]:
         if self.target:
-            match = re.match(query, str(self.cwd / self.target))
-            if match:
-                return match.string
+            for name in (str(self.target), str(self.cwd / self.target)):
+                match = re.fullmatch(query, name)
+                if match:
+                    return match.string
 
     def has_wildcard(self) -> bool:
         return self.target is not None and '%' in str(self.target)
@@ -107,14 +124,27 @@ class Target(ABC):
                 f"Attempted to replace '%' with '{request}' for target {self}, but the target has no '%' in its target or any of its dependencies")
 
         new = copy(self)
+        new.env = self.env.copy()
         new.target = str(new.target).replace('%', str(request)) \
             if new.target else None
         new.deps = [
             (dep(request) if dep.has_wildcard() else dep) if isinstance(dep, Target)
-            else Path(str(dep).replace('%', str(request)))
+            else _dep_path(str(dep).replace('%', str(request)))
             for dep in new.deps
         ]
         return new
 
     def __repr__(self) -> str:
         return f"{BLUE}{self.__class__.__name__}({RESET}{self.target or ''}{BLUE}){RESET}"
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _dep_path(dep: str) -> Path:
+    "Dependencies named by the same string share one (immutable) `Path`, ie the headers most targets include"
+    return Path(dep)
+
+
+@functools.lru_cache(maxsize=None)
+def _makefile_dir(filename: str) -> Path:
+    "The directory of a PyMakefile, which paths in its targets are relative to"
+    return Path(filename).parent
@@ -1,44 +1,157 @@
 import re
-from typing import Set, Dict
+import os
+from typing import Dict, List, Optional, Set, Tuple, Union
 from .target import FilePath, Target
 
-match_cache: Dict[str, Target] = {}
 
-
-def find_matching_target(request: FilePath, targets: Dict[str, Target]) -> Target:
+class _TrieNode:
+    __slots__ = ('children', 'suffixes')
+
+    def __init__(self):
+        self.children: Dict[str, '_TrieNode'] = {}
+        # suffix -> pattern targets with the prefix leading to this node
+        self.suffixes: Dict[str, List[Target]] = {}
+
+
+class TargetIndex:
+    """Resolves requests (target names or output paths) to the targets of a PyMakefile, built once per build.
+
+    Names and the outputs of plain targets are looked up by hashing. Pattern targets (whose output contains
+    a `%`) are kept in a trie of the text before their `%`, with the text after it hashed at each node,
+    so a lookup costs time in the length of the request rather than the number of targets. As with GNU
+    make, the pattern with the shortest (non-empty) stem wins, and is instantiated for it with `target(stem)`.
+    Requests containing a `*` glob fall back to scanning every target.
+    Resolutions are memoised, so each request resolves to the same `Target` instance for as long as the index lives.
+    """
+
+    def __init__(self, targets: Dict[str, Target]):
+        self.targets = targets
+        self._outputs: Dict[str, List[Target]] = {}
+        self._patterns = _TrieNode()
+        self._memo: Dict[str, Optional[Target]] = {}
+        # the pattern target that each target instantiated by a lookup came from
+        self._rules: Dict[Target, Target] = {}
+
+        for target in dict.fromkeys(targets.values()):
+            if not target.target:
+                continue
+            for output in _forms(target):
+                if target.has_wildcard():
+                    prefix, suffix = output.split('%', 1)
+                    node = self._patterns
+                    for char in prefix:
+                        node = node.children.setdefault(char, _TrieNode())
+                    targets_with_suffix = node.suffixes.setdefault(suffix, [])
+                    if target not in targets_with_suffix:
+                        targets_with_suffix.append(target)
+                else:
+                    outputs = self._outputs.setdefault(output, [])
+                    if target not in outputs:
+                        outputs.append(target)
+
+    @classmethod
+    def of(cls, targets: Union[Dict[str, Target], 'TargetIndex']) -> 'TargetIndex':
+        return targets if isinstance(targets, TargetIndex) else cls(targets)
+
+    def rule(self, target: Target) -> Optional[Target]:
+        "The pattern target that the target was instantiated from, or None if it wasn't"
+        return self._rules.get(target)
+
+    def find(self, request: FilePath) -> Target:
+        "The target that the request names or that makes it. Raises NoTargetMatchError if there isn't one"
+        req_str = str(request)
+        try:
+            found = self._memo[req_str]
+        except KeyError:
+            found = self._memo[req_str] = self._resolve(req_str)
+        if found is None:
+            # TODO: levenshtein debugging assistance
+            raise NoTargetMatchError(
+                f"No target matches the request '{req_str}'")
+        return found
+
+    def _resolve(self, req_str: str) -> Optional[Target]:
+        if req_str in self.targets:
+            return self.targets[req_str]
+        if '*' in req_str:
+            return _scan(req_str, self.targets)
+
+        path = os.path.normpath(req_str)
+        outputs = self._outputs.get(path)
+        if outputs:
+            if len(outputs) > 1:
+                raise MultipleTargetsMatchError(
+                    f'Multiple target match the request "{req_str}": {outputs[0]} and {outputs[1]}')
+            return outputs[0]
+        return self._match_pattern(req_str, path)
+
+    def _match_pattern(self, req_str: str, path: str) -> Optional[Target]:
+        # (stem, pattern target) for each pattern that matches
+        matches: List[Tuple[str, Target]] = []
+        node: Optional[_TrieNode] = self._patterns
+        depth = 0
+        while node is not None:
+            if node.suffixes:
+                rest = path[depth:]
+                if len(node.suffixes) <= len(rest):
+                    candidates = ((s, node.suffixes[s]) for s in node.suffixes
+                                  if len(s) < len(rest) and rest.endswith(s))
+                else:
+                    # fewer possible suffixes of the request than patterns here, so look those up instead
+                    candidates = ((rest[i:], node.suffixes[rest[i:]]) for i in range(1, len(rest) + 1)
+                                  if rest[i:] in node.suffixes)
+                for suffix, targets in candidates:
+                    stem = rest[:len(rest) - len(suffix)]
+                    matches.extend((stem, target) for target in targets)
+            if depth == len(path):
+                break
+            node = node.children.get(path[depth])
+            depth += 1
+
+        if not matches:
+            return None
+        shortest = min(len(stem) for stem, _ in matches)
+        best = list(dict.fromkeys(
+            (stem, target) for stem, target in matches if len(stem) == shortest))
+        if len({target for _, target in best}) > 1:
+            raise MultipleTargetsMatchError(
+                f'Multiple target match the request "{req_str}": {best[0][1]} and {best[1][1]}')
+        stem, target = best[0]
+        instance = target(stem)
+        self._rules[instance] = target
+        return instance
+
+
+def _forms(target: Target) -> List[str]:
+    "The paths that a target's output may be requested by: as given, under its cwd, and absolute"
+    output = str(target.target)
+    under_cwd = os.path.join(target.cwd, output)
+    return list(dict.fromkeys(
+        [os.path.normpath(output), os.path.normpath(under_cwd), os.path.abspath(under_cwd)]))
+
+
+def _scan(req_str: str, targets: Dict[str, Target]) -> Optional[Target]:
+    "Match a glob request against every target in turn"
     matching: Set[Target] = set()
-    checked: Set[Target] = set()
-
-    req_str = str(request)
-    if req_str in match_cache:
-        return match_cache[req_str]
-    elif req_str in targets:
-        return targets[req_str]
-
     req_pat = re.compile(req_str
                          # TODO: ensure that this is actually a dir, even when at the end
                          .replace("**", r"\w*")
                          .replace("*", r"\w*"))
 
-    for target in targets.values():
-        if not target in checked:
-            if target.matches(req_pat):
-                if any(matching):
-                    raise MultipleTargetsMatchError(
-                        f'Multiple target match the request "{req_str}": {matching.pop()} and {target}'
-                    )
-
-                matching.add(target)
+    for target in dict.fromkeys(targets.values()):
+        if target.matches(req_pat):
+            if any(matching):
+                raise MultipleTargetsMatchError(
+                    f'Multiple target match the request "{req_str}": {matching.pop()} and {target}'
+                )
+            matching.add(target)
 
-            checked.add(target)
+    return matching.pop() if matching else None
 
-    if not any(matching):
-        # TODO: levenshtein debugging assistance
-        raise NoTargetMatchError(
-            f"No target matches the request '{req_str}'")
 
-    match_cache[req_str] = found = matching.pop()
-    return found
+def find_matching_target(request: FilePath, targets: Union[Dict[str, Target], TargetIndex]) -> Target:
+    "Resolve the request with the index. Given a plain dict of targets, builds a throwaway index for it"
+    return TargetIndex.of(targets).find(request)
 
 
 class NoTargetMatchError(Exception):
@@ -0,0 +1,144 @@
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+from contextvars import ContextVar
+import contextlib
+import json
+import os
+import time
+
+from .targets.target import FilePath
+
+Event = Dict[str, Any]
+
+BUILD_TRACK = 0  # track of the spans that aren't part of any one target
+
+# the build being traced, if any
+_tracer: Optional['Tracer'] = None
+# the track of the target being made in the current context
+_track: 'ContextVar[int]' = ContextVar('trace_track', default=BUILD_TRACK)
+# while remaking a target in its executor, the spans to send back to make() along with the result
+_collected: 'ContextVar[Optional[List[Event]]]' = ContextVar('trace_collected', default=None)
+
+_NO_SPAN = contextlib.nullcontext()
+
+
+class Tracer:
+    """The spans of a build, written in the Chrome Trace Event format read by Perfetto and chrome://tracing.
+
+    Each target gets its own track (a 'thread' of the trace), in make()'s process and in the process of
+    whichever worker remade it. Timestamps are from the monotonic clock, which workers share with make().
+    """
+
+    def __init__(self):
+        self.events: List[Event] = []
+        self.tracks: Dict[int, str] = {BUILD_TRACK: 'build'}
+
+    def write(self, path: FilePath):
+        pid = os.getpid()
+        metadata: List[Event] = []
+        for process in sorted({e['pid'] for e in self.events} | {pid}):
+            name = 'pymake' if process == pid else f'pymake worker {process}'
+            metadata.append(_metadata('process_name', process, 0, name))
+            for track in sorted({e['tid'] for e in self.events if e['pid'] == process}):
+                metadata.append(_metadata('thread_name', process, track, self.tracks.get(track, str(track))))
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+def _metadata(name: str, pid: int, tid: int, value: str) -> Event:
+    return {'name': name, 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': value}}
+
+
+@contextlib.contextmanager
+def tracing(path: Optional[FilePath]):
+    "Trace the build within the context, writing the trace to path on exit. Does nothing if path is None"
+    global _tracer
+    if path is None:
+        yield None
+        return
+    previous, _tracer = _tracer, Tracer()
+    tracer = _tracer
+    try:
+        yield tracer
+    finally:
+        _tracer = previous
+        tracer.write(path)
+
+
+def enabled() -> bool:
+    return _tracer is not None or _collected.get() is not None
+
+
+def now() -> int:
+    "Start of a span to be recorded with `complete()`"
+    return time.monotonic_ns()
+
+
+def complete(name: str, cat: str, start: int, track: Optional[int] = None, **args: Any):
+    "Record a span from `start` until now, in the current target's track unless given another"
+    events = _collected.get()
+    if events is None:
+        if _tracer is None:
+            return
+        events = _tracer.events
+    event: Event = {
+        'name': name, 'cat': cat, 'ph': 'X',
+        'ts': start / 1000, 'dur': (time.monotonic_ns() - start) / 1000,
+        'pid': os.getpid(), 'tid': _track.get() if track is None else track,
+    }
+    if args:
+        event['args'] = args
+    events.append(event)
+
+
+def span(name: str, cat: str, track: Optional[int] = None, **args: Any):
+    "Context manager recording a span of its body, if the build is being traced"
+    if _tracer is None and _collected.get() is None:
+        return _NO_SPAN
+    return _span(name, cat, track, args)
+
+
+@contextlib.contextmanager
+def _span(name: str, cat: str, track: Optional[int], args: Dict[str, Any]):
+    start = now()
+    try:
+        yield
+    finally:
+        complete(name, cat, start, track, **args)
+
+
+def current_track() -> int:
+    return _track.get()
+
+
+@contextlib.contextmanager
+def target_track(track: int, name: str):
+    "Record the spans within the context in the track of a target"
+    if _tracer is not None:
+        _tracer.tracks[track] = name
+    token = _track.set(track)
+    try:
+        yield
+    finally:
+        _track.reset(token)
+
+
+@contextlib.contextmanager
+def collecting(track: Optional[int]) -> Iterator[List[Event]]:
+    """In a target's executor, collect the spans of its remake in its track, to send back to make().
+    Collects nothing if track is None, ie when the build isn't traced"""
+    events: List[Event] = []
+    if track is None:
+        yield events
+        return
+    tokens = _track.set(track), _collected.set(events)
+    try:
+        yield events
+    finally:
+        _collected.reset(tokens[1])
+        _track.reset(tokens[0])
+
+
+def merge(events: Iterable[Event]):
+    "Add the spans sent back by an executor to the build's trace"
+    if _tracer is not None:
+        _tracer.events.extend(events)
@@ -0,0 +1,520 @@
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
+from pathlib import Path
+import ctypes
+import ctypes.util
+import asyncio
+import struct
+import errno
+import time
+import os
+
+from .cache import TimestampCache
+from .graph import BuildGraph, DependencyCycleError, Node
+from .logger import logger, GREY, RESET
+from .make import make
+from .snapshot import FileSnapshot
+from .targets.makefile import Makefile, SubMakes, _walk_fingerprint
+from .targets.target import FilePath, Target
+from .targets.wildcard import NoTargetMatchError, TargetIndex
+
+DEBOUNCE = 0.1  # seconds to wait for a burst of changes to end before rebuilding
+POLL_INTERVAL = 0.5  # seconds between the scans of the polling watcher
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+_ENTRIES = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | _ENTRIES | IN_ONLYDIR
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len, followed by the name
+
+
+class Changes:
+    "A batch of changes to the watched paths"
+
+    __slots__ = ('paths', 'directories', 'overflowed')
+
+    def __init__(self):
+        # files modified, created or deleted, and paths under the watched trees
+        self.paths: Set[str] = set()
+        # directories whose entries were added or removed
+        self.directories: Set[str] = set()
+        # whether events were lost, so that anything may have changed
+        self.overflowed = False
+
+    def __bool__(self) -> bool:
+        return bool(self.paths or self.directories or self.overflowed)
+
+
+class Watcher:
+    """Watches files for changes, directories for entries being added or removed, and whole trees for
+    changes to anything under them. `changes()` returns them in batches, once none have arrived for
+    `debounce` seconds, so that a burst of writes (ie a save, or a `git checkout`) is one rebuild"""
+
+    def __init__(self, debounce: float = DEBOUNCE):
+        self.debounce = debounce
+        self.files: Set[str] = set()
+        self.directories: Set[str] = set()
+        self.trees: Set[str] = set()
+        self._changes = Changes()
+        self._changed = asyncio.Event()
+
+    def watch(self, files: Iterable[str], directories: Iterable[str], trees: Iterable[str] = ()):
+        "Watch these paths (all absolute) instead of those watched before"
+        self.files, self.directories, self.trees = set(files), set(directories), set(trees)
+
+    async def changes(self) -> Changes:
+        while True:
+            await self._changed.wait()
+            while True:
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), self.debounce)
+                except asyncio.TimeoutError:
+                    break
+            changes, self._changes = self._changes, Changes()
+            if changes:
+                return changes
+
+    def in_tree(self, path: str) -> bool:
+        parent = path
+        while True:
+            if parent in self.trees:
+                return True
+            parent, child = os.path.dirname(parent), parent
+            if parent == child:
+                return False
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(Watcher):
+    """Watches with Linux's inotify (through ctypes, so without dependencies), by the directories that
+    contain the paths. Raises OSError where inotify isn't available, or when out of watches"""
+
+    def __init__(self, debounce: float = DEBOUNCE):
+        super().__init__(debounce)
+        self._libc = _libc()
+        self._fd: int = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise _error("inotify_init1")
+        self._watches: Dict[str, int] = {}  # directory -> watch descriptor
+        self._by_wd: Dict[int, str] = {}
+        # existing ancestors watched in place of directories that don't exist yet
+        self._ancestors: Set[str] = set()
+        self._loop = asyncio.get_event_loop()
+        self._loop.add_reader(self._fd, self._read)
+
+    def watch(self, files: Iterable[str], directories: Iterable[str], trees: Iterable[str] = ()):
+        super().watch(files, directories, trees)
+        wanted = self.directories | {os.path.dirname(f) for f in self.files}
+        for tree in self.trees:
+            wanted.update(root for root, _, _ in os.walk(tree))
+
+        self._ancestors = set()
+        watched: Set[str] = set()
+        for directory in wanted:
+            # watch the closest ancestor that exists, to notice the directory being created
+            while not self._add(directory):
+                parent = os.path.dirname(directory)
+                if parent == directory:
+                    break
+                directory = parent
+                self._ancestors.add(directory)
+            watched.add(directory)
+
+        for directory in set(self._watches) - watched:
+            self._libc.inotify_rm_watch(self._fd, self._watches.pop(directory))
+
+    def _add(self, directory: str) -> bool:
+        "Watch the directory, returning False if it doesn't exist"
+        if directory in self._watches:
+            return True
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _MASK)
+        if wd < 0:
+            if ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return False
+            raise _error(f"inotify_add_watch {directory}")
+        self._watches[directory] = wd
+        self._by_wd[wd] = directory
+        return True
+
+    def pending(self) -> Changes:
+        """The changes so far, without waiting for any more. As the kernel queues the events as the changes
+        are made, that's every change made before the call"""
+        self._read()
+        changes, self._changes = self._changes, Changes()
+        self._changed.clear()
+        return changes
+
+    def _read(self):
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            self._parse(data)
+        if self._changes:
+            self._changed.set()
+
+    def _parse(self, data: bytes):
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].split(b'\0', 1)[0])
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self._changes.overflowed = True
+                continue
+            directory = self._by_wd.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                # the directory was removed, and its watch with it
+                del self._by_wd[wd]
+                if self._watches.get(directory) == wd:
+                    del self._watches[directory]
+                continue
+
+            path = os.path.join(directory, name) if name else directory
+            if path in self.files or self.in_tree(path):
+                self._changes.paths.add(path)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and self.in_tree(path):
+                    for root, _, _ in os.walk(path):
+                        self._add(root)
+            if mask & _ENTRIES and (directory in self.directories or directory in self._ancestors):
+                self._changes.directories.add(directory)
+
+    def close(self):
+        self._loop.remove_reader(self._fd)
+        os.close(self._fd)
+
+
+class PollingWatcher(Watcher):
+    """Watches by scanning the paths every `interval` seconds, in a thread: the size and modification time
+    of files, the entries of directories, and a fingerprint of the files under trees"""
+
+    def __init__(self, debounce: float = DEBOUNCE, interval: float = POLL_INTERVAL):
+        super().__init__(debounce)
+        self.interval = interval
+        # (kind, path) -> what it was when last scanned
+        self._seen: Dict[Tuple[str, str], Any] = {}
+        self._task = asyncio.ensure_future(self._poll())
+
+    def watch(self, files: Iterable[str], directories: Iterable[str], trees: Iterable[str] = ()):
+        super().watch(files, directories, trees)
+        keys = [('file', f) for f in self.files] + [('dir', d) for d in self.directories] \
+            + [('tree', t) for t in self.trees]
+        # keep what was seen of the paths watched before, so that changes since the last scan aren't lost
+        self._seen = {key: self._seen[key] if key in self._seen else _scan(*key) for key in keys}
+
+    async def _poll(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            keys = list(self._seen)
+            now = await loop.run_in_executor(None, lambda: [_scan(*key) for key in keys])
+            for key, state in zip(keys, now):
+                if key not in self._seen or self._seen[key] == state:
+                    continue
+                self._seen[key] = state
+                kind, path = key
+                if kind == 'dir':
+                    self._changes.directories.add(path)
+                else:
+                    self._changes.paths.add(path)
+            if self._changes:
+                self._changed.set()
+
+    def close(self):
+        self._task.cancel()
+
+
+def watcher(debounce: float = DEBOUNCE, poll: bool = False) -> Watcher:
+    "An inotify watcher, or where that isn't available (or with `poll`), a polling one"
+    if not poll:
+        try:
+            return InotifyWatcher(debounce)
+        except OSError as e:
+            logger.info(f"Can't watch with inotify, so polling for changes instead: {e}")
+    return PollingWatcher(debounce)
+
+
+def _libc() -> Any:
+    name = ctypes.util.find_library('c')
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch, libc.inotify_rm_watch
+    except (OSError, AttributeError) as e:
+        raise OSError(f"inotify isn't available: {e}")
+    return libc
+
+
+def _error(call: str) -> OSError:
+    code = ctypes.get_errno()
+    return OSError(code, f"{call}: {os.strerror(code)}")
+
+
+def _scan(kind: str, path: str) -> Any:
+    try:
+        if kind == 'file':
+            stat = os.stat(path)
+            return stat.st_size, stat.st_mtime_ns
+        if kind == 'dir':
+            return frozenset(os.listdir(path))
+        return _walk_fingerprint(path)
+    except OSError:
+        return None
+
+
+class Watched:
+    "The paths that a build depends upon, and the nodes that depend on each"
+
+    def __init__(self, graph: Optional[BuildGraph], snapshot: FileSnapshot, makefile: Optional[str]):
+        self.files: Dict[str, List[Node]] = {}
+        self.outputs: Dict[str, Node] = {}
+        self.trees: Dict[str, Node] = {}
+        # globs can't match anything new without an entry being added to one of these
+        self.directories = set(snapshot.listed())
+        if graph is not None:
+            for node in graph.order:
+                for path in node.files:
+                    self.files.setdefault(snapshot.abspath(path), []).append(node)
+                if node.target.target:
+                    self.outputs[snapshot.abspath(node.target.target)] = node
+                if isinstance(node.target, Makefile):
+                    self.trees[os.path.abspath(node.target.directory)] = node
+        self.makefile = makefile
+
+    def watch(self, watcher: Watcher):
+        files = set(self.files) | set(self.outputs)
+        if self.makefile is not None:
+            files.add(self.makefile)
+        watcher.watch(files, self.directories, self.trees)
+
+
+async def watch(
+    target: Target,
+    *,
+    cache: Optional[Union[TimestampCache, FilePath]] = '.pymake-cache',
+    targets: Optional[Union[Dict[str, Target], TargetIndex]] = None,
+    prefix_dir: FilePath = '',
+    makefile: Optional[FilePath] = None,
+    debounce: float = DEBOUNCE,
+    poll: bool = False,
+    **options: Any
+):
+    """Make the target, then remake it whenever the files it depends upon change, until cancelled or
+    the `makefile` changes (so that it can be reloaded). `options` are passed on to `make()`.
+
+    The graph, the filesystem snapshot and the cache stay in memory between builds. The dependency files
+    of the graph, the outputs of its targets, the directories listed by its globs and the directories of
+    its `Makefile`s are watched, with inotify where it's available, or else (or with `poll`) by polling.
+    Each batch of changes (see `Watcher`) invalidates only the changed paths in the snapshot, and only the
+    targets that depend on them, and their dependents, are checked by the next build. When entries are
+    added to or removed from a globbed directory, the graph is resolved again, which reuses the rest of
+    the snapshot. A target's output only counts as changed when it's deleted, as that's all that'd make it
+    out-of-date. If a change affects targets of the build in progress, that build is cancelled (killing
+    its `sh()` subprocesses on the event loop) and another started, rather than waiting for it to finish.
+    """
+    index = TargetIndex.of(targets or {})
+    _prefix_dir = Path(prefix_dir)
+    _cache = cache if cache is None or isinstance(cache, TimestampCache) \
+        else TimestampCache(_prefix_dir / cache, index)
+    _makefile = os.path.abspath(makefile) if makefile is not None else None
+    build = _WatchedBuild(target, index, _prefix_dir, _cache)
+    _watcher = watcher(debounce, poll)
+    changes = asyncio.ensure_future(_watcher.changes())
+
+    def rewatch():
+        nonlocal _watcher, changes
+        watched = Watched(build.graph, build.snapshot, _makefile)
+        try:
+            watched.watch(_watcher)
+        except OSError as e:
+            logger.warning(f"Can't watch with inotify, so polling for changes instead: {e}")
+            _watcher.close()
+            changes.cancel()
+            _watcher = PollingWatcher(debounce)
+            watched.watch(_watcher)
+            changes = asyncio.ensure_future(_watcher.changes())
+        return watched
+
+    running: Optional['asyncio.Future[Any]'] = None
+    try:
+        while True:
+            watched = rewatch()
+            running = None
+            only = build.pending
+            if build.graph is not None and (only is None or only):
+                build.pending = set()
+                start = time.perf_counter()
+                running = asyncio.ensure_future(make(
+                    target, cache=_cache, targets=index, prefix_dir=_prefix_dir, snapshot=build.snapshot,
+                    graph=build.graph, only=only, **options))
+
+            while running is None or not running.done():
+                await asyncio.wait([f for f in (running, changes) if f is not None],
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not changes.done():
+                    continue
+                batch = changes.result()
+                changes = asyncio.ensure_future(_watcher.changes())
+                if _makefile is not None and _makefile in batch.paths:
+                    logger.info(f"{_makefile} changed")
+                    if running is not None:
+                        running.cancel()
+                        await asyncio.gather(running, return_exceptions=True)
+                    return
+
+                affected = build.changed(batch, watched)
+                if running is None:
+                    if build.pending is None or build.pending:
+                        break
+                    continue
+                if affected is None or affected and (only is None or not affected.isdisjoint(only)):
+                    logger.info("Cancelling the build, as its targets are affected by changes")
+                    running.cancel()
+                    await asyncio.gather(running, return_exceptions=True)
+                    build.retry(only)
+
+            if running is None or running.cancelled():
+                continue
+            try:
+                stats = running.result()
+                print(f"{GREY}Remade {stats.remade} of {stats.targets} targets in "
+                      f"{time.perf_counter() - start:.3f}s. Watching for changes...{RESET}")
+            except Exception as e:
+                logger.error(f"Build failed: {e}")
+                build.failed(only)
+                print(f"{GREY}Watching for changes...{RESET}")
+    finally:
+        if running is not None and not running.done():
+            running.cancel()
+            await asyncio.gather(running, return_exceptions=True)
+        changes.cancel()
+        _watcher.close()
+        if _cache is not None:
+            _cache.save()
+
+
+def watch_sync(target: Target, **kwargs: Any):
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(watch(target, **kwargs))
+
+
+class _WatchedBuild:
+    "What `watch()` keeps between builds, and the targets each change affects"
+
+    def __init__(self, target: Target, index: TargetIndex, prefix_dir: Path, cache: Optional[TimestampCache]):
+        self.target = target
+        self.index = index
+        self.prefix_dir = prefix_dir
+        self.cache = cache
+        self.snapshot = FileSnapshot()
+        self.graph = self._resolve()
+        # the targets to check in the next build, or None for all of them
+        self.pending: Optional[Set[Target]] = None
+        # the targets of a failed build, to check again once anything changes
+        self._failed: Optional[Set[Target]] = set()
+
+    def _resolve(self) -> Optional[BuildGraph]:
+        try:
+            return BuildGraph(self.target, self.index, self.prefix_dir, self.snapshot)
+        except (NoTargetMatchError, DependencyCycleError) as e:
+            logger.error(f"{e}")
+            return None
+
+    def retry(self, targets: Optional[Set[Target]]):
+        "Check the targets again in the next build, ie as it was cancelled"
+        self.pending = None if targets is None or self.pending is None else self.pending | targets
+
+    def failed(self, targets: Optional[Set[Target]]):
+        self._failed = None if targets is None or self._failed is None else self._failed | targets
+
+    def changed(self, changes: Changes, watched: Watched) -> Optional[Set[Target]]:
+        """Forget what changed, and add the targets that it affects to `pending`. Returns those that a build
+        in progress would have to check again, or None for all of them. That excludes the `Makefile`s whose
+        directories changed, as they change while being made"""
+        sub_makes = SubMakes.of(self.snapshot, self.cache)
+        seeds: Set[Node] = set()
+        makefiles: Set[Node] = set()
+        if changes.overflowed:
+            logger.info("Lost track of changes, so checking everything")
+            self.snapshot = FileSnapshot()
+            self.graph = None
+        else:
+            for path in changes.paths | changes.directories:
+                self.snapshot.invalidate(path)
+            for path in changes.paths:
+                seeds.update(watched.files.get(path, ()))
+                output = watched.outputs.get(path)
+                if output is not None and self.snapshot.stat(path) is None:
+                    seeds.add(output)
+                for tree, node in watched.trees.items():
+                    if path == tree or path.startswith(tree + os.sep):
+                        assert isinstance(node.target, Makefile)
+                        sub_makes.forget(node.target)
+                        makefiles.add(node)
+
+        old = self.graph
+        if changes.directories or old is None:
+            self.graph = self._resolve()
+            if old is not None and self.graph is not None:
+                seeds = _renode(seeds, self.graph)
+                makefiles = _renode(makefiles, self.graph)
+                seeds.update(node for node in self.graph.order if _edges_changed(node, old))
+            else:
+                self.pending = None
+        if self.pending is None or self.graph is None:
+            return None
+
+        affected = _downstream(seeds)
+        queued = affected | _downstream(makefiles)
+        if queued:
+            failed, self._failed = self._failed, set()
+            if failed is None:
+                self.pending = None
+                return None
+            queued |= failed
+        self.pending |= queued
+        return affected
+
+
+def _renode(nodes: Iterable[Node], graph: BuildGraph) -> Set[Node]:
+    "The nodes of the same targets in another graph"
+    return {graph.nodes[node.target] for node in nodes if node.target in graph.nodes}
+
+
+def _edges_changed(node: Node, old: BuildGraph) -> bool:
+    "Whether the node's dependencies differ from those of its target in the old graph"
+    before = old.nodes.get(node.target)
+    return before is None or before.files != node.files \
+        or [dep.target for dep in before.deps] != [dep.target for dep in node.deps]
+
+
+def _downstream(seeds: Iterable[Node]) -> Set[Target]:
+    "The targets of the nodes and all of their dependents"
+    seen = set(seeds)
+    stack = list(seen)
+    while stack:
+        for dependent in stack.pop().dependents:
+            if dependent not in seen:
+                seen.add(dependent)
+                stack.append(dependent)
+    return {node.target for node in seen}
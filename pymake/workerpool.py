@@ -0,0 +1,242 @@
+from typing import Any, Awaitable, Callable, Deque, Dict, Generic, List, Optional, Sequence, Set, Tuple, TypeVar
+from multiprocessing.connection import Connection
+from collections import deque
+import multiprocessing
+import asyncio
+import pickle
+import os
+
+import dill  # type: ignore
+from tblib import pickling_support  # type: ignore
+pickling_support.install()  # type: ignore
+
+from .environment import N_CPU_CORES
+from .logger import logger
+from .trace import complete, current_track, now, span
+
+Item = TypeVar('Item')
+Job = Callable[..., Awaitable[Any]]
+
+
+class WarmWorkerPool(Generic[Item]):
+    """A pool of worker processes forked once, after the items they work on (ie the build graph) are loaded.
+
+    Since the workers inherit the items when they are forked, a job only needs to send the item's index.
+    Each worker runs `job(item, *args)` on a single long-lived event loop, and so can progress up to
+    `jobs_per_worker` async jobs at once. Items that weren't known when the pool started are sent pickled.
+    The workers are only forked once the first job is submitted, so that builds with nothing to do don't
+    pay for them. Requires the 'fork' start method, see `WarmWorkerPool.supported()`.
+    """
+
+    def __init__(
+        self,
+        items: Sequence[Item],
+        job: Job,
+        max_workers: Optional[int] = None,
+        jobs_per_worker: int = 4
+    ):
+        self.items = list(items)
+        self.ids = {item: i for i, item in enumerate(self.items)}
+        self.job = job
+        self.max_workers = max_workers or N_CPU_CORES
+        self.jobs_per_worker = jobs_per_worker
+        self.jobs_sent = 0
+        self.bytes_sent = 0
+
+        self._workers: List['_Worker'] = []
+        self._started = False
+        self._next_job = 0
+        self._queue: Deque[Tuple[int, Any, Tuple[Any, ...]]] = deque()
+        # trace track of each job, as jobs are sent and received outside of the context that submitted them
+        self._tracks: Dict[int, int] = {}
+        self._futures: Dict[int, 'asyncio.Future[Any]'] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @staticmethod
+    def supported() -> bool:
+        return 'fork' in multiprocessing.get_all_start_methods()
+
+    def _start(self):
+        context = multiprocessing.get_context('fork')
+        for _ in range(self.max_workers):
+            conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=_serve, args=(child_conn, self.items, self.job), daemon=True)
+            process.start()
+            child_conn.close()
+            self._workers.append(_Worker(process, conn))
+        self._started = True
+        logger.debug(f"Forked {len(self._workers)} warm workers")
+
+    def _attach(self):
+        "Listen for results on the running event loop"
+        if not self._started:
+            self._start()
+        loop = asyncio.get_event_loop()
+        if self._loop is loop:
+            return
+        if self._loop is not None:
+            self._detach()
+        self._loop = loop
+        for worker in self._workers:
+            loop.add_reader(worker.conn.fileno(), self._receive, worker)
+
+    def _detach(self):
+        if self._loop is not None and not self._loop.is_closed():
+            for worker in self._workers:
+                self._loop.remove_reader(worker.conn.fileno())
+        self._loop = None
+
+    def submit(self, item: Item, *args: Any) -> 'asyncio.Future[Any]':
+        "Run the job for the item on the least busy worker, returning a future of its result"
+        self._attach()
+        assert self._loop is not None
+        job_id = self._next_job
+        self._next_job += 1
+        fut = self._futures[job_id] = self._loop.create_future()
+        self._tracks[job_id] = current_track()
+
+        ref = self.ids.get(item)
+        self._queue.append((job_id, ref if ref is not None else dill.dumps(item), args))
+        self._dispatch()
+        return fut
+
+    def _dispatch(self):
+        while self._queue:
+            worker = min(self._workers, key=lambda w: len(w.jobs))
+            if len(worker.jobs) >= self.jobs_per_worker:
+                return
+            job_id, ref, args = self._queue.popleft()
+            if self._futures[job_id].cancelled():
+                del self._futures[job_id]
+                del self._tracks[job_id]
+                continue
+
+            with span('send', 'dispatch', self._tracks[job_id], worker=worker.process.pid):
+                message = pickle.dumps((job_id, ref, args))
+                worker.conn.send_bytes(message)
+            worker.jobs.add(job_id)
+            self.jobs_sent += 1
+            self.bytes_sent += len(message)
+
+    def _receive(self, worker: '_Worker'):
+        start = now()
+        try:
+            job_id, ok, result = dill.loads(worker.conn.recv_bytes())
+        except (EOFError, OSError):
+            self._lost(worker)
+            return
+
+        complete('receive', 'dispatch', start, self._tracks.pop(job_id, None), worker=worker.process.pid)
+        worker.jobs.discard(job_id)
+        fut = self._futures.pop(job_id)
+        if not fut.done():
+            if ok:
+                fut.set_result(result)
+            else:
+                fut.set_exception(result)
+        self._dispatch()
+
+    def _lost(self, worker: '_Worker'):
+        "Fail the jobs of a worker that died"
+        assert self._loop is not None
+        self._loop.remove_reader(worker.conn.fileno())
+        self._workers.remove(worker)
+        for job_id in worker.jobs:
+            self._tracks.pop(job_id, None)
+            fut = self._futures.pop(job_id)
+            if not fut.done():
+                fut.set_exception(WorkerDiedError(
+                    f"worker process {worker.process.pid} died with exit code {worker.process.exitcode}"))
+        if not self._workers:
+            for fut in self._futures.values():
+                if not fut.done():
+                    fut.set_exception(WorkerDiedError("all worker processes died"))
+            self._futures.clear()
+            self._tracks.clear()
+            self._queue.clear()
+
+    def shutdown(self):
+        self._detach()
+        for worker in self._workers:
+            try:
+                worker.conn.send_bytes(pickle.dumps(None))
+            except OSError:
+                pass
+        for worker in self._workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.conn.close()
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_: Any):
+        self.shutdown()
+
+
+class _Worker:
+    def __init__(self, process: Any, conn: Connection):
+        self.process = process
+        self.conn = conn
+        self.jobs: Set[int] = set()
+
+
+class WorkerDiedError(Exception):
+    pass
+
+
+def _serve(conn: Connection, items: List[Any], job: Job):
+    "Worker process main loop: run jobs as they arrive on a single event loop until told to stop"
+    # we were forked from within the parent's running event loop
+    asyncio.events._set_running_loop(None)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    stopped = loop.create_future()
+    running: Set['asyncio.Task[None]'] = set()
+
+    async def run(job_id: int, item: Any, args: Tuple[Any, ...]):
+        try:
+            reply = (job_id, True, await job(item, *args))
+        except BaseException as e:
+            reply = (job_id, False, e)
+
+        try:
+            data = pickle.dumps(reply)
+        except Exception:
+            try:
+                # ie for exceptions defined in a PyMakefile
+                data = dill.dumps(reply)
+            except Exception as e:
+                data = pickle.dumps((job_id, False, Exception(
+                    f"Couldn't send the result of the job back from worker {os.getpid()}: {e!r}, "
+                    f"result was: {reply[2]!r}")))
+        conn.send_bytes(data)
+
+    def receive():
+        try:
+            message = pickle.loads(conn.recv_bytes())
+        except (EOFError, OSError):
+            message = None
+        if message is None:
+            if not stopped.done():
+                stopped.set_result(None)
+            return
+
+        job_id, ref, args = message
+        item = items[ref] if isinstance(ref, int) else dill.loads(ref)
+        task = loop.create_task(run(job_id, item, args))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+    loop.add_reader(conn.fileno(), receive)
+    try:
+        loop.run_until_complete(stopped)
+        if running:
+            loop.run_until_complete(asyncio.wait(running))
+    finally:
+        loop.remove_reader(conn.fileno())
+        loop.close()
+        conn.close()
@@ -37,5 +37,7 @@ setup(
     entry_points='''
         [console_scripts]
         pymake=pymake.cli:cli_shell
+        pymakec=pymake.client:main
+        pymake-worker=pymake.remote:main
     ''',
 )
@@ -0,0 +1,24 @@
+"""Targets are keyed in the artifact cache by the envvars that change what they make, and no others"""
+from pathlib import Path
+
+from pymake.artifacts import Artifacts, LocalStore
+from pymake.targets.target import Target
+
+
+class _File(Target):
+    async def make(self):
+        pass
+
+
+def _key(directory: Path, **env: str) -> str:
+    target = _File('out', 'src', cwd=directory)
+    target.env.update(env)
+    return Artifacts(LocalStore(directory / 'artifacts')).key(target, 'deps')
+
+
+def test_key_ignores_unrelated_envvars(tmp_path: Path):
+    assert _key(tmp_path, SOME_TOKEN='a', PATH='/a') == _key(tmp_path, SOME_TOKEN='b', PATH='/b')
+
+
+def test_key_changes_with_keyed_envvars(tmp_path: Path):
+    assert _key(tmp_path, CFLAGS='-O2') != _key(tmp_path, CFLAGS='-O0')
@@ -0,0 +1,56 @@
+"""The cache's journal recovers from records torn by a crash mid-append, and from corrupt records"""
+from pathlib import Path
+import json
+
+from pymake.cache import TimestampCache
+from pymake.targets.target import Target
+
+
+class _File(Target):
+    async def make(self):
+        pass
+
+
+def _targets(directory: Path):
+    return {name: _File(name, 'src', cwd=directory) for name in ('a', 'b', 'c')}
+
+
+def _journal(directory: Path) -> Path:
+    path = directory / 'cache'
+    path.write_text(''.join(json.dumps(['timestamp', name, float(i)]) + '\n' for i, name in enumerate('abc')))
+    return path
+
+
+def _timestamps(cache: TimestampCache):
+    return {str(target.target): when for target, when in cache.items()}
+
+
+def _records(path: Path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_torn_last_record_is_truncated(tmp_path: Path):
+    path = _journal(tmp_path)
+    lines = path.read_text().splitlines(keepends=True)
+    path.write_text(lines[0] + lines[1] + lines[2][:10])
+
+    cache = TimestampCache(path, _targets(tmp_path))
+    assert _timestamps(cache) == {'a': 0.0, 'b': 1.0}
+    assert path.read_text() == lines[0] + lines[1]
+
+    cache.compact()
+    assert sorted(_records(path)) == [['timestamp', 'a', 0.0], ['timestamp', 'b', 1.0]]
+    assert _timestamps(TimestampCache(path, _targets(tmp_path))) == {'a': 0.0, 'b': 1.0}
+
+
+def test_corrupt_middle_record_is_skipped(tmp_path: Path):
+    path = _journal(tmp_path)
+    lines = path.read_text().splitlines(keepends=True)
+    path.write_text(lines[0] + '["timest\n' + lines[1] + lines[2])
+
+    cache = TimestampCache(path, _targets(tmp_path))
+    assert _timestamps(cache) == {'a': 0.0, 'b': 1.0, 'c': 2.0}
+
+    cache.compact()
+    assert sorted(_records(path)) == [['timestamp', 'a', 0.0], ['timestamp', 'b', 1.0], ['timestamp', 'c', 2.0]]
+    assert _timestamps(TimestampCache(path, _targets(tmp_path))) == {'a': 0.0, 'b': 1.0, 'c': 2.0}
@@ -0,0 +1,65 @@
+"""Builds of PyMakefiles, run through the CLI as users run them"""
+from typing import List
+from pathlib import Path
+import subprocess
+import time
+import sys
+import os
+
+ROOT = Path(__file__).parent.parent
+
+CHAIN = '''
+from pymake import *
+
+@makes('a.o', 'a.c')
+async def a(out: Path):
+    await sh(f"cp a.c {out}; echo a >> made.log")
+
+@makes('app', 'a.o')
+async def app(out: Path):
+    await sh(f"cp a.o {out}; echo app >> made.log")
+'''
+
+
+def pymake(cwd: Path, *args: str) -> str:
+    "Run pymake with the arguments in the directory, returning its stdout"
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(ROOT)] + sys.path))
+    res = subprocess.run([sys.executable, '-c', 'from pymake.cli import cli_shell; cli_shell()', *args],
+                         cwd=cwd, env=env, capture_output=True, text=True)
+    assert res.returncode == 0, res.stderr
+    return res.stdout
+
+
+def _made(directory: Path) -> List[str]:
+    "The targets made since the last call"
+    log = directory / 'made.log'
+    if not log.exists():
+        return []
+    made = log.read_text().split()
+    log.unlink()
+    return made
+
+
+def test_touched_intermediate_output_remakes_its_dependents(tmp_path: Path):
+    (tmp_path / 'PyMakefile.py').write_text(CHAIN)
+    (tmp_path / 'a.c').write_text('a')
+    pymake(tmp_path, 'app')
+    assert _made(tmp_path) == ['a', 'app']
+    pymake(tmp_path, 'app')
+    assert _made(tmp_path) == []
+
+    # as if a.o was remade by another build, or edited by hand
+    later = time.time() + 10
+    os.utime(tmp_path / 'a.o', (later, later))
+    assert pymake(tmp_path, '-n', 'app').split(':')[0] == 'app'
+    pymake(tmp_path, 'app')
+    assert _made(tmp_path) == ['app']
+
+
+def test_makefile_in_subdirectory_resolves_from_parent(tmp_path: Path):
+    # dependencies are resolved under the makefile's directory, ie 'd/a.o', which the index must know a.o by
+    (tmp_path / 'd').mkdir()
+    (tmp_path / 'd' / 'PyMakefile.py').write_text(CHAIN)
+    (tmp_path / 'd' / 'a.c').write_text('a')
+    stale = pymake(tmp_path, '-m', 'd/PyMakefile.py', '-n', 'app')
+    assert [line.split(':')[0] for line in stale.splitlines()] == ['a.o', 'app']
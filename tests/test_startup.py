@@ -0,0 +1,42 @@
+"""Importing pymake, as every PyMakefile does, and `pymake show` must stay within their startup budgets, and
+importing pymake mustn't import the modules that are only needed once targets are remade. The import is budgeted
+relative to importing asyncio, so that it holds on slower machines. See `benchmarks.startup` for the full
+benchmark"""
+from pathlib import Path
+
+from benchmarks.generate import generate
+from benchmarks.startup import IMPORT_BUDGET_RATIO, LAZY_MODULES, REPEATS, SHOW_BUDGET_MS, import_times, \
+    show_seconds
+
+MAKEFILE = '''
+from pymake import *
+
+@makes('out.txt', 'in.txt')
+async def out(out: Path, deps: Dependencies):
+    await sh(f"cp {deps[0]} {out}")
+'''
+
+
+def test_import_pymake_is_lazy():
+    imported = import_times('import pymake')
+    assert not [module for module in LAZY_MODULES if module in imported]
+
+
+def test_loading_a_makefile_is_lazy(tmp_path: Path):
+    (tmp_path / 'PyMakefile.py').write_text(MAKEFILE)
+    imported = import_times(
+        "from pymake.compiled import load_targets; assert load_targets('PyMakefile.py')", cwd=str(tmp_path))
+    assert not [module for module in LAZY_MODULES if module in imported]
+
+
+def test_import_pymake_is_within_budget():
+    import_ms = min(import_times('import pymake')['pymake'] for _ in range(REPEATS))
+    asyncio_ms = min(import_times('import asyncio')['asyncio'] for _ in range(REPEATS))
+    assert import_ms / asyncio_ms <= IMPORT_BUDGET_RATIO
+
+
+def test_show_is_within_budget(tmp_path: Path):
+    generate(tmp_path, 'fanout', 100)
+    show_seconds(str(tmp_path))  # warm the filesystem cache
+    show_ms = min(show_seconds(str(tmp_path)) for _ in range(REPEATS)) * 1000
+    assert show_ms <= SHOW_BUDGET_MS